@@ -1,5 +1,8 @@
 """
 Queries the AMANDA read-replica DB and sents the result as a CSV in S3
+
+oracledb, pandas and boto3 are imported by the functions that use them, so the
+module imports quickly (a cached result never needs oracledb or pandas).
 """
 
 import argparse
@@ -7,12 +10,12 @@ from io import StringIO
 import os
 import logging
 
-import oracledb as cx_Oracle
-import pandas as pd
-import boto3
-
 import utils
-from queries import QUERIES
+from fetch_tuning import apply_fetch_settings, fetch_settings
+from profiling import Profiler, add_profile_arguments
+from queries import DEFAULT_CACHE_TTL, QUERIES, QUERY_SETTINGS
+from result_cache import LocalResultStore, ResultCache, S3ResultStore, cache_key
+from tracing import Tracer, trace_oracle, trace_s3
 
 # AMANDA RR DB Credentials
 HOST = os.getenv("HOST")
@@ -21,6 +24,9 @@ SERVICE_NAME = os.getenv("SERVICE_NAME")
 USER = os.getenv("DB_USER")
 PASSWORD = os.getenv("DB_PASS")
 
+# Connection class of the sessions taken from DRCP, see get_pool
+DRCP_CONNECTION_CLASS = "ROW_REPORTING"
+
 # AWS Credentials
 AWS_ACCESS_ID = os.getenv("EXEC_DASH_ACCESS_ID")
 AWS_PASS = os.getenv("EXEC_DASH_PASS")
@@ -40,6 +46,8 @@ issued_permits: similar to applications_received but is now for counting those p
 
 """
 
+logger = logging.getLogger(__name__)
+
 
 def get_conn():
     """
@@ -50,10 +58,41 @@ def get_conn():
     cx_Oracle Connection Object
 
     """
+    import oracledb as cx_Oracle
+
     dsn_tns = cx_Oracle.makedsn(HOST, PORT, service_name=SERVICE_NAME)
     return cx_Oracle.connect(user=USER, password=PASSWORD, dsn=dsn_tns)
 
 
+def get_pool(size, drcp=False):
+    """
+    Returns a pool of connections to the AMANDA Read replica database, used when
+    several queries run at the same time. With drcp the sessions are taken from the
+    database resident connection pool, under DRCP_CONNECTION_CLASS, so they are
+    shared with other processes instead of each one opening its own.
+    """
+    import oracledb as cx_Oracle
+
+    if drcp:
+        return cx_Oracle.create_pool(
+            user=USER,
+            password=PASSWORD,
+            host=HOST,
+            port=int(PORT),
+            service_name=SERVICE_NAME,
+            server_type="pooled",
+            cclass=DRCP_CONNECTION_CLASS,
+            purity=cx_Oracle.PURITY_SELF,
+            min=1,
+            max=size,
+            increment=1,
+        )
+    dsn_tns = cx_Oracle.makedsn(HOST, PORT, service_name=SERVICE_NAME)
+    return cx_Oracle.create_pool(
+        user=USER, password=PASSWORD, dsn=dsn_tns, min=1, max=size, increment=1
+    )
+
+
 def row_factory(cursor):
     """
     Define cursor row handler which returns each row as a dict
@@ -71,7 +110,90 @@ def row_factory(cursor):
     return lambda *args: dict(zip([d[0] for d in cursor.description], args))
 
 
-def df_to_s3(df, resource, filename):
+def run_query(conn, query, binds=None, fetch=None):
+    """
+    Runs one of the queries in queries.py
+
+    Parameters
+    ----------
+    conn : cx_Oracle Connection Object
+    query (str): key of the query in QUERIES
+    binds (dict): values of the query's bind parameters by name
+    fetch (dict): arraysize and prefetchrows of the cursor, the query's fetch_settings by default
+
+    Returns
+    -------
+    list of dicts, one per row
+
+    """
+    cursor = conn.cursor()
+    apply_fetch_settings(cursor, fetch_settings(query) if fetch is None else fetch)
+    logger.info(f"Executing query: {query}")
+    cursor.execute(QUERIES[query], binds or {})
+    cursor.rowfactory = row_factory(cursor)
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+
+def query_csv(connect, query, cache=None, binds=None):
+    """
+    Returns the result of a query as CSV. Results fetched within the query's
+    cache_ttl (see QUERY_SETTINGS) are served from the cache instead of AMANDA.
+
+    Parameters
+    ----------
+    connect : function returning a cx_Oracle Connection, only called when the result isn't cached
+    query (str): key of the query in QUERIES
+    cache (result_cache.ResultCache): cache of the results, None to always run the query
+    binds (dict): values of the query's bind parameters by name
+
+    Returns
+    -------
+    str: the CSV of the result
+
+    """
+    ttl = QUERY_SETTINGS.get(query, {}).get("cache_ttl", DEFAULT_CACHE_TTL)
+    key = None
+    if cache is not None and ttl > 0:
+        key = cache_key(QUERIES[query], binds, ttl)
+        csv = cache.get(query, key)
+        if csv is not None:
+            return csv
+
+    import pandas as pd
+
+    with connect() as conn:
+        rows = run_query(conn, query, binds)
+    csv = pd.DataFrame(rows).to_csv(index=False)
+    if key is not None:
+        cache.put(query, key, csv)
+    return csv
+
+
+def get_s3_client():
+    """Returns a boto3 S3 client with the AWS credentials"""
+    import boto3
+
+    return boto3.client(
+        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
+    )
+
+
+def get_result_cache(kind, s3_client, refresh=False):
+    """Returns the query result cache kept in CACHE_DIR (local) or in the S3 bucket (s3)"""
+    if kind == "s3":
+        return ResultCache(S3ResultStore(s3_client, BUCKET), refresh)
+    return ResultCache(LocalResultStore(), refresh)
+
+
+def csv_to_s3(csv, client, filename):
+    """Uploads a CSV to the S3 bucket as <filename>.csv"""
+    client.put_object(Bucket=BUCKET, Key=f"{filename}.csv", Body=csv)
+    return csv
+
+
+def df_to_s3(df, client, filename):
     """
     Send pandas dataframe to an S3 bucket as a CSV
     h/t https://stackoverflow.com/questions/38154040/save-dataframe-to-csv-directly-to-s3-python
@@ -79,34 +201,36 @@ def df_to_s3(df, resource, filename):
     Parameters
     ----------
     df : Pandas Dataframe
-    resource : boto3 s3 resource
+    client : boto3 s3 client
     filename : String of the file that will be created in the S3 bucket ex:
 
+    Returns
+    -------
+    str: the CSV that was uploaded
+
     """
     csv_buffer = StringIO()
     df.to_csv(csv_buffer, index=False)
-    resource.Object(BUCKET, f"{filename}.csv").put(Body=csv_buffer.getvalue())
+    return csv_to_s3(csv_buffer.getvalue(), client, filename)
 
 
 def main(args):
-    # Connect to AMANDA RR DB
-    conn = get_conn()
-    cursor = conn.cursor()
+    script = f"amanda_to_s3-{args.query}"
+    with Profiler.from_args(script, args) as profiler, Tracer(script):
+        s3_client = trace_s3(get_s3_client())
+        cache = get_result_cache(args.cache_store, s3_client, args.refresh)
+        binds = dict(bind.split("=", 1) for bind in args.bind)
 
-    # Execute our query
-    logger.info(f"Executing query: {args.query}")
-    cursor.execute(QUERIES[args.query])
-    cursor.rowfactory = row_factory(cursor)
-    rows = cursor.fetchall()
-    conn.close()
+        # Connect to AMANDA RR DB, unless the result is cached
+        with profiler.stage("download"):
+            csv = query_csv(
+                lambda: trace_oracle(get_conn()), args.query, cache, binds
+            )
 
-    # Upload to S3
-    logger.info(f"Uploading {len(rows)} rows to S3")
-    s3_resource = boto3.resource(
-        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
-    )
-    df = pd.DataFrame(rows)
-    df_to_s3(df, s3_resource, args.query)
+        # Upload to S3
+        with profiler.stage("publish"):
+            logger.info(f"Uploading {args.query}.csv to S3")
+            csv_to_s3(csv, s3_client, args.query)
 
 
 # CLI argument definition
@@ -119,12 +243,29 @@ parser.add_argument(
     help="Name of the query defined in queries.py. Ex: applications_received",
 )
 
-args = parser.parse_args()
+parser.add_argument(
+    "--bind",
+    action="append",
+    default=[],
+    help="Value of a bind parameter of the query as NAME=VALUE, can be repeated",
+)
 
-logger = utils.get_logger(
-    __name__,
-    level=logging.INFO,
+parser.add_argument(
+    "--refresh",
+    action="store_true",
+    help="Run the query even if a cached result is still within its cache_ttl",
 )
 
+parser.add_argument(
+    "--cache-store",
+    choices=["local", "s3"],
+    default="local",
+    help="Keep the query result cache in CACHE_DIR (local) or in the S3 bucket (s3)",
+)
+
+add_profile_arguments(parser)
+
 if __name__ == "__main__":
+    utils.get_logger(__name__, level=logging.INFO)
+    args = parser.parse_args()
     main(args)
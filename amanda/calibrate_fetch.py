@@ -0,0 +1,272 @@
+"""
+Calibrates the fetch settings (cursor.arraysize and cursor.prefetchrows) of an AMANDA
+query against the read replica.
+
+The query is run once to warm up the database and count its rows, then once per
+combination of the arraysize and prefetchrows values given (repeated --repeat
+times). Each run records the round trips to the database, the rows fetched per
+second and the Python memory peak of the fetch. The fastest settings whose memory
+peak is under --max-memory-mb are stored in fetch_tuning.json in CACHE_DIR, which
+amanda_to_s3.py and extraction_service.py on the same machine fetch with from then
+on. The QUERY_SETTINGS entry with the settings is logged too, to be committed in
+queries.py so every deployment uses them.
+
+Round trips are read from the session's "SQL*Net roundtrips to/from client"
+statistic when the user can read v$mystat, otherwise they are estimated from the
+row count.
+
+python amanda/calibrate_fetch.py --query lde_site_plan_revisions
+"""
+import argparse
+import json
+import logging
+import statistics
+import time
+import tracemalloc
+
+import utils
+from amanda_to_s3 import get_conn, run_query
+from fetch_tuning import FETCH_TUNING_PATH, fetch_settings, save_fetch_tuning
+from profiling import reset_memory_peak
+from queries import QUERIES, QUERY_SETTINGS
+
+# oracledb's defaults
+DEFAULT_ARRAYSIZE = 100
+DEFAULT_PREFETCHROWS = 2
+
+ROUND_TRIPS_SQL = """
+    SELECT ms.value
+    FROM v$mystat ms
+    JOIN v$statname sn ON ms.statistic# = sn.statistic#
+    WHERE sn.name = 'SQL*Net roundtrips to/from client'
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def round_trips(conn):
+    """Returns the round trips of the session so far, or None when v$mystat can't be read"""
+    import oracledb as cx_Oracle
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute(ROUND_TRIPS_SQL)
+        return cursor.fetchone()[0]
+    except cx_Oracle.DatabaseError:
+        return None
+    finally:
+        cursor.close()
+
+
+def estimate_round_trips(rows, arraysize, prefetchrows):
+    """
+    Round trips of a query fetching `rows` rows: the execute (which returns the
+    prefetched rows), then one per arraysize rows left. A fetch that comes back with
+    fewer than arraysize rows ends the query, so a result that is a multiple of the
+    fetch size takes one more.
+    """
+    if rows < prefetchrows:
+        return 1
+    return 2 + (rows - prefetchrows) // arraysize
+
+
+def measure(conn, query, binds, arraysize, prefetchrows):
+    """
+    Runs a query once with the given fetch settings.
+
+    Returns
+    -------
+    dict: rows, seconds, rows_per_second, round_trips (None when they can't be read) and peak_memory_mb
+
+    """
+    before = round_trips(conn)
+    # Tracing may already be on for a caller's --profile, leave it running for them
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    else:
+        reset_memory_peak()
+    memory_start, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    rows = run_query(
+        conn, query, binds, {"arraysize": arraysize, "prefetchrows": prefetchrows}
+    )
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    if started:
+        tracemalloc.stop()
+    after = round_trips(conn)
+    return {
+        "rows": len(rows),
+        "seconds": seconds,
+        "rows_per_second": len(rows) / seconds if seconds else None,
+        # The round trip of the statistics query itself is left out
+        "round_trips": after - before - 1 if None not in (before, after) else None,
+        "peak_memory_mb": (peak - memory_start) / 1024**2,
+    }
+
+
+def candidates(rows, arraysizes, prefetchrows):
+    """
+    Returns the (arraysize, prefetchrows) combinations to measure. A prefetchrows of
+    0 means "same as arraysize". Results smaller than the largest arraysize also get
+    the settings that return every row with the execute, in one round trip.
+    """
+    combinations = {
+        (arraysize, prefetch or arraysize)
+        for arraysize in arraysizes
+        for prefetch in prefetchrows
+    }
+    if rows < max(arraysizes):
+        # prefetchrows is one more than the result, so oracledb knows it has every row
+        combinations.add((rows + 1, rows + 1))
+    return sorted(combinations)
+
+
+def calibrate(conn, query, binds, arraysizes, prefetchrows, repeat):
+    """
+    Measures a query with each candidate fetch setting.
+
+    Returns
+    -------
+    list of dicts, the settings and median measurements of each candidate
+
+    """
+    # Warms up the database's cache and the statement cache, and counts the rows
+    rows = len(run_query(conn, query, binds))
+    logger.info(f"{query} returns {rows} rows")
+
+    results = []
+    for arraysize, prefetch in candidates(rows, arraysizes, prefetchrows):
+        runs = [measure(conn, query, binds, arraysize, prefetch) for _ in range(repeat)]
+        round_trips = runs[-1]["round_trips"]
+        result = {
+            "arraysize": arraysize,
+            "prefetchrows": prefetch,
+            "rows": rows,
+            "seconds": statistics.median(run["seconds"] for run in runs),
+            "peak_memory_mb": max(run["peak_memory_mb"] for run in runs),
+            "round_trips": round_trips,
+            "round_trips_estimated": round_trips is None,
+        }
+        if round_trips is None:
+            result["round_trips"] = estimate_round_trips(rows, arraysize, prefetch)
+        result["rows_per_second"] = rows / result["seconds"] if result["seconds"] else None
+        logger.info(
+            f"arraysize={arraysize} prefetchrows={prefetch}: {result['seconds']:.3f}s, "
+            f"{result['round_trips']} round trips, {result['peak_memory_mb']:.1f} MB"
+        )
+        results.append(result)
+    return results
+
+
+def best(results, max_memory_mb):
+    """
+    Returns the fastest result whose memory peak is under max_memory_mb, fewer round
+    trips break ties. When none fit, the one using the least memory.
+    """
+    fitting = [result for result in results if result["peak_memory_mb"] <= max_memory_mb]
+    if not fitting:
+        return min(results, key=lambda result: result["peak_memory_mb"])
+    return min(fitting, key=lambda result: (result["seconds"], result["round_trips"]))
+
+
+def query_settings_entry(query, settings):
+    """Returns the QUERY_SETTINGS entry of a query with its fetch settings replaced"""
+    entry = {
+        **QUERY_SETTINGS.get(query, {}),
+        **{name: settings[name] for name in ["arraysize", "prefetchrows"]},
+    }
+    return f'"{query}": {json.dumps(entry)},'
+
+
+def main(args):
+    binds = dict(bind.split("=", 1) for bind in args.bind)
+    current = fetch_settings(args.query)
+    logger.info(
+        f"Current settings of {args.query}: "
+        f"arraysize={current.get('arraysize', DEFAULT_ARRAYSIZE)} "
+        f"prefetchrows={current.get('prefetchrows', DEFAULT_PREFETCHROWS)}"
+    )
+    with get_conn() as conn:
+        results = calibrate(
+            conn, args.query, binds, args.arraysize, args.prefetchrows, args.repeat
+        )
+    chosen = best(results, args.max_memory_mb)
+    logger.info(
+        f"Best settings of {args.query}: arraysize={chosen['arraysize']} "
+        f"prefetchrows={chosen['prefetchrows']}"
+    )
+    logger.info(
+        "To use them everywhere, commit this entry in QUERY_SETTINGS in queries.py:\n"
+        + query_settings_entry(args.query, chosen)
+    )
+    if args.dry_run:
+        return chosen
+    return save_fetch_tuning(
+        args.query,
+        chosen,
+        {
+            name: chosen[name]
+            for name in ["rows", "seconds", "round_trips", "round_trips_estimated", "peak_memory_mb"]
+        },
+    )
+
+
+# CLI argument definition
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "--query",
+    choices=list(QUERIES.keys()),
+    required=True,
+    help="Name of the query defined in queries.py. Ex: lde_site_plan_revisions",
+)
+
+parser.add_argument(
+    "--bind",
+    action="append",
+    default=[],
+    help="Value of a bind parameter of the query as NAME=VALUE, can be repeated",
+)
+
+parser.add_argument(
+    "--arraysize",
+    type=int,
+    nargs="+",
+    default=[DEFAULT_ARRAYSIZE, 500, 1000, 5000, 10000],
+    help="Values of cursor.arraysize to measure",
+)
+
+parser.add_argument(
+    "--prefetchrows",
+    type=int,
+    nargs="+",
+    default=[DEFAULT_PREFETCHROWS, 0],
+    help="Values of cursor.prefetchrows to measure with each arraysize, 0 is the same as the arraysize",
+)
+
+parser.add_argument(
+    "--repeat",
+    type=int,
+    default=3,
+    help="Runs of each setting, the median time is kept",
+)
+
+parser.add_argument(
+    "--max-memory-mb",
+    type=float,
+    default=256,
+    help="Settings whose fetch peaks above this much Python memory aren't chosen",
+)
+
+parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help=f"Only log the best settings, don't store them in {FETCH_TUNING_PATH}",
+)
+
+if __name__ == "__main__":
+    utils.get_logger(__name__, level=logging.INFO)
+    args = parser.parse_args()
+    main(args)
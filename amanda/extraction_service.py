@@ -0,0 +1,382 @@
+"""
+Long-running AMANDA extraction service.
+
+Keeps a warm pool of connections to the AMANDA read replica and runs the queries in
+queries.py on the schedules in QUERY_SETTINGS, uploading each result to S3 the same
+way amanda_to_s3.py does. Queries can also be run on demand through a local HTTP
+endpoint, which reports the service's health and the latency of each query:
+
+GET /health               200 when a pooled connection answers a ping, 503 otherwise
+GET /stats                runs, failures and latencies of each query
+POST /queries/<query>     runs a query now, add ?refresh=1 to skip the result cache
+"""
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import signal
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import utils
+from amanda_to_s3 import (
+    csv_to_s3,
+    get_pool,
+    get_result_cache,
+    get_s3_client,
+    query_csv,
+)
+from queries import QUERIES, QUERY_SETTINGS
+from tracing import Tracer, trace_oracle, trace_s3
+
+# Ranges of the fields of a cron expression: minute, hour, day, month, weekday (0 is sunday)
+CRON_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+# Number of recent run times each query's latency percentiles are computed from
+LATENCY_WINDOW = 100
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cron_field(field, low, high):
+    """Returns the set of values a cron field (*, */5, 1-5, 1,15, 10/20) allows"""
+    values = set()
+    for part in field.split(","):
+        part, _, step = part.partition("/")
+        step = int(step) if step else 1
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(value) for value in part.split("-"))
+        else:
+            start = int(part)
+            # "10/20" runs from 10 to the end of the range every 20
+            end = high if step > 1 else start
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"Invalid cron field {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def parse_cron(expression):
+    """
+    Parses a cron expression of 5 fields: minute, hour, day of the month, month and
+    day of the week (0 is sunday). A time must match every field, including both day
+    fields.
+
+    Returns
+    -------
+    list of the sets of values each field allows
+
+    """
+    fields = expression.split()
+    if len(fields) != len(CRON_RANGES):
+        raise ValueError(f"Cron expression needs {len(CRON_RANGES)} fields: {expression}")
+    return [
+        parse_cron_field(field, low, high)
+        for field, (low, high) in zip(fields, CRON_RANGES)
+    ]
+
+
+def cron_matches(schedule, when):
+    """Whether a parsed cron schedule runs at a datetime (to the minute)"""
+    minute, hour, day, month, weekday = schedule
+    # Python's weekday() is 0 on monday
+    return (
+        when.minute in minute
+        and when.hour in hour
+        and when.day in day
+        and when.month in month
+        and (when.weekday() + 1) % 7 in weekday
+    )
+
+
+class QueryStats:
+    """Runs, failures and recent latencies of one query"""
+
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.running = False
+        self.last_started = None
+        self.last_finished = None
+        self.last_error = None
+        self.last_bytes = 0
+        self.seconds = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def to_dict(self):
+        seconds = sorted(self.seconds)
+
+        def percentile(p):
+            if not seconds:
+                return None
+            return round(seconds[min(int(p * len(seconds)), len(seconds) - 1)], 3)
+
+        return {
+            "runs": self.runs,
+            "failures": self.failures,
+            "running": self.running,
+            "last_started": self.last_started,
+            "last_finished": self.last_finished,
+            "last_error": self.last_error,
+            "last_bytes": self.last_bytes,
+            "p50_seconds": percentile(0.5),
+            "p95_seconds": percentile(0.95),
+            "max_seconds": round(seconds[-1], 3) if seconds else None,
+        }
+
+
+class ExtractionService:
+    """
+    Runs AMANDA queries on a shared connection pool and uploads their results to S3.
+
+    Parameters
+    ----------
+    pool : oracledb ConnectionPool
+    s3_client : boto3 S3 client object
+    cache_store (str): where the query result cache is kept, "local" or "s3"
+    schedules (dict): query name to cron expression
+    concurrency (int): queries run at the same time, less than the size of the pool so a
+        connection is always free for the health check
+
+    """
+
+    def __init__(self, pool, s3_client, cache_store, schedules, concurrency):
+        self.pool = pool
+        self.s3_client = s3_client
+        self.cache = get_result_cache(cache_store, s3_client)
+        # Scheduled runs always query AMANDA, their result still refreshes the cache
+        self.refresh_cache = get_result_cache(cache_store, s3_client, refresh=True)
+        self.schedules = {query: parse_cron(cron) for query, cron in schedules.items()}
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="extract"
+        )
+        self.stats = {query: QueryStats() for query in QUERIES}
+        self.started_at = datetime.datetime.now().isoformat()
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        # One health check at a time, so they only ever need the pool's spare connection
+        self._health_lock = threading.Lock()
+
+    def trigger(self, query, refresh=False):
+        """
+        Queues a run of a query, unless it is already running or the service is
+        stopping.
+
+        Returns
+        -------
+        bool: whether the run was queued
+
+        """
+        with self._lock:
+            stats = self.stats[query]
+            if self.stopped.is_set() or stats.running:
+                return False
+            stats.running = True
+        try:
+            self.executor.submit(self.extract, query, refresh)
+        except RuntimeError:
+            # The executor was shut down since the check above
+            with self._lock:
+                stats.running = False
+            return False
+        return True
+
+    def extract(self, query, refresh=False):
+        """Runs a query (or reads its cached result) and uploads the CSV to S3"""
+        stats = self.stats[query]
+        with self._lock:
+            stats.last_started = datetime.datetime.now().isoformat()
+        start = time.perf_counter()
+        # Each run exports its own spans, the tracer isn't shared between threads
+        tracer = Tracer(f"amanda_to_s3-{query}")
+
+        def connect():
+            return trace_oracle(self.pool.acquire(), tracer)
+
+        try:
+            cache = self.refresh_cache if refresh else self.cache
+            csv = query_csv(connect, query, cache)
+            csv_to_s3(csv, trace_s3(self.s3_client, tracer), query)
+        except Exception as e:
+            logger.exception(f"{query} failed")
+            with self._lock:
+                stats.failures += 1
+                stats.last_error = repr(e)
+        else:
+            seconds = time.perf_counter() - start
+            logger.info(f"Uploaded {query} in {seconds:.2f}s")
+            with self._lock:
+                stats.runs += 1
+                stats.last_error = None
+                stats.last_bytes = len(csv.encode())
+                stats.seconds.append(seconds)
+        finally:
+            with self._lock:
+                stats.running = False
+                stats.last_finished = datetime.datetime.now().isoformat()
+            tracer.export()
+
+    def run_schedules(self):
+        """Triggers the scheduled queries at the start of every minute until stopped"""
+        while True:
+            now = time.time()
+            if self.stopped.wait(60 - now % 60):
+                return
+            minute = datetime.datetime.now().replace(second=0, microsecond=0)
+            for query, schedule in self.schedules.items():
+                if self.stopped.is_set():
+                    return
+                if cron_matches(schedule, minute) and not self.trigger(query, refresh=True):
+                    logger.warning(f"Skipping scheduled {query}, the last run hasn't finished")
+
+    def health(self):
+        """Pings a pooled connection, returns whether it answered and the pool's usage"""
+        status = {
+            "started_at": self.started_at,
+            "pool_opened": self.pool.opened,
+            "pool_busy": self.pool.busy,
+        }
+        try:
+            with self._health_lock, self.pool.acquire() as conn:
+                conn.ping()
+            status["status"] = "ok"
+        except Exception as e:
+            status["status"] = "unavailable"
+            status["error"] = repr(e)
+        return status
+
+    def stats_dict(self):
+        with self._lock:
+            return {query: stats.to_dict() for query, stats in self.stats.items()}
+
+    def stop(self):
+        with self._lock:
+            self.stopped.set()
+        self.executor.shutdown(wait=True)
+
+
+def handler(service):
+    """Returns the HTTP request handler class of the service's endpoints"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def _respond(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == "/health":
+                health = service.health()
+                self._respond(200 if health["status"] == "ok" else 503, health)
+            elif path == "/stats":
+                self._respond(200, service.stats_dict())
+            else:
+                self._respond(404, {"error": f"Unknown path {path}"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            prefix, _, query = url.path.rpartition("/")
+            if prefix != "/queries" or query not in QUERIES:
+                self._respond(404, {"error": f"Unknown query {url.path}"})
+                return
+            refresh = parse_qs(url.query).get("refresh", ["0"])[0] in ("1", "true")
+            if service.trigger(query, refresh=refresh):
+                self._respond(202, {"query": query, "queued": True})
+            elif service.stopped.is_set():
+                self._respond(503, {"query": query, "queued": False, "error": "stopping"})
+            else:
+                self._respond(409, {"query": query, "queued": False, "error": "already running"})
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return Handler
+
+
+def main(args):
+    schedules = {
+        query: settings["schedule"]
+        for query, settings in QUERY_SETTINGS.items()
+        if settings.get("schedule")
+    }
+    # One connection more than the workers can hold, so /health never waits on a
+    # long-running query to get one
+    pool = get_pool(args.concurrency + 1, drcp=args.drcp)
+    s3_client = get_s3_client()
+    service = ExtractionService(
+        pool, s3_client, args.cache_store, schedules, args.concurrency
+    )
+    server = ThreadingHTTPServer((args.host, args.port), handler(service))
+
+    def shutdown(signum, frame):
+        # server.shutdown() waits for serve_forever(), which runs on the main thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    scheduler = threading.Thread(target=service.run_schedules, name="scheduler")
+    scheduler.start()
+    logger.info(
+        f"Listening on {args.host}:{args.port}, scheduled: "
+        + (", ".join(f"{q} ({c})" for q, c in schedules.items()) or "nothing")
+    )
+    try:
+        server.serve_forever()
+    finally:
+        logger.info("Stopping, waiting for running queries to finish")
+        server.server_close()
+        service.stop()
+        scheduler.join()
+        pool.close()
+
+
+# CLI argument definition
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "--host",
+    default="127.0.0.1",
+    help="Address the HTTP endpoint listens on",
+)
+
+parser.add_argument(
+    "--port",
+    type=int,
+    default=8080,
+    help="Port of the HTTP endpoint",
+)
+
+parser.add_argument(
+    "--concurrency",
+    type=int,
+    default=4,
+    help="Queries run at the same time, the connection pool has one more connection for health checks",
+)
+
+parser.add_argument(
+    "--drcp",
+    action="store_true",
+    help="Take the pool's sessions from the database resident connection pool (DRCP)",
+)
+
+parser.add_argument(
+    "--cache-store",
+    choices=["local", "s3"],
+    default="local",
+    help="Keep the query result cache in CACHE_DIR (local) or in the S3 bucket (s3)",
+)
+
+if __name__ == "__main__":
+    utils.get_logger(__name__, level=logging.INFO)
+    args = parser.parse_args()
+    main(args)
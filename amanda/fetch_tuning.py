@@ -0,0 +1,90 @@
+"""
+Fetch settings (cursor.arraysize and cursor.prefetchrows) of the AMANDA queries.
+
+oracledb fetches 100 rows per round trip by default and prefetches 2 rows with the
+execute, whatever the size of the result. Queries can set their own values in
+QUERY_SETTINGS, and calibrate_fetch.py measures a range of values against the
+read replica and stores the best in fetch_tuning.json in CACHE_DIR, which takes
+precedence. The file is read on every query, so a long-running extraction_service.py
+picks up a new calibration without a restart. It is only kept as long as CACHE_DIR,
+calibrate_fetch.py also logs the QUERY_SETTINGS entry to commit in queries.py.
+"""
+import datetime
+import json
+import logging
+import os
+
+from queries import QUERY_SETTINGS
+from storage import CACHE_DIR, atomic_write
+
+FETCH_TUNING_PATH = os.getenv(
+    "FETCH_TUNING_PATH", os.path.join(CACHE_DIR, "fetch_tuning.json")
+)
+
+# The cursor attributes the settings are applied to
+FETCH_SETTINGS = ["arraysize", "prefetchrows"]
+
+logger = logging.getLogger(__name__)
+
+
+def load_fetch_tuning(path=FETCH_TUNING_PATH):
+    """Returns the calibrated settings by query name, empty when nothing was calibrated"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logger.warning(f"Ignoring unreadable fetch tuning file {path}")
+        return {}
+
+
+def fetch_settings(query, path=FETCH_TUNING_PATH):
+    """
+    Returns the fetch settings of a query: the calibrated ones from fetch_tuning.json,
+    then the ones in QUERY_SETTINGS. Settings that aren't set are left out, so the
+    oracledb defaults apply.
+
+    Returns
+    -------
+    dict: arraysize and/or prefetchrows
+
+    """
+    settings = {
+        name: value
+        for name, value in QUERY_SETTINGS.get(query, {}).items()
+        if name in FETCH_SETTINGS
+    }
+    calibrated = {
+        name: value
+        for name, value in load_fetch_tuning(path).get(query, {}).items()
+        if name in FETCH_SETTINGS
+    }
+    if calibrated and calibrated != settings:
+        logger.info(f"Fetching {query} with the settings calibrated in {path}: {calibrated}")
+    settings.update(calibrated)
+    return settings
+
+
+def apply_fetch_settings(cursor, settings):
+    """Sets the fetch settings on a cursor, they must be set before the query is executed"""
+    for name in FETCH_SETTINGS:
+        if settings.get(name) is not None:
+            setattr(cursor, name, int(settings[name]))
+
+
+def save_fetch_tuning(query, settings, measurements=None, path=FETCH_TUNING_PATH):
+    """
+    Stores the calibrated settings of a query in fetch_tuning.json, along with the
+    measurements they were chosen from. The settings of other queries are kept.
+    """
+    tuning = load_fetch_tuning(path)
+    tuning[query] = {
+        **{name: settings[name] for name in FETCH_SETTINGS if name in settings},
+        "calibrated_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        **(measurements or {}),
+    }
+    with atomic_write(path, "w") as f:
+        json.dump(tuning, f, indent=2, sort_keys=True)
+        f.write("\n")
+    return tuning[query]
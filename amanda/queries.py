@@ -61,6 +61,48 @@ QUERIES = {
     ORDER BY
         Foldertype
     """,
+    "applications_received_weekly": """
+    SELECT
+        Foldertype,
+        TO_CHAR(TRUNC(ROUND(INDATE, 'DDD') + 1, 'IW') + 5, 'YYYY-MM-DD') WeekEnding,
+        COUNT(1) IssuedROWPermits
+    FROM
+        folder
+    WHERE (foldertype in('DS')
+        AND STATUSCODE NOT IN(50005, 50003, 70045)
+        AND INDATE >= TO_DATE('10-01-2018', 'mm-dd-yyyy')
+        AND INDATE IS NOT NULL)
+        OR(foldertype in('RW', 'EX')
+            AND STATUSCODE NOT IN(70045, 50003)
+            AND INDATE >= TO_DATE('10-01-2018', 'mm-dd-yyyy')
+            AND SUBCODE NOT IN(50510, 50505)
+            AND INDATE IS NOT NULL)
+    GROUP BY
+        TO_CHAR(TRUNC(ROUND(INDATE, 'DDD') + 1, 'IW') + 5, 'YYYY-MM-DD'),
+        Foldertype
+    ORDER BY
+        Foldertype
+    """,
+    "issued_permits_weekly": """
+    SELECT
+        Foldertype,
+        TO_CHAR(TRUNC(ROUND(ISSUEDATE, 'DDD') + 1, 'IW') + 5, 'YYYY-MM-DD') WeekEnding,
+        COUNT(1) IssuedROWPermits
+    FROM
+        folder
+    WHERE (foldertype in('EX', 'DS')
+        AND ISSUEDATE >= TO_DATE('10-01-2018', 'mm-dd-yyyy')
+        AND ISSUEDATE IS NOT NULL)
+        OR(foldertype in('RW')
+            AND ISSUEDATE >= TO_DATE('10-01-2018', 'mm-dd-yyyy')
+            AND SUBCODE NOT IN(50510, 50505)
+            AND ISSUEDATE IS NOT NULL)
+    GROUP BY
+        TO_CHAR(TRUNC(ROUND(ISSUEDATE, 'DDD') + 1, 'IW') + 5, 'YYYY-MM-DD'),
+        Foldertype
+    ORDER BY
+        Foldertype
+    """,
     "review_time": """
     WITH
         pa_first AS (
@@ -513,3 +555,30 @@ QUERIES = {
         f.folderrsn
     """,
 }
+
+# Settings of each query:
+# cache_ttl: seconds the result of a query is reused by amanda_to_s3 before AMANDA is
+#   queried again, see result_cache.py. Queries without a cache_ttl aren't cached
+#   (DEFAULT_CACHE_TTL), so every run queries AMANDA.
+# schedule: cron expression (minute hour day month weekday) of when extraction_service.py
+#   runs the query and uploads the result to S3
+# arraysize, prefetchrows: rows fetched per round trip and rows returned with the
+#   execute, see fetch_tuning.py. Values calibrated by calibrate_fetch.py override these
+#   on the machine they were calibrated on, commit the entry it logs to keep them.
+DEFAULT_CACHE_TTL = 0
+
+QUERY_SETTINGS = {
+    # Snapshots of the permits active right now, a handful of rows returned with the execute
+    "active_permits": {
+        "schedule": "*/5 * * * *",
+        "arraysize": 50,
+        "prefetchrows": 51,
+    },
+    "row_inspector_permit_list": {"cache_ttl": 900, "arraysize": 1000, "prefetchrows": 1000},
+    "row_inspector_segment_list": {"cache_ttl": 900, "arraysize": 5000, "prefetchrows": 5000},
+    # Weekly counts and historical review times, rerun by backfills and ad-hoc pulls
+    "applications_received_weekly": {"cache_ttl": 3600},
+    "issued_permits_weekly": {"cache_ttl": 3600},
+    "review_time": {"cache_ttl": 3600},
+    "lde_site_plan_revisions": {"arraysize": 1000, "prefetchrows": 1000},
+}
@@ -0,0 +1,132 @@
+"""
+Cache of AMANDA query results, so reruns, ad-hoc pulls and backfills within a
+query's TTL don't hit the read replica again.
+
+Results are keyed by the query text, its bind parameters and the TTL window the
+run falls in, and stored as the gzipped CSV that is uploaded to S3. The cache is
+kept in CACHE_DIR or under a prefix of the S3 bucket, so runs on other machines
+share it.
+"""
+import datetime
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+
+from storage import CACHE_DIR, atomic_write
+
+# Prefix of the cached results in the S3 bucket
+S3_PREFIX = "query_cache"
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(sql, binds, ttl, now=None):
+    """
+    Returns the key of a query's result: a hash of the query text, the bind
+    parameters and the TTL window `now` falls in. A new window gets a new key, so
+    results are never served after the window they were fetched in.
+    """
+    now = time.time() if now is None else now
+    window = int(now // ttl)
+    payload = json.dumps(
+        {"sql": sql, "binds": binds or {}, "window": window, "ttl": ttl},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class LocalResultStore:
+    """Keeps the latest result of each query in a file in CACHE_DIR"""
+
+    def __init__(self, directory=os.path.join(CACHE_DIR, "query_results")):
+        self.directory = directory
+
+    def _path(self, query, key):
+        return os.path.join(self.directory, f"{query}-{key}.csv.gz")
+
+    def read(self, query, key):
+        path = self._path(query, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def write(self, query, key, data):
+        path = self._path(query, key)
+        with atomic_write(path) as f:
+            f.write(data)
+        # Results of earlier windows will never be read again
+        pattern = os.path.join(self.directory, f"{glob.escape(query)}-*.csv.gz")
+        for old in glob.glob(pattern):
+            if old != path:
+                os.remove(old)
+
+
+class S3ResultStore:
+    """Keeps the latest result of each query in an S3 object, its key in the object's metadata"""
+
+    def __init__(self, s3, bucket, prefix=S3_PREFIX):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _key(self, query):
+        return f"{self.prefix}/{query}.csv.gz"
+
+    def read(self, query, key):
+        # The key is checked on the object's metadata before its body is downloaded
+        try:
+            response = self.s3.head_object(Bucket=self.bucket, Key=self._key(query))
+        except self.s3.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+        if response["Metadata"].get("cache-key") != key:
+            return None
+        response = self.s3.get_object(Bucket=self.bucket, Key=self._key(query))
+        return response["Body"].read()
+
+    def write(self, query, key, data):
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self._key(query),
+            Body=data,
+            Metadata={
+                "cache-key": key,
+                "cached-at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            },
+        )
+
+
+class ResultCache:
+    """
+    Reads and writes query results in a LocalResultStore or S3ResultStore.
+
+    Parameters
+    ----------
+    store : LocalResultStore or S3ResultStore
+    refresh (bool): always run the queries, the results are still written to the cache
+
+    """
+
+    def __init__(self, store, refresh=False):
+        self.store = store
+        self.refresh = refresh
+
+    def get(self, query, key):
+        """Returns the cached CSV of a query, or None"""
+        if self.refresh:
+            return None
+        data = self.store.read(query, key)
+        if data is None:
+            return None
+        logger.info(f"Serving {query} from the result cache")
+        return gzip.decompress(data).decode()
+
+    def put(self, query, key, csv):
+        self.store.write(query, key, gzip.compress(csv.encode()))
@@ -3,13 +3,14 @@ Get the currently active permits data and publish it to a
 socrata dataset that is a rolling log of currently active permits.
 """
 
-import boto3
-from sodapy import Socrata
-import pandas as pd
 import pytz
 
+import argparse
 import os
 
+from profiling import Profiler, add_profile_arguments
+from rate_limit import limit_socrata
+from tracing import Tracer, trace_s3, trace_socrata
 from utils import df_to_socrata_dataset
 
 tz = "US/Central"
@@ -42,6 +43,8 @@ def s3_to_df(s3, filename):
     (dataframe) : dataframe of the csv file stored in S3
     (str) : string of the date/time the file was last modified
     """
+    import pandas as pd
+
     response = s3.get_object(Bucket=BUCKET, Key=filename)
     return (
         pd.read_csv(response.get("Body")),
@@ -53,6 +56,8 @@ def s3_to_df(s3, filename):
 
 def prepare_data(df, modified_date):
     # Rotate our dataframe to have the columns be the permit type
+    import pandas as pd
+
     df = pd.pivot_table(df, columns="FOLDERTYPE")
     # Create published date column
     df["published_date"] = modified_date
@@ -66,27 +71,47 @@ def socrata_columns(df):
     return df
 
 
-def main():
-    s3_client = boto3.client(
-        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
-    )
-    soda = Socrata(
-        SO_WEB,
-        SO_TOKEN,
-        username=SO_KEY,
-        password=SO_SECRET,
-        timeout=500,
-    )
-
-    # Get data from S3 bucket and the time it was published
-    df, time = s3_to_df(s3_client, "active_permits.csv")
-    # Get our data in the right shape
-    df = prepare_data(df, time)
-    # Format columns
-    df = socrata_columns(df)
-    # Upsert to socrata
-    df_to_socrata_dataset(soda, DATASET, df, method="upsert")
-
+def main(args):
+    import boto3
+    from sodapy import Socrata
+
+    script = "active_permits_logging"
+    with Profiler.from_args(script, args) as profiler, Tracer(script):
+        s3_client = trace_s3(
+            boto3.client(
+                "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
+            )
+        )
+        soda = trace_socrata(
+            limit_socrata(
+                Socrata(
+                    SO_WEB,
+                    SO_TOKEN,
+                    username=SO_KEY,
+                    password=SO_SECRET,
+                    timeout=500,
+                )
+            )
+        )
+
+        # Get data from S3 bucket and the time it was published
+        with profiler.stage("download"):
+            df, time = s3_to_df(s3_client, "active_permits.csv")
+        with profiler.stage("transform"):
+            # Get our data in the right shape
+            df = prepare_data(df, time)
+            # Format columns
+            df = socrata_columns(df)
+        # Upsert to socrata
+        with profiler.stage("publish"):
+            df_to_socrata_dataset(soda, DATASET, df, method="upsert")
+
+
+# CLI argument definition
+parser = argparse.ArgumentParser()
+
+add_profile_arguments(parser)
 
 if __name__ == "__main__":
-    main()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,161 @@
+"""
+Local DuckDB store the metrics scripts can run their joins and aggregations in.
+
+The extracts in S3 (CSV or Parquet) are ingested into a table each, once per run,
+and the metrics are queried with SQL, which DuckDB runs on every core and spills
+to disk when it doesn't fit in memory. Results come back as Arrow tables or record
+batches. The database file is kept in CACHE_DIR, so ad-hoc queries can be run on the
+same tables after a run:
+
+duckdb .cache/analytics.duckdb "SELECT count(*) FROM row_inspector_permit_list"
+
+duckdb is only imported when a store is opened, so the scripts can import this
+module whether or not they run with --engine duckdb.
+"""
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+from config import ANALYTICS_DB
+
+logger = logging.getLogger(__name__)
+
+# Rows in each record batch returned by AnalyticsStore.stream
+BATCH_SIZE = 100000
+
+
+def table_name(filename):
+    """Returns the table an S3 file is ingested into, ex: issued_permits.csv -> issued_permits"""
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return re.sub(r"\W+", "_", name).strip("_").lower()
+
+
+class AnalyticsStore:
+    """
+    DuckDB database the S3 extracts are ingested into.
+
+    Parameters
+    ----------
+    path (str): database file, use ":memory:" for a store that isn't kept after the run
+    threads (int): threads DuckDB runs queries with, all cores by default
+
+    """
+
+    def __init__(self, path=ANALYTICS_DB, threads=None):
+        import duckdb
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.conn = duckdb.connect(path)
+        if threads:
+            self.conn.execute(f"SET threads = {int(threads)}")
+        if path != ":memory:":
+            # Joins and aggregations larger than memory spill next to the database
+            temp_directory = os.path.join(os.path.dirname(path) or ".", "duckdb_tmp")
+            self.conn.execute(
+                "SET temp_directory = '{}'".format(temp_directory.replace("'", "''"))
+            )
+        # ETag of the S3 object each table was last ingested from
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS _sources (name VARCHAR PRIMARY KEY, etag VARCHAR)"
+        )
+
+    @staticmethod
+    def quote(identifier):
+        """Quotes a column or table name for SQL, the AMANDA column names contain SQL"""
+        return '"' + identifier.replace('"', '""') + '"'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        self.conn.close()
+
+    def tables(self):
+        return {row[0] for row in self.conn.execute("SHOW TABLES").fetchall()}
+
+    def columns(self, name):
+        rows = self.conn.execute(f"DESCRIBE {self.quote(name)}").fetchall()
+        return [row[0] for row in rows]
+
+    def ingest(self, s3, bucket, filename, frames=None, name=None):
+        """
+        Loads an S3 extract into a table named after the file, see table_name. Files
+        whose ETag hasn't changed since they were last ingested are not downloaded again.
+
+        Parameters
+        ----------
+        s3 : boto3 S3 client object
+        bucket (str)
+        filename (str): key of a .csv or .parquet file
+        frames (dict): dataframes of files already in memory by S3 file name, see pipeline.py
+        name (str): table to load the file into instead of the one named after the file
+
+        Returns
+        -------
+        name (str): the table the file was loaded into
+
+        """
+        name = name or table_name(filename)
+        if frames and filename in frames:
+            self.register(name, frames[filename])
+            return name
+
+        etag = s3.head_object(Bucket=bucket, Key=filename)["ETag"]
+        stored = self.conn.execute(
+            "SELECT etag FROM _sources WHERE name = ?", [name]
+        ).fetchone()
+        if stored and stored[0] == etag and name in self.tables():
+            logger.info(f"{filename} is unchanged, using table {name}")
+            return name
+
+        response = s3.get_object(Bucket=bucket, Key=filename)
+        suffix = os.path.splitext(filename)[1].lower()
+        # DuckDB reads the file from disk, so the body is streamed to it instead of
+        # being held in memory
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            shutil.copyfileobj(response["Body"], f)
+        try:
+            reader = "read_parquet" if suffix == ".parquet" else "read_csv_auto"
+            self.conn.execute(
+                f"CREATE OR REPLACE TABLE {self.quote(name)} AS SELECT * FROM {reader}(?)",
+                [f.name],
+            )
+        finally:
+            os.remove(f.name)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO _sources VALUES (?, ?)", [name, etag]
+        )
+        logger.info(f"Ingested {filename} into table {name}")
+        return name
+
+    def register(self, name, df):
+        """Loads a dataframe into a table, replacing it"""
+        self.conn.register("_frame", df)
+        try:
+            self.conn.execute(
+                f"CREATE OR REPLACE TABLE {self.quote(name)} AS SELECT * FROM _frame"
+            )
+        finally:
+            self.conn.unregister("_frame")
+        # Tables loaded from memory are never skipped by ingest
+        self.conn.execute("DELETE FROM _sources WHERE name = ?", [name])
+
+    def query_arrow(self, sql, params=None):
+        """Returns the result of a query as a pyarrow Table"""
+        return self.conn.execute(sql, params or []).arrow()
+
+    def query_df(self, sql, params=None):
+        """Returns the result of a query as a Pandas dataframe"""
+        return self.query_arrow(sql, params).to_pandas()
+
+    def stream(self, sql, params=None, batch_size=BATCH_SIZE):
+        """Returns a pyarrow RecordBatchReader over the result of a query, for results too large to hold at once"""
+        return self.conn.execute(sql, params or []).fetch_record_batch(batch_size)
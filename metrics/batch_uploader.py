@@ -0,0 +1,81 @@
+"""
+Hands finished batches to a bounded pool of upload threads so that uploads to
+Socrata overlap with preparing the next batch.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BatchUploader:
+    """
+    Runs upload(batch) for each submitted batch on up to `concurrency` threads.
+    submit() blocks once `max_pending` batches are waiting, which keeps memory
+    bounded when uploads are slower than the producer. The first failed upload
+    is raised from the next submit() or when the uploader is closed.
+
+    Parameters
+    ----------
+    upload (callable): called with each batch, its return value is passed to on_done
+    concurrency (int): number of upload threads
+    max_pending (int): batches allowed in flight before submit() blocks
+    on_done (callable): optional, called with (batch_number, result, context) after each upload
+
+    """
+
+    def __init__(self, upload, concurrency=1, max_pending=None, on_done=None):
+        self.upload = upload
+        self.on_done = on_done
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="batch-upload"
+        )
+        self.slots = threading.BoundedSemaphore(max_pending or concurrency * 2)
+        self.futures = []
+        self.error = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # Don't start the batches still waiting after a failure upstream
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            return False
+        self.close()
+        return False
+
+    def _run(self, batch_number, batch, context):
+        try:
+            result = self.upload(batch)
+            if self.on_done:
+                self.on_done(batch_number, result, context)
+            return result
+        except BaseException as e:
+            with self._lock:
+                if self.error is None:
+                    self.error = e
+            raise
+        finally:
+            self.slots.release()
+
+    def submit(self, batch, context=None):
+        """
+        Queues a batch for upload, blocking while too many batches are in flight.
+        context is handed back to on_done once the batch is uploaded.
+        """
+        self._raise_error()
+        self.slots.acquire()
+        self.futures.append(
+            self.executor.submit(self._run, len(self.futures), batch, context)
+        )
+
+    def close(self):
+        """Waits for every queued upload and raises the first upload error"""
+        self.executor.shutdown(wait=True)
+        self._raise_error()
+        return [f.result() for f in self.futures]
+
+    def _raise_error(self):
+        if self.error is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            raise self.error
@@ -0,0 +1,192 @@
+"""
+Benchmarks the inspector_prioritization scoring pipeline on synthetic data at
+multiples of today's permit volume, with S3 and Socrata stubbed out.
+
+python metrics/benchmark_inspector_prioritization.py --scales 1 10 100
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+
+import inspector_prioritization
+from profiling import Profiler
+from segment_index import LOOKUP_COLUMNS, NULL_ZONE, SEGMENT_LOOKUP_KEY, lookup_metadata
+from synthetic_data import generate
+from utils import get_logger
+
+logger = logging.getLogger(__name__)
+
+
+class StubS3:
+    """Serves CSV files from memory in place of a boto3 S3 client"""
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key):
+        return {
+            "Body": BytesIO(self.objects[Key]),
+            "LastModified": datetime.datetime.now(datetime.timezone.utc),
+        }
+
+    def head_object(self, Bucket, Key):
+        return {
+            "ETag": f'"{hashlib.md5(self.objects[Key]).hexdigest()}"',
+            "Metadata": lookup_metadata() if Key == SEGMENT_LOOKUP_KEY else {},
+        }
+
+
+class StubSocrata:
+    """
+    Stands in for the sodapy client. Serves the road segment records and
+    serializes published payloads to JSON the way sodapy would.
+    """
+
+    def __init__(self, segment_records):
+        self.segment_records = segment_records
+
+    def get(self, dataset_identifier, **kwargs):
+        return self.segment_records
+
+    def _publish(self, payload):
+        body = json.dumps(payload)
+        return {"Rows Created": len(payload), "Bytes": len(body)}
+
+    def replace(self, dataset_identifier, payload):
+        return self._publish(payload)
+
+    def upsert(self, dataset_identifier, payload):
+        return self._publish(payload)
+
+
+def segment_lookup_file(segment_records):
+    """Returns the road segment records as the .npy file roadway_segment_tagging.py publishes"""
+    columns = [
+        np.array([int(r.get(name, NULL_ZONE)) for r in segment_records], dtype=np.int64)
+        for name in LOOKUP_COLUMNS
+    ]
+    table = np.stack(columns)
+    table = table[:, np.argsort(table[0])]
+    buffer = BytesIO()
+    np.save(buffer, table, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def run_scale(scale, seed, output_dir, engine="pandas", segment_source="socrata"):
+    """Runs the scoring pipeline once at the given scale and returns its report"""
+    permits, segments, segment_records = generate(scale=scale, seed=seed)
+    objects = {
+        inspector_prioritization.PERMITS_FILE: permits.to_csv(index=False).encode(),
+        inspector_prioritization.SEGMENTS_FILE: segments.to_csv(index=False).encode(),
+    }
+    if segment_source == "lookup":
+        objects[SEGMENT_LOOKUP_KEY] = segment_lookup_file(segment_records)
+    s3 = StubS3(objects)
+    soda = StubSocrata(segment_records)
+
+    profiler = Profiler(
+        f"benchmark_inspector_prioritization-{scale:g}x", enabled=True, output_dir=output_dir
+    )
+    with profiler:
+        start = time.perf_counter()
+        scored = inspector_prioritization.prioritize_permits(
+            s3,
+            soda,
+            profiler,
+            engine=engine,
+            segment_source="auto" if segment_source == "lookup" else "socrata",
+        )
+        wall = time.perf_counter() - start
+
+    report = profiler.report()
+    return {
+        "scale": scale,
+        "permits": len(permits),
+        "permit_segments": len(segments),
+        "scored_permits": len(scored),
+        "wall_seconds": round(wall, 6),
+        "stages": report["totals"],
+    }
+
+
+def main(args):
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix="row-benchmark-")
+    results = []
+    for scale in args.scales:
+        logger.info(f"Benchmarking inspector prioritization at {scale:g}x volume")
+        result = run_scale(
+            scale, args.seed, output_dir, args.engine, args.segment_source
+        )
+        for name, stage in result["stages"].items():
+            logger.info(
+                f"{scale:g}x {name}: {stage['seconds']:.3f}s, "
+                f"peak {stage['peak_memory_bytes'] / 2**20:.1f} MiB"
+            )
+        logger.info(f"{scale:g}x total: {result['wall_seconds']:.3f}s")
+        results.append(result)
+
+    output = {
+        "benchmark": "inspector_prioritization",
+        "seed": args.seed,
+        "engine": args.engine,
+        "segment_source": args.segment_source,
+        "run_at": datetime.datetime.now().isoformat(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+
+# CLI argument definition
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "--scales",
+    nargs="+",
+    type=float,
+    default=[1, 10, 100],
+    help="Multiples of today's permit volume to benchmark. Ex: --scales 1 10 100",
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=0,
+    help="Random seed for the synthetic data",
+)
+parser.add_argument(
+    "--engine",
+    choices=["pandas", "duckdb"],
+    default="pandas",
+    help="Engine the permit and segment merges run in, see inspector_prioritization.py",
+)
+parser.add_argument(
+    "--segment-source",
+    choices=["socrata", "lookup"],
+    default="socrata",
+    help="Score with the stubbed segment dataset or with a segment lookup served from the stubbed S3",
+)
+parser.add_argument(
+    "--output",
+    required=False,
+    help="Path of a JSON file to write the results to, printed to stdout otherwise",
+)
+parser.add_argument(
+    "--output-dir",
+    required=False,
+    help="Directory for the per-run profile reports, a temporary directory otherwise",
+)
+
+if __name__ == "__main__":
+    get_logger(__name__, level=logging.INFO)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,119 @@
+"""
+Checkpoints for long-running roadway segment tagging runs. The state is stored in
+a local file or in S3 after every completed page of segments, so a failed run can
+pick up where it stopped with --resume.
+
+The state stores are also used for other state kept between runs, like the week
+fingerprints of row_data_summary.py --incremental.
+"""
+import datetime
+import json
+import os
+
+from storage import atomic_write
+
+
+class LocalStateStore:
+    """Keeps the checkpoint in a local file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def write(self, data):
+        with atomic_write(self.path) as f:
+            f.write(data)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class S3StateStore:
+    """Keeps the checkpoint in an S3 object"""
+
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+
+    def read(self):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.key)
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return response["Body"].read()
+
+    def write(self, data):
+        self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=data)
+
+    def delete(self):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.key)
+
+
+class Checkpoint:
+    """
+    Progress of a tagging run.
+
+    Parameters
+    ----------
+    store : LocalStateStore or S3StateStore
+    replace (bool): whether the run replaces every segment in the dataset
+    formatted_time (str): segments modified since this time are part of the run
+    last_objectid (int): every segment up to this OBJECTID has been uploaded
+    segments_checked (int): number of segments checked or uploaded so far
+    batches_completed (int): number of batches uploaded so far
+    started_at (str): ISO timestamp of when the run started
+
+    """
+
+    def __init__(
+        self,
+        store,
+        replace,
+        formatted_time,
+        last_objectid=-1,
+        segments_checked=0,
+        batches_completed=0,
+        started_at=None,
+    ):
+        self.store = store
+        self.replace = replace
+        self.formatted_time = formatted_time
+        self.last_objectid = last_objectid
+        self.segments_checked = segments_checked
+        self.batches_completed = batches_completed
+        self.started_at = started_at or datetime.datetime.now().isoformat()
+
+    @classmethod
+    def load(cls, store):
+        """Returns the stored checkpoint, or None when there is no run to resume"""
+        data = store.read()
+        if data is None:
+            return None
+        state = json.loads(data)
+        # Older checkpoints listed the segments seen, the segment index has them
+        segment_ids = state.pop("segment_ids", None)
+        if segment_ids is not None:
+            state["segments_checked"] = len(segment_ids)
+        return cls(store, **state)
+
+    def save(self):
+        state = {
+            "replace": self.replace,
+            "formatted_time": self.formatted_time,
+            "last_objectid": self.last_objectid,
+            "segments_checked": self.segments_checked,
+            "batches_completed": self.batches_completed,
+            "started_at": self.started_at,
+        }
+        self.store.write(json.dumps(state).encode())
+
+    def clear(self):
+        """Removes the checkpoint once the run has finished"""
+        self.store.delete()
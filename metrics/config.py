@@ -1,3 +1,8 @@
+import os
+
+# CACHE_DIR is shared with the other directories, see shared/storage.py
+from storage import CACHE_DIR
+
 feature_service_base_url = (
     "https://services.arcgis.com/0L95CJ0VTaxqcmED/ArcGIS/rest/services/"
 )
@@ -10,3 +15,32 @@ DAPCZ_FEATURE_SERVICE_URL = (
 ROW_INSPECTOR_SERVICE_URL = (
     feature_service_base_url + "TRANSPORTATION_row_inspector_zones/FeatureServer/0"
 )
+
+# Segments and zones are all requested in NAD83 Texas Central (ftUS) so they can be
+# intersected locally
+SPATIAL_REFERENCE = 2277
+
+# Default number of concurrent requests made to each remote service
+AGOL_CONCURRENCY = 3
+SOCRATA_CONCURRENCY = 2
+
+# Client-side limits for each remote service, see rate_limit.py. Requests per second
+# (rate) and concurrency start at these values, are raised up to the max_ values while
+# the service responds normally and are halved when it throttles.
+RATE_LIMITS = {
+    "agol": {
+        "rate": 10.0,
+        "max_rate": 40.0,
+        "concurrency": AGOL_CONCURRENCY,
+        "max_concurrency": 8,
+    },
+    "socrata": {
+        "rate": 5.0,
+        "max_rate": 20.0,
+        "concurrency": SOCRATA_CONCURRENCY,
+        "max_concurrency": 8,
+    },
+}
+
+# DuckDB database the extracts are ingested into with --engine duckdb, see analytics_store.py
+ANALYTICS_DB = os.path.join(CACHE_DIR, "analytics.duckdb")
@@ -1,13 +1,17 @@
-import boto3
-import pandas as pd
-import numpy as np
-from sodapy import Socrata
-
+import argparse
+from contextlib import nullcontext
 import datetime
 import os
 import logging
 
-from utils import get_logger, s3_csv_to_df, df_to_socrata_dataset
+from analytics_store import AnalyticsStore
+from profiling import Profiler, add_profile_arguments
+from rate_limit import limit_socrata
+from schemas import SCHEMAS, apply_schema
+from segment_index import fetch_segment_lookup
+from socrata_publish import RevisionPublisher
+from tracing import Tracer, trace_s3, trace_socrata
+from utils import get_logger, load_csv, df_to_socrata_dataset
 
 # AWS Credentials
 AWS_ACCESS_ID = os.getenv("EXEC_DASH_ACCESS_ID")
@@ -25,6 +29,8 @@ SEGMENT_DATASET = os.getenv("SEGMENT_DATASET")
 PERMITS_FILE = "row_inspector_permit_list.csv"
 SEGMENTS_FILE = "row_inspector_segment_list.csv"
 
+logger = logging.getLogger(__name__)
+
 
 def number_of_segments_scoring(permits, segments):
     """
@@ -35,6 +41,7 @@ def number_of_segments_scoring(permits, segments):
     permits - with a count_segment_scoring column with the scores based on the number of segments
 
     """
+    import numpy as np
 
     counts = segments.groupby("FOLDERRSN")["PROPERTYRSN"].count()
     counts = counts.rename("count_segments")
@@ -46,6 +53,33 @@ def number_of_segments_scoring(permits, segments):
     return permits
 
 
+def number_of_segments_scoring_sql(store, permits, segments):
+    """
+    number_of_segments_scoring run in DuckDB on the permits and segments tables of
+    the analytics store.
+
+    Returns
+    -------
+    permits - dataframe of the permits table with the count_segments and count_segment_scoring columns
+
+    """
+    sql = f"""
+        SELECT
+            p.*,
+            CAST(coalesce(c.count_segments, 0) AS DOUBLE) AS count_segments,
+            CASE WHEN coalesce(c.count_segments, 0) > 1 THEN 10 ELSE 5 END
+                AS count_segment_scoring
+        FROM {store.quote(permits)} p
+        LEFT JOIN (
+            SELECT FOLDERRSN, count(PROPERTYRSN) AS count_segments
+            FROM {store.quote(segments)}
+            GROUP BY FOLDERRSN
+        ) c ON p.FOLDERRSN = c.FOLDERRSN
+        ORDER BY p.rowid
+    """
+    return store.query_df(sql)
+
+
 def duration_scoring(row):
     """
 
@@ -58,6 +92,8 @@ def duration_scoring(row):
     scoring based on the number of days the permit is active
 
     """
+    import pandas as pd
+
     # each permit type uses a different column from the query for the duration (in days).
     if row["FOLDERTYPE"] == "RW":
         duration_column = "TOTAL_DAYS"
@@ -88,16 +124,89 @@ def duration_scoring(row):
     return 1, row[duration_column], start
 
 
+def segment_scoring(permits, segments):
+    """
+    Merges the highest road class and DAPCZ scores of each permit's segments, and
+    their ROW inspector zone, to the permits.
+
+    Returns
+    -------
+    permits - with road_class_scoring, dapcz_scoring and row_inspector_zone columns
+
+    """
+    road_class = segments.groupby("FOLDERRSN")["segment_road_class_scoring"].max()
+    road_class = road_class.rename("road_class_scoring")
+    permits = permits.merge(
+        road_class, left_on="FOLDERRSN", right_index=True, how="left"
+    )
+    permits["road_class_scoring"] = permits["road_class_scoring"].fillna(0)
+
+    dapcz = segments.groupby("FOLDERRSN")["dapcz_segment_scoring"].max()
+    dapcz = dapcz.rename("dapcz_scoring")
+    permits = permits.merge(dapcz, left_on="FOLDERRSN", right_index=True, how="left")
+    permits["dapcz_scoring"] = permits["dapcz_scoring"].fillna(0)
+
+    # Merging ROW inspector zone to permits
+    row_inspector_zones = segments.groupby("FOLDERRSN")["row_inspector_zone"].max()
+    row_inspector_zones = row_inspector_zones.rename("row_inspector_zone")
+    permits = permits.merge(
+        row_inspector_zones, left_on="FOLDERRSN", right_index=True, how="left"
+    )
+    return permits
+
+
+def segment_scoring_sql(store, permits, segments):
+    """
+    segment_scoring run in DuckDB. Only the permit numbers and the segment scores
+    are loaded into the store, the scores come back in the order of the permits.
+    """
+    columns = [
+        "FOLDERRSN",
+        "segment_road_class_scoring",
+        "dapcz_segment_scoring",
+        "row_inspector_zone",
+    ]
+    store.register("permit_keys", permits[["FOLDERRSN"]])
+    store.register("segment_scores", segments[columns])
+    scores = store.query_df(
+        """
+        SELECT
+            coalesce(s.road_class_scoring, 0) AS road_class_scoring,
+            coalesce(s.dapcz_scoring, 0) AS dapcz_scoring,
+            s.row_inspector_zone
+        FROM permit_keys p
+        LEFT JOIN (
+            SELECT
+                FOLDERRSN,
+                max(segment_road_class_scoring) AS road_class_scoring,
+                max(dapcz_segment_scoring) AS dapcz_scoring,
+                max(row_inspector_zone) AS row_inspector_zone
+            FROM segment_scores
+            GROUP BY FOLDERRSN
+        ) s ON p.FOLDERRSN = s.FOLDERRSN
+        ORDER BY p.rowid
+        """
+    )
+    permits = permits.copy()
+    for column in scores.columns:
+        permits[column] = scores[column].to_numpy()
+    return permits
+
+
 def batch_list(data, batch_size=100):
     for i in range(0, len(data), batch_size):
         yield data[i: i + batch_size]
 
 
 def retrieve_road_segment_data(segments, soda):
+    import pandas as pd
+
     data = soda.get(SEGMENT_DATASET, limit=999999)
     segment_data = pd.DataFrame(data)
     segment_data["segment_id"] = segment_data["segment_id"].astype(int)
     segment_data["inspector_zone"] = segment_data["inspector_zone"].astype(float)
+    # Socrata returns numbers as strings
+    segment_data["road_class"] = pd.to_numeric(segment_data["road_class"], errors="coerce")
 
     segments = segments.merge(
         segment_data, left_on="PROPERTYRSN", right_on="segment_id", how="inner"
@@ -110,6 +219,26 @@ def retrieve_road_segment_data(segments, soda):
     return segments
 
 
+def lookup_road_segment_data(segments, lookup):
+    """
+    Same as retrieve_road_segment_data, with the road class and zones of the
+    segments looked up in the SegmentLookup published by roadway_segment_tagging.py
+    instead of the segment dataset in Socrata.
+    """
+    import numpy as np
+
+    segment_ids = segments["PROPERTYRSN"].to_numpy(dtype=np.int64, na_value=-1)
+    found, columns = lookup.find(segment_ids)
+    segments = segments[found].copy()
+    segments["segment_id"] = segment_ids[found]
+    segments["road_class"] = columns["road_class"][found]
+    segments["row_inspector_zone"] = columns["inspector_zone"][found]
+    segments["dapcz_zone"] = columns["dapcz_zone"][found]
+    # Flagging segments if they are in the DAPCZ for later scoring
+    segments["is_dapcz"] = segments["dapcz_zone"].notnull()
+    return segments
+
+
 def road_class_scoring(row):
     """
     Our score criteria: Critical = 10, Arterial = 7, Collector = 5, Residential = 3
@@ -171,6 +300,8 @@ def recent_inspection_scoring(row):
     lose 5 points if there was a traffic inspection attempt in the last 7 calendar days
 
     """
+    import pandas as pd
+
     if row["MOST_RECENT_INSPECTION"]:
         inspection_dt = pd.to_datetime(row["MOST_RECENT_INSPECTION"])
         delta = datetime.datetime.today() - inspection_dt
@@ -195,107 +326,195 @@ def cleanup_permit_types(row):
     return row["PERMIT_TYPE"]
 
 
-def main():
-    s3_client = boto3.client(
-        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
-    )
-    permits = s3_csv_to_df(s3_client, BUCKET, PERMITS_FILE)
-    logger.info(f"{len(permits)} Permits retrieved from S3")
-    segments = s3_csv_to_df(s3_client, BUCKET, SEGMENTS_FILE)
-    logger.info(f"{len(segments)} Segments retrieved from S3")
-
-    # Socrata credentials
-    soda = Socrata(
-        SO_WEB,
-        SO_TOKEN,
-        username=SO_KEY,
-        password=SO_SECRET,
-        timeout=500,
-    )
-
-    # number of segments scoring:
-    permits = number_of_segments_scoring(permits, segments)
-
-    # permit duration scoring:
-    permits[["duration_scoring", "duration", "START_DATE"]] = permits.apply(duration_scoring, axis=1,
-                                                                            result_type='expand')
-
-    # downloading road segment data
-    logger.info("Retrieving road segment data...")
-    segments = retrieve_road_segment_data(segments, soda)
-
-    # road segment class scoring
-    logger.info("Scoring permits based on road segments data")
-    segments["segment_road_class_scoring"] = segments.apply(road_class_scoring, axis=1)
-
-    # get maximum scoring for each permit's segments
-    road_class = segments.groupby("FOLDERRSN")["segment_road_class_scoring"].max()
-    road_class = road_class.rename("road_class_scoring")
-    permits = permits.merge(
-        road_class, left_on="FOLDERRSN", right_index=True, how="left"
-    )
-    permits["road_class_scoring"] = permits["road_class_scoring"].fillna(0)
-
-    # Downtown Project Coordination Zone (DAPCZ) segment scoring, 10 points if any segment is in the DAPCZ, 0 otherwise
-    segments["dapcz_segment_scoring"] = np.where(segments["is_dapcz"], 10, 0)
-    dapcz = segments.groupby("FOLDERRSN")["dapcz_segment_scoring"].max()
-    dapcz = dapcz.rename("dapcz_scoring")
-    permits = permits.merge(dapcz, left_on="FOLDERRSN", right_index=True, how="left")
-    permits["dapcz_scoring"] = permits["dapcz_scoring"].fillna(0)
+def main(args):
+    import boto3
+    from sodapy import Socrata
+
+    script = "inspector_prioritization"
+    with Profiler.from_args(script, args) as profiler, Tracer(script):
+        s3_client = trace_s3(
+            boto3.client(
+                "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
+            )
+        )
+        # Socrata credentials
+        soda = trace_socrata(
+            limit_socrata(
+                Socrata(
+                    SO_WEB,
+                    SO_TOKEN,
+                    username=SO_KEY,
+                    password=SO_SECRET,
+                    timeout=500,
+                )
+            )
+        )
+        prioritize_permits(
+            s3_client,
+            soda,
+            profiler,
+            engine=args.engine,
+            backend=args.backend,
+            segment_source=args.segment_source,
+        )
+
+
+def open_store(engine):
+    # Returns the analytics store for --engine duckdb, duckdb is only imported then
+    if engine != "duckdb":
+        return nullcontext()
+    return AnalyticsStore()
+
+
+def prioritize_permits(
+    s3_client,
+    soda,
+    profiler,
+    frames=None,
+    engine="pandas",
+    backend="soda",
+    segment_source="auto",
+):
+    """
+    Scores the active permits in S3 and replaces the priority dataset in Socrata.
 
-    # Merging ROW inspector zone to permits
-    row_inspector_zones = segments.groupby("FOLDERRSN")["row_inspector_zone"].max()
-    row_inspector_zones = row_inspector_zones.rename("row_inspector_zone")
-    permits = permits.merge(
-        row_inspector_zones, left_on="FOLDERRSN", right_index=True, how="left"
-    )
+    Parameters
+    ----------
+    s3_client : boto3 S3 client object
+    soda : sodapy client object
+    profiler : profiling.Profiler wrapping the stages of the run
+    frames (dict): dataframes of files already in memory by S3 file name, see pipeline.py
+    engine (str): "pandas", or "duckdb" to run the merges in the analytics store
+    backend (str): "soda" to send the rows as JSON, or "revision" to upload them as a CSV revision
+    segment_source (str): "auto" to look up the road segments in the segment lookup in S3 when
+        there is a current one (see SEGMENT_LOOKUP_MAX_AGE), "socrata" to always download the segment dataset
 
-    # Active deficiencies scoring
-    permits["active_deficiencies_scoring"] = permits.apply(active_deficiencies_scoring, axis=1)
-
-    # Recent inspection scoring
-    permits["recent_inspection_scoring"] = permits.apply(recent_inspection_scoring, axis=1)
-
-    # Cleanup permit types
-    permits["PERMIT_TYPE"] = permits.apply(cleanup_permit_types, axis=1)
-
-    # Total Scoring
-    cols = permits.columns
-    scoring_cols = []
-    for col in cols:
-        if col.endswith("_scoring"):
-            scoring_cols.append(col)
-    permits["total_score"] = permits[scoring_cols].sum(axis=1)
-
-    # cleaning up timestamps
-    date_fields = [
-        "EXPIRY_DATE",
-        "START_DATE",
-        "END_DATE",
-        "ISSUE_DATE",
-        "MOST_RECENT_INSPECTION",
-        "EXTENSION_START_DATE",
-        "EXTENSION_END_DATE",
-        "EVENT_START_DATE",
-    ]
-    for field in date_fields:
-        permits[field] = pd.to_datetime(permits[field], format="mixed")
-        permits[field] = permits[field].dt.strftime("%Y-%m-%dT%H:%M:00.000")
+    Returns
+    -------
+    permits - the scored permits that were sent to Socrata
 
-    # replacing NaN's with None (Socrata doesn't like)
-    permits = permits.replace(np.nan, None)
+    """
+    import numpy as np
+
+    with open_store(engine) as store:
+        with profiler.stage("download"):
+            if store is not None:
+                permits_table = store.ingest(s3_client, BUCKET, PERMITS_FILE, frames)
+                segments_table = store.ingest(s3_client, BUCKET, SEGMENTS_FILE, frames)
+            else:
+                permits = load_csv(
+                    s3_client, BUCKET, PERMITS_FILE, frames, SCHEMAS["row_inspector_permit_list"]
+                )
+                logger.info(f"{len(permits)} Permits retrieved from S3")
+                segments = load_csv(
+                    s3_client, BUCKET, SEGMENTS_FILE, frames, SCHEMAS["row_inspector_segment_list"]
+                )
+                logger.info(f"{len(segments)} Segments retrieved from S3")
+
+        with profiler.stage("score"):
+            # number of segments scoring:
+            if store is not None:
+                permits = number_of_segments_scoring_sql(store, permits_table, segments_table)
+                permits = apply_schema(permits, SCHEMAS["row_inspector_permit_list"])
+                segments = store.query_df(f"SELECT * FROM {store.quote(segments_table)}")
+                segments = apply_schema(segments, SCHEMAS["row_inspector_segment_list"])
+            else:
+                permits = number_of_segments_scoring(permits, segments)
+
+            # permit duration scoring:
+            permits[["duration_scoring", "duration", "START_DATE"]] = permits.apply(duration_scoring, axis=1,
+                                                                                    result_type='expand')
+
+        # downloading road segment data
+        with profiler.stage("download", dataset="road_segments"):
+            lookup = None
+            if segment_source == "auto":
+                lookup = fetch_segment_lookup(s3_client, BUCKET)
+            if lookup is not None:
+                logger.info(f"Looking up road segment data in {len(lookup)} segments...")
+                segments = lookup_road_segment_data(segments, lookup)
+            else:
+                logger.info("Retrieving road segment data...")
+                segments = retrieve_road_segment_data(segments, soda)
+
+        with profiler.stage("score"):
+            # road segment class scoring
+            logger.info("Scoring permits based on road segments data")
+            segments["segment_road_class_scoring"] = segments.apply(road_class_scoring, axis=1)
+
+            # Downtown Project Coordination Zone (DAPCZ) segment scoring, 10 points if any segment is in the DAPCZ, 0 otherwise
+            segments["dapcz_segment_scoring"] = np.where(segments["is_dapcz"], 10, 0)
+
+            # get maximum scoring and the ROW inspector zone of each permit's segments
+            if store is not None:
+                permits = segment_scoring_sql(store, permits, segments)
+            else:
+                permits = segment_scoring(permits, segments)
+
+            # Active deficiencies scoring
+            permits["active_deficiencies_scoring"] = permits.apply(active_deficiencies_scoring, axis=1)
+
+            # Recent inspection scoring
+            permits["recent_inspection_scoring"] = permits.apply(recent_inspection_scoring, axis=1)
+
+            # Cleanup permit types
+            permits["PERMIT_TYPE"] = permits.apply(cleanup_permit_types, axis=1)
+
+            # Total Scoring
+            cols = permits.columns
+            scoring_cols = []
+            for col in cols:
+                if col.endswith("_scoring"):
+                    scoring_cols.append(col)
+            permits["total_score"] = permits[scoring_cols].sum(axis=1)
 
     logger.info(
         f"Replacing data in Socrata dataset: datahub.austintexas.gov/d/{DATASET}"
     )
-    response = df_to_socrata_dataset(soda, DATASET, permits, method="replace")
+    schema = SCHEMAS["inspector_prioritization"]
+    with profiler.stage("publish"):
+        if backend == "revision":
+            publisher = RevisionPublisher(SO_WEB, SO_TOKEN, SO_KEY, SO_SECRET)
+            response = publisher.publish_df(
+                permits, DATASET, "inspector_prioritization.csv", schema=schema
+            )
+        else:
+            # Timestamps are formatted and NaN's replaced with None (Socrata doesn't like) by the serializer
+            response = df_to_socrata_dataset(
+                soda, DATASET, permits, method="replace", schema=schema
+            )
     logger.info(response)
+    return permits
+
 
+# CLI argument definition
+parser = argparse.ArgumentParser()
 
-logger = get_logger(
-    __name__,
-    level=logging.INFO,
+parser.add_argument(
+    "--engine",
+    choices=["pandas", "duckdb"],
+    default="pandas",
+    help="Run the permit and segment merges in pandas or in the local DuckDB store, see analytics_store.py",
 )
 
+parser.add_argument(
+    "--backend",
+    choices=["soda", "revision"],
+    default="soda",
+    help="Send the rows as JSON through SODA, or upload them as a CSV revision",
+)
+
+parser.add_argument(
+    "--segment-source",
+    choices=["auto", "socrata"],
+    default="auto",
+    help="Look up road segments in the segment lookup published by roadway_segment_tagging.py "
+    "when there is one (auto), or download the segment dataset (socrata)",
+)
+
+add_profile_arguments(parser)
+
 if __name__ == "__main__":
-    main()
+    get_logger(__name__, level=logging.INFO)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,244 @@
+"""
+Client-side rate limiting for the remote services the scripts call.
+
+Each service gets one RateLimiter shared by every thread: a token bucket caps the
+requests per second and an AIMD (additive increase, multiplicative decrease) limit
+caps the requests in flight. Throttled responses (429 and 5xx) halve both and are
+retried after the service's Retry-After, healthy responses slowly raise them back
+up to their maximum, so throughput settles at what the service accepts.
+
+Calls that aren't idempotent (creating a revision, ...) are only retried when they
+were rejected with a 429: after a 5xx or a timeout the service may have acted on the
+request, and repeating it could do it twice.
+"""
+import datetime
+import email.utils
+import logging
+import random
+import re
+import threading
+import time
+
+from config import RATE_LIMITS
+from tracing import record
+
+# Status codes of responses that are retried after backing off
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Status codes of responses to requests the service didn't act on, which are retried
+# even when they aren't idempotent
+REJECTED_STATUS = {429}
+
+# Attempts made for each call before the error is raised
+MAX_ATTEMPTS = 6
+
+# Longest wait between attempts when the service doesn't send Retry-After, in seconds
+MAX_BACKOFF = 60
+
+logger = logging.getLogger(__name__)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def parse_retry_after(value):
+    """Returns the seconds to wait from a Retry-After header (seconds or HTTP date), or None"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max((date - now).total_seconds(), 0)
+
+
+def status_code(error):
+    """
+    Returns the HTTP status of a failed call, or None when it failed without a
+    response. sodapy raises requests' HTTPError with the response attached, arcgis
+    only puts the status code in the message.
+    """
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is None:
+        match = re.search(r"Error Code: (\d{3})", str(error))
+        status = int(match.group(1)) if match else None
+    return status
+
+
+def throttled(error):
+    """
+    Tells whether a failed call should be retried after backing off. Connection
+    errors and timeouts are retried too.
+
+    Returns
+    -------
+    retry (bool): the call failed because the service is overloaded or unreachable
+    wait (float): seconds asked for by the service's Retry-After header, or None
+
+    """
+    response = getattr(error, "response", None)
+    status = status_code(error)
+    if status is None:
+        names = {cls.__name__ for cls in type(error).__mro__}
+        return bool(names & {"ConnectionError", "Timeout", "TimeoutError"}), None
+    if status not in RETRY_STATUS:
+        return False, None
+    headers = getattr(response, "headers", None) or {}
+    return True, parse_retry_after(headers.get("Retry-After"))
+
+
+class RateLimiter:
+    """
+    Token bucket and AIMD concurrency limit of one service.
+
+    Parameters
+    ----------
+    name (str): name of the service, used in log messages
+    rate (float): requests per second to start at
+    max_rate (float): requests per second the rate is raised up to
+    concurrency (int): requests in flight to start at
+    max_concurrency (int): requests in flight the limit is raised up to
+
+    """
+
+    def __init__(self, name, rate, max_rate, concurrency, max_concurrency):
+        self.name = name
+        self.rate = float(rate)
+        self.max_rate = float(max_rate)
+        self.min_rate = min(self.rate, 1.0)
+        self.limit = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+        # The bucket holds up to one second of requests
+        self.tokens = min(self.rate, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Blocks until a request may start"""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    timeout = self.blocked_until - now
+                elif self.in_flight >= max(int(self.limit), 1):
+                    timeout = None
+                elif self.tokens < 1:
+                    timeout = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                self._condition.wait(timeout)
+
+    def release(self, ok, throttle=False, wait=None):
+        """
+        Ends a request started with acquire().
+
+        Parameters
+        ----------
+        ok (bool): the request succeeded, raises the limits
+        throttle (bool): the service throttled the request, halves the limits
+        wait (float): seconds every request waits before starting, from Retry-After
+
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttle:
+                self.limit = max(self.limit / 2, 1.0)
+                self.rate = max(self.rate / 2, self.min_rate)
+                if wait:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + wait)
+            elif ok:
+                # Roughly one more request in flight for every `limit` that succeed
+                self.limit = min(self.limit + 1 / self.limit, self.max_concurrency)
+                self.rate = min(self.rate + self.max_rate / 100, self.max_rate)
+            self._condition.notify_all()
+
+    def call(self, func, *args, idempotent=True, **kwargs):
+        """
+        Calls func within the limits, retrying it when the service throttles. A call
+        that isn't idempotent is only retried when the service rejected it (see
+        REJECTED_STATUS), the limits are still lowered on any throttled response.
+        """
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                retry, wait = throttled(e)
+                self.release(ok=False, throttle=retry, wait=wait)
+                if not idempotent and status_code(e) not in REJECTED_STATUS:
+                    raise
+                if not retry or attempt == MAX_ATTEMPTS:
+                    raise
+                if wait is None:
+                    # Exponential backoff with jitter when the service doesn't say how long
+                    time.sleep(random.uniform(0, min(2**attempt, MAX_BACKOFF)))
+                logger.warning(
+                    f"{self.name} throttled ({e!r}), retrying with {int(self.limit)} "
+                    f"concurrent requests at {self.rate:.1f}/s"
+                )
+                record(retries=1)
+                continue
+            self.release(ok=True)
+            return result
+
+
+def get_limiter(service, **settings):
+    """
+    Returns the process wide limiter of a service, created from RATE_LIMITS the
+    first time it is requested. settings override RATE_LIMITS, ex: max_concurrency.
+    """
+    with _limiters_lock:
+        if service not in _limiters:
+            _limiters[service] = RateLimiter(
+                service, **{**RATE_LIMITS[service], **settings}
+            )
+        return _limiters[service]
+
+
+class RateLimitedClient:
+    """
+    Proxy around a client that runs the calls to `methods` through a limiter,
+    every other attribute is passed through to the client.
+    """
+
+    def __init__(self, client, limiter, methods):
+        self._client = client
+        self._limiter = limiter
+        self._methods = methods
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in self._methods:
+            return attr
+
+        def limited(*args, **kwargs):
+            return self._limiter.call(attr, *args, **kwargs)
+
+        return limited
+
+
+def limit_socrata(soda):
+    """Rate limits the reads and writes of a sodapy client"""
+    return RateLimitedClient(
+        soda, get_limiter("socrata"), {"get", "upsert", "replace", "delete"}
+    )
+
+
+def limit_feature_layer(layer):
+    """Rate limits the queries of an arcgis FeatureLayer"""
+    return RateLimitedClient(layer, get_limiter("agol"), {"query"})
@@ -1,20 +1,60 @@
-from arcgis.gis import GIS
-from arcgis.features import FeatureLayer
-from arcgis.geometry.filters import intersects
-from sodapy import Socrata
+import numpy as np
+import shapely
 
 import argparse
+import collections
 import datetime
+import itertools
 import os
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+from batch_uploader import BatchUploader
+from checkpoint import Checkpoint, LocalStateStore, S3StateStore
 from config import (
+    RATE_LIMITS,
     SEGMENTS_FEATURE_SERVICE_URL,
     DAPCZ_FEATURE_SERVICE_URL,
     ROW_INSPECTOR_SERVICE_URL,
+    SPATIAL_REFERENCE,
+)
+from profiling import Profiler, add_profile_arguments
+from rate_limit import get_limiter, limit_feature_layer, limit_socrata
+from segment_index import (
+    DTYPE,
+    SEGMENT_INDEX_NAME,
+    SEGMENT_LOOKUP_KEY,
+    SEGMENT_LOOKUP_PATH,
+    SegmentIndex,
+    geometry_hash,
+    lookup_metadata,
+    row_hash,
+    zone_from_int,
+    zone_to_int,
+)
+from storage import CACHE_DIR
+from tracing import (
+    Tracer,
+    trace_feature_layer,
+    trace_requests,
+    trace_s3,
+    trace_socrata,
 )
 from utils import get_logger
+from zone_index import (
+    ZoneIndex,
+    changed_area,
+    esri_to_shapely,
+    load_zone_layer,
+    zone_state_name,
+)
+
 
+# AWS Credentials
+AWS_ACCESS_ID = os.getenv("EXEC_DASH_ACCESS_ID")
+AWS_PASS = os.getenv("EXEC_DASH_PASS")
+BUCKET = os.getenv("BUCKET_NAME")
 
 # AGOL Credentials
 AGOL_USERNAME = os.getenv("AGOL_USERNAME")
@@ -27,103 +67,559 @@ SO_KEY = os.getenv("SO_KEY")
 SO_SECRET = os.getenv("SO_SECRET")
 DATASET = os.getenv("SEGMENT_DATASET")
 
+# Number of segments in each Socrata upsert
+BATCH_SIZE = 100
+# Number of segments in each page requested from AGOL
+PAGE_SIZE = 2000
+# Number of rows in each page requested from Socrata
+SOCRATA_PAGE_SIZE = 50000
+
+CHECKPOINT_NAME = "segment_tagging_checkpoint.json"
+
+# Names of the zone layers, and of the tags they produce
+ZONE_LAYERS = ["INSPECTOR_ZONE", "DAPCZ_ZONE"]
+
+logger = logging.getLogger(__name__)
 
-def batch_list(data, batch_size=100):
+
+def batch_list(data, batch_size=BATCH_SIZE):
     for i in range(0, len(data), batch_size):
         yield data[i : i + batch_size]
 
 
-def retrieve_row_inspector_segments_by_segment(geom, gis, inspector_zones):
+def get_socrata():
+    from sodapy import Socrata
+
+    return trace_socrata(
+        limit_socrata(
+            Socrata(
+                SO_WEB,
+                SO_TOKEN,
+                username=SO_KEY,
+                password=SO_SECRET,
+                timeout=500,
+            )
+        )
+    )
+
+
+def retrieve_zones(inspector_zones, dapcz_features, pool, stores):
+    """
+    Loads the ROW inspector zone and DAPCZ polygons on the AGOL worker pool.
+    Layers that haven't been edited since the last run come from their state store.
+
+    Returns
+    -------
+    zones - ZoneIndex of both layers used to tag segments
+    area - shapely geometry of where the zones changed since they were saved, or None
+
+    """
+    inspector_layer = pool.submit(
+        load_zone_layer,
+        "INSPECTOR_ZONE",
+        inspector_zones,
+        "ROW_INSPECTOR_ZONE_ID",
+        SPATIAL_REFERENCE,
+        stores["INSPECTOR_ZONE"],
+    )
+    dapcz_layer = pool.submit(
+        load_zone_layer,
+        "DAPCZ_ZONE",
+        dapcz_features,
+        "DAPCZ_ZONES_ID",
+        SPATIAL_REFERENCE,
+        stores["DAPCZ_ZONE"],
+    )
+    layers = []
+    changes = []
+    for future in (inspector_layer, dapcz_layer):
+        layer, previous = future.result()
+        layers.append(layer)
+        if previous is not None:
+            area = changed_area(previous, layer)
+            if area is not None:
+                changes.append(area)
+    area = shapely.union_all(changes) if changes else None
+    return ZoneIndex(layers), area
+
+
+def get_state_stores(kind):
+    """
+    Returns where the run checkpoint, the segment index and the zone layers the
+    index was tagged with are kept: files in CACHE_DIR or objects in S3. They are all
+    kept in the same place, so a resumed run always finds the index the failed run
+    saved with its checkpoint, and a run on a new machine compares the zones with the
+    ones the index was tagged with.
+
+    Returns
+    -------
+    dict of "checkpoint", "index" and each of ZONE_LAYERS to a LocalStateStore or S3StateStore
+
+    """
+    import boto3
+
+    names = {
+        "checkpoint": CHECKPOINT_NAME,
+        "index": SEGMENT_INDEX_NAME,
+        **{layer: zone_state_name(layer) for layer in ZONE_LAYERS},
+    }
+    if kind == "s3":
+        s3 = trace_s3(
+            boto3.client(
+                "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
+            )
+        )
+        return {state: S3StateStore(s3, BUCKET, name) for state, name in names.items()}
+    return {
+        state: LocalStateStore(os.path.join(CACHE_DIR, name))
+        for state, name in names.items()
+    }
+
+
+def delete_stale_segments(soda, segment_ids):
+    """
+    Deletes the rows of every segment in the dataset that was not part of a replace
+    run. Replace runs upsert over the existing rows and finish with this instead of
+    truncating the dataset first, so it is never left empty.
+
+    Returns
+    -------
+    number of rows deleted
+
+    """
+    keep = set(segment_ids)
+    stale = []
+    offset = 0
+    while True:
+        rows = soda.get(
+            DATASET,
+            select="segment_id",
+            order="segment_id",
+            limit=SOCRATA_PAGE_SIZE,
+            offset=offset,
+        )
+        if not rows:
+            break
+        for row in rows:
+            if "segment_id" in row and int(float(row["segment_id"])) not in keep:
+                stale.append(int(float(row["segment_id"])))
+        offset += len(rows)
+
+    for batch in batch_list(stale):
+        soda.upsert(DATASET, [{"segment_id": s, ":deleted": True} for s in batch])
+    return len(stale)
+
+
+def save_zones(zones, stores):
+    """Writes the zone layers to their state stores"""
+    for layer in zones.layers:
+        if layer.cache_key is not None:
+            layer.save(stores[layer.name])
+
+
+def iter_segment_pages(segments_layer, where, page_size=PAGE_SIZE, start_after=-1):
     """
-    Tags roadway segments with appropriate ROW inspector zone.
-    If a segment is in multiple, only the last ROW inspector zone is used.
+    Yields dataframes of the segments matching a where clause, one page at a time.
+    Pages are requested in OBJECTID order, each one starting after the last
+    OBJECTID of the previous page, so memory stays bounded by the page size.
     """
-    filter = intersects(geom)
-    response = inspector_zones.query(
-        geometry_filter=filter,
-        out_fields="ROW_INSPECTOR_ZONE_ID",
-        return_geometry=False,
-        gis=gis,
+    last_objectid = start_after
+    while True:
+        query_result = segments_layer.query(
+            where=f"({where}) AND OBJECTID > {last_objectid}",
+            out_fields="SEGMENT_ID, FULL_STREET_NAME, ROAD_CLASS, MODIFIED_DATE",
+            return_geometry=True,
+            out_sr=SPATIAL_REFERENCE,
+            order_by_fields="OBJECTID ASC",
+            result_record_count=page_size,
+        )
+        page = query_result.df
+        if page.empty:
+            return
+        yield page
+        last_objectid = int(page["OBJECTID"].max())
+
+
+def prefetch(pages, pool):
+    """Yields from an iterator of pages while the next page downloads on the pool"""
+    next_page = pool.submit(next, pages, None)
+    while True:
+        page = next_page.result()
+        if page is None:
+            return
+        next_page = pool.submit(next, pages, None)
+        yield page
+
+
+def retrieve_segments_in_area(segments_layer, area):
+    """
+    Returns a dataframe of the segments that intersect an area. AGOL is queried
+    with the area's envelope and the results are filtered with a local spatial
+    index over the segment geometries.
+    """
+    from arcgis.geometry.filters import intersects
+
+    xmin, ymin, xmax, ymax = area.bounds
+    envelope = {
+        "xmin": xmin,
+        "ymin": ymin,
+        "xmax": xmax,
+        "ymax": ymax,
+        "spatialReference": {"wkid": SPATIAL_REFERENCE},
+    }
+    query_result = segments_layer.query(
+        where="1=1",
+        geometry_filter=intersects(envelope, sr=SPATIAL_REFERENCE),
+        out_fields="SEGMENT_ID, FULL_STREET_NAME, ROAD_CLASS, MODIFIED_DATE",
+        return_geometry=True,
+        out_sr=SPATIAL_REFERENCE,
     )
-    if response.features:
-        # It is possible a segment could intersect multiple ROW inspector zones, but we only take the first one.
-        return response.features[0].attributes["ROW_INSPECTOR_ZONE_ID"]
-    return None
+    segments = query_result.df
+    if segments.empty:
+        return segments
+    tree = shapely.STRtree([esri_to_shapely(shape) for shape in segments["SHAPE"]])
+    hits = tree.query(area, predicate="intersects")
+    return segments.iloc[np.sort(hits)]
 
 
-def retrieve_dapcz_segments_by_segment(geom, gis, dapcz_features):
+def tag_batch(batch, zones, index):
     """
-    Tags roadway segments with appropriate ROW inspector zone.
-    If a segment is in multiple, only the last ROW inspector zone is used.
+    Tags a batch of roadway segments with the ROW inspector zone and DAPCZ zone they
+    intersect. Segments whose geometry hash matches the segment index keep their
+    stored tags and are not tagged again.
+
+    Parameters
+    ----------
+    batch : dataframe of segments from AGOL with a SHAPE column
+    zones : ZoneIndex of the inspector and DAPCZ zones
+    index : SegmentIndex of the segments already published
+
+    Returns
+    -------
+    records - list of dicts for Socrata, only the rows that changed since they were published
+    entries - SegmentIndex entries for every new or changed segment in the batch
+    upload - boolean array, which of the entries have a record to upsert
+
     """
-    filter = intersects(geom)
-    response = dapcz_features.query(
-        geometry_filter=filter,
-        out_fields="DAPCZ_ZONES_ID",
-        return_geometry=False,
-        gis=gis,
+    geometries = np.array(
+        [esri_to_shapely(shape) for shape in batch["SHAPE"]], dtype=object
     )
-    if response.features:
-        # It is possible a segment could intersect DAPCZ zones, but we only take the first one.
-        return response.features[0].attributes["DAPCZ_ZONES_ID"]
-    return None
+    hashes = np.array([geometry_hash(g) for g in geometries], dtype=np.uint64)
+    segment_ids = batch["SEGMENT_ID"].to_numpy(dtype=np.int64)
+    positions, found = index.find(segment_ids)
+    if len(index):
+        stored = index.data[positions]
+    else:
+        stored = np.zeros(len(batch), dtype=DTYPE)
+    same_geometry = found & (stored["geometry_hash"] == hashes)
+
+    # Reusing the stored tags, only new geometries are intersected with the zones
+    inspector_zone = np.array(
+        [zone_from_int(z) for z in stored["inspector_zone"]], dtype=object
+    )
+    dapcz_zone = np.array([zone_from_int(z) for z in stored["dapcz_zone"]], dtype=object)
+    if (~same_geometry).any():
+        tags = zones.tag(geometries[~same_geometry])
+        inspector_zone[~same_geometry] = tags["INSPECTOR_ZONE"]
+        dapcz_zone[~same_geometry] = tags["DAPCZ_ZONE"]
+
+    # Removing unwanted fields for Socrata export
+    batch = batch.drop(columns=["SHAPE", "MODIFIED_DATE", "OBJECTID"], errors="ignore")
+    batch["INSPECTOR_ZONE"] = inspector_zone
+    batch["DAPCZ_ZONE"] = dapcz_zone
+    records = batch.to_dict("records")
+    row_hashes = np.array([row_hash(r) for r in records], dtype=np.uint64)
+    changed = ~found | (stored["row_hash"] != row_hashes)
+
+    dirty = changed | ~same_geometry
+    entries = np.zeros(dirty.sum(), dtype=DTYPE)
+    entries["segment_id"] = segment_ids[dirty]
+    entries["geometry_hash"] = hashes[dirty]
+    entries["row_hash"] = row_hashes[dirty]
+    entries["inspector_zone"] = [zone_to_int(z) for z in inspector_zone[dirty]]
+    entries["dapcz_zone"] = [zone_to_int(z) for z in dapcz_zone[dirty]]
+    # Road classes are stored like the zones, NULL_ZONE when missing
+    road_class = batch["ROAD_CLASS"].to_numpy()
+    entries["road_class"] = [zone_to_int(c) for c in road_class[dirty]]
+    records = [r for r, c in zip(records, changed) if c]
+    return records, entries, changed[dirty]
 
 
 def main(args):
+    script = "roadway_segment_tagging"
+    with Profiler.from_args(script, args) as profiler, Tracer(script):
+        tag_segments(args, profiler)
+
+
+def tag_segments(args, profiler):
+    from arcgis.features import FeatureLayer
+    from arcgis.gis import GIS
+
     gis = GIS(
         "https://austin.maps.arcgis.com", username=AGOL_USERNAME, password=AGOL_PASSWORD
     )
-    segments_layer = FeatureLayer(SEGMENTS_FEATURE_SERVICE_URL, gis)
-    inspector_zones = FeatureLayer(ROW_INSPECTOR_SERVICE_URL, gis)
-    dapcz_features = FeatureLayer(DAPCZ_FEATURE_SERVICE_URL, gis)
-
-    soda = Socrata(
-        SO_WEB,
-        SO_TOKEN,
-        username=SO_KEY,
-        password=SO_SECRET,
-        timeout=500,
+    # AGOL queries don't report their size, the bytes are counted on the GIS session
+    trace_requests(getattr(getattr(gis, "_con", None), "_session", None))
+    # The limiters ramp concurrency up to the sizes of the worker pools
+    get_limiter("agol", max_concurrency=args.agol_concurrency)
+    get_limiter("socrata", max_concurrency=args.socrata_concurrency)
+    segments_layer, inspector_zones, dapcz_features = [
+        trace_feature_layer(limit_feature_layer(FeatureLayer(url, gis)))
+        for url in (
+            SEGMENTS_FEATURE_SERVICE_URL,
+            ROW_INSPECTOR_SERVICE_URL,
+            DAPCZ_FEATURE_SERVICE_URL,
+        )
+    ]
+
+    stores = get_state_stores(args.checkpoint_store)
+    store, index_store = stores["checkpoint"], stores["index"]
+    checkpoint = Checkpoint.load(store) if args.resume else None
+    if checkpoint is not None:
+        logger.info(
+            f"Resuming the run started at {checkpoint.started_at} "
+            f"after OBJECTID {checkpoint.last_objectid}."
+        )
+    else:
+        # We search for new segment updates in the last 30 days
+        search_date = datetime.datetime.now() - datetime.timedelta(days=30)
+        formatted_time = search_date.strftime("%Y-%m-%d %H:%M:%S")
+        if args.replace:
+            # If we need to replace all the data:
+            formatted_time = "1970-01-01 00:00:00"
+        checkpoint = Checkpoint(
+            store, replace=args.replace, formatted_time=formatted_time
+        )
+
+    agol_pool = ThreadPoolExecutor(
+        max_workers=args.agol_concurrency, thread_name_prefix="agol"
     )
+    with agol_pool:
+        # Retrieving the zones from AGOL (or their state stores)
+        with profiler.stage("download", dataset="zones"):
+            zones, area = retrieve_zones(
+                inspector_zones, dapcz_features, agol_pool, stores
+            )
+            # Segments in the area where zones were redrawn since the last run
+            affected = None
+            if area is not None and not checkpoint.replace:
+                affected = retrieve_segments_in_area(segments_layer, area)
 
-    # We search for new segment updates in the last 30 days
-    search_date = datetime.datetime.now() - datetime.timedelta(days=30)
-    formatted_time = search_date.strftime("%Y-%m-%d %H:%M:%S")
+        # A replace run publishes every segment again, so it starts from an empty
+        # index unless it is resumed and the index holds what it already uploaded
+        if checkpoint.replace and checkpoint.last_objectid < 0:
+            index = SegmentIndex(store=index_store)
+        else:
+            index = SegmentIndex.load(index_store)
+            if not checkpoint.replace and not len(index):
+                # Without the index every segment of the last 30 days would be upserted
+                # again and the segment lookup couldn't be published
+                raise RuntimeError(
+                    f"No segment index in the {args.checkpoint_store} state store. Run "
+                    "--replace once to build it, with the --checkpoint-store daily runs use."
+                )
 
-    if args.replace:
-        # If we need to replace all the data:
-        formatted_time = "1970-01-01 00:00:00"
-        res = soda.replace(DATASET, [])
+        if affected is not None and not affected.empty:
+            logger.info(
+                f"Zones changed since the last run, retagging {len(affected)} affected segments."
+            )
+            # Stored tags of these segments are stale even though their geometry is not
+            index.invalidate(affected["SEGMENT_ID"])
 
-    # Retrieving segment data from AGOL
-    query_result = segments_layer.query(
-        where=f"MODIFIED_DATE >= TIMESTAMP '{formatted_time}'",
-        out_fields="SEGMENT_ID, FULL_STREET_NAME, ROAD_CLASS, MODIFIED_DATE",
-        return_geometry=True,
-    )
-    segments = query_result.df.to_dict("records")
+        # Recently updated segments are streamed page by page from AGOL, the next
+        # page downloads while the current one is tagged and uploaded.
+        pages = prefetch(
+            iter_segment_pages(
+                segments_layer,
+                f"MODIFIED_DATE >= TIMESTAMP '{checkpoint.formatted_time}'",
+                page_size=args.page_size,
+                start_after=checkpoint.last_objectid,
+            ),
+            agol_pool,
+        )
+        checked, upserted = upload_segments(
+            affected, pages, zones, index, checkpoint, args, profiler
+        )
+
+    if checkpoint.replace:
+        if checkpoint.segments_checked:
+            # A replace run starts from an empty index and saves it with every
+            # checkpoint, so once it finishes the index holds every segment in AGOL
+            segment_ids = index.data["segment_id"].tolist()
+            with profiler.stage("publish", step="delete_stale"):
+                deleted = delete_stale_segments(get_socrata(), segment_ids)
+            logger.info(f"Deleted {deleted} segments that are no longer in AGOL.")
+            index.complete = True
+            index.save()
+        else:
+            logger.warning("No segments retrieved, skipped deleting stale segments.")
 
-    if not segments:
+    if not checked:
         logger.info("No recently updated segments, did nothing.")
-        return 0
-    logger.info(f"Tagging {len(segments)} recently updated segments.")
-    segment_batches = batch_list(segments)
-
-    for batch in segment_batches:
-        for segment in batch:
-            # Tag with inspector zone
-            segment["INSPECTOR_ZONE"] = retrieve_row_inspector_segments_by_segment(
-                geom=segment["SHAPE"], gis=gis, inspector_zones=inspector_zones
-            )
-            # Tag with DAPCZ zone
-            segment["DAPCZ_ZONE"] = retrieve_dapcz_segments_by_segment(
-                geom=segment["SHAPE"], gis=gis, dapcz_features=dapcz_features
-            )
-            # Removing unwanted fields for Socrata export
-            segment.pop("SHAPE", None)
-            segment.pop("MODIFIED_DATE", None)
-            segment.pop("OBJECTID", None)
-        res = soda.upsert(DATASET, batch)
-        logger.info(f"Batch uploaded to Socrata with result: {res}")
+    else:
+        logger.info(
+            f"Upserted {upserted} changed segments, {checked - upserted} were unchanged."
+        )
+
+    # Published on every run, even without changes, so its age tells
+    # inspector_prioritization.py that it is current
+    if index.complete:
+        with profiler.stage("publish", step="segment_lookup"):
+            publish_segment_lookup(index)
+    else:
+        logger.warning(
+            "The segment index is incomplete, the segment lookup isn't published. Run "
+            "--replace to rebuild it."
+        )
+
+    # The new zones are only saved once the segments they affect are retagged
+    save_zones(zones, stores)
+    checkpoint.clear()
+
+
+def publish_segment_lookup(index):
+    """
+    Saves the road class and zones of every segment as a SegmentLookup in CACHE_DIR
+    and uploads it to S3 for inspector_prioritization.py
+    """
+    import boto3
+
+    lookup = index.lookup()
+    lookup.save()
+    s3 = trace_s3(
+        boto3.client(
+            "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
+        )
+    )
+    with open(SEGMENT_LOOKUP_PATH, "rb") as f:
+        s3.put_object(
+            Bucket=BUCKET,
+            Key=SEGMENT_LOOKUP_KEY,
+            Body=f.read(),
+            Metadata=lookup_metadata(),
+        )
+    logger.info(f"Published the lookup of {len(lookup)} segments to S3.")
+
+
+def upload_segments(affected, pages, zones, index, checkpoint, args, profiler):
+    """
+    Tags the segments of each page and upserts the changed ones to Socrata on the
+    uploader threads. Once every batch of a page is uploaded, the segment index is
+    saved and the checkpoint moves past the page.
+
+    Parameters
+    ----------
+    affected : dataframe of segments in the area where zones changed, or None
+    pages : iterator of dataframes of recently updated segments in OBJECTID order
+    zones : ZoneIndex of the inspector and DAPCZ zones
+    index : SegmentIndex of the segments already published
+    checkpoint : Checkpoint of the run
+    args : parsed CLI arguments
+    profiler : profiling.Profiler wrapping the stages of the run
+
+    Returns
+    -------
+    checked - number of segments tagged or checked against the index
+    upserted - number of segments sent to Socrata
+
+    """
+    # Each upload thread gets its own Socrata client (and HTTP session)
+    clients = threading.local()
+    lock = threading.Lock()
+    # Index entries of uploaded batches, applied to the index on the main thread
+    completed = []
+    # Uploads still in flight for each page, and the pages waiting to be checkpointed
+    outstanding = {}
+    unfinished_pages = collections.deque()
+
+    def upsert(batch):
+        if not hasattr(clients, "soda"):
+            clients.soda = get_socrata()
+        return clients.soda.upsert(DATASET, batch)
+
+    def uploaded(batch_number, res, context):
+        page_number, batch_entries = context
+        with lock:
+            completed.append(batch_entries)
+            outstanding[page_number] -= 1
+            checkpoint.batches_completed += 1
+        logger.info(f"Batch {batch_number} uploaded to Socrata with result: {res}")
+
+    def commit():
+        """Saves the index and checkpoints the pages whose uploads have all finished"""
+        with lock:
+            entries = list(completed)
+            completed.clear()
+            finished = []
+            # Pages are checkpointed in order so last_objectid never skips a page
+            while unfinished_pages and outstanding[unfinished_pages[0][0]] == 0:
+                finished.append(unfinished_pages.popleft())
+        if entries:
+            index.update(np.concatenate(entries))
+        if not finished:
+            return
+        for page_number, last_objectid, segments in finished:
+            if last_objectid is not None:
+                checkpoint.last_objectid = last_objectid
+            checkpoint.segments_checked += segments
+            del outstanding[page_number]
+        index.save()
+        checkpoint.save()
+
+    # Tagged batches are handed to the uploader so Socrata upserts overlap tagging
+    uploader = BatchUploader(
+        upsert, concurrency=args.socrata_concurrency, on_done=uploaded
+    )
+
+    def submit(page_number, records, entries):
+        with lock:
+            outstanding[page_number] += 1
+        uploader.submit(list(records), context=(page_number, np.concatenate(entries)))
+        records.clear()
+        entries.clear()
+
+    # Segments in changed zone areas come first, they have no place in the OBJECTID order
+    sources = [] if affected is None or affected.empty else [(affected, False)]
+    sources = itertools.chain(sources, ((page, True) for page in pages))
+    seen = set()
+    checked = 0
+    upserted = 0
+    try:
+        with uploader:
+            with profiler.stage("transform"):
+                for page_number, (page, streamed) in enumerate(sources):
+                    last_objectid = int(page["OBJECTID"].max()) if streamed else None
+                    page = page[~page["SEGMENT_ID"].isin(seen)]
+                    seen.update(page["SEGMENT_ID"])
+                    checked += len(page)
+                    with lock:
+                        outstanding[page_number] = 0
+
+                    records = []
+                    entries = []
+                    for batch in batch_list(page):
+                        batch_records, batch_entries, upload = tag_batch(
+                            batch, zones, index
+                        )
+                        with lock:
+                            completed.append(batch_entries[~upload])
+                        records.extend(batch_records)
+                        entries.append(batch_entries[upload])
+                        upserted += len(batch_records)
+                        if len(records) >= BATCH_SIZE:
+                            submit(page_number, records, entries)
+                    if records:
+                        submit(page_number, records, entries)
+
+                    unfinished_pages.append((page_number, last_objectid, len(page)))
+                    commit()
+            # Waiting on the uploads still in flight
+            with profiler.stage("publish"):
+                uploader.close()
+    finally:
+        # Whatever finished before a failure is kept for --resume
+        commit()
+    return checked, upserted
 
 
 # CLI argument definition
@@ -134,15 +630,50 @@ parser.add_argument(
     "--replace",
     action="store_true",
     required=False,
-    help="Provide --replace to truncate and replace existing segment data stored in socrata",
+    help="Provide --replace to retag every segment and replace the segment data stored in socrata",
 )
 
-args = parser.parse_args()
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    required=False,
+    help="Continue a failed run from its last checkpoint",
+)
 
-logger = get_logger(
-    __name__,
-    level=logging.INFO,
+parser.add_argument(
+    "--checkpoint-store",
+    choices=["local", "s3"],
+    default="s3",
+    help="Keep the run checkpoint and the segment index in the S3 bucket (s3, so they outlive the "
+    "container) or in CACHE_DIR (local)",
 )
 
+parser.add_argument(
+    "--agol-concurrency",
+    type=int,
+    default=RATE_LIMITS["agol"]["max_concurrency"],
+    help="Most concurrent AGOL queries, the rate limiter ramps up to it while AGOL keeps up "
+    f"(default {RATE_LIMITS['agol']['max_concurrency']})",
+)
+
+parser.add_argument(
+    "--socrata-concurrency",
+    type=int,
+    default=RATE_LIMITS["socrata"]["max_concurrency"],
+    help="Most concurrent Socrata upserts, the rate limiter ramps up to it while Socrata keeps up "
+    f"(default {RATE_LIMITS['socrata']['max_concurrency']})",
+)
+
+parser.add_argument(
+    "--page-size",
+    type=int,
+    default=PAGE_SIZE,
+    help=f"Number of segments requested from AGOL at a time (default {PAGE_SIZE})",
+)
+
+add_profile_arguments(parser)
+
 if __name__ == "__main__":
+    get_logger(__name__, level=logging.INFO)
+    args = parser.parse_args()
     main(args)
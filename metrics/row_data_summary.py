@@ -1,12 +1,19 @@
 """
 Summarizes data CSVs for ROW permits stored in S3 and publishes it to Socrata
 """
-import boto3
-import pandas as pd
-from sodapy import Socrata
 
+import argparse
+import json
+import logging
 import os
-from utils import s3_csv_to_df, df_to_socrata_dataset
+
+from analytics_store import AnalyticsStore
+from checkpoint import LocalStateStore, S3StateStore
+from profiling import Profiler, add_profile_arguments
+from rate_limit import limit_socrata
+from storage import CACHE_DIR
+from tracing import Tracer, trace_s3, trace_socrata
+from utils import get_logger, load_csv, df_to_socrata_dataset
 
 # AWS Credentials
 AWS_ACCESS_ID = os.getenv("EXEC_DASH_ACCESS_ID")
@@ -20,6 +27,12 @@ SO_KEY = os.getenv("SO_KEY")
 SO_SECRET = os.getenv("SO_SECRET")
 DATASET = os.getenv("WEEK_DATASET")
 
+# More rows than the weekly dataset will ever have
+SOCRATA_LIMIT = 100000
+
+# Each file is bucketed by week into one or more measures. AMANDA files have a measure
+# for each FOLDERTYPE in summary_cols ("DS Applications Received", ...), the smartsheet
+# files count towards the measure named in their config.
 FILES = [
     {
         "name": "Applications Received",
@@ -40,25 +53,104 @@ FILES = [
         "fname": "Commercial DS Permit Requests.csv",
         "date_col": "Date Created",
         "summary_cols": "Count Permits",
+        # Smartsheet DS requests are added to the AMANDA totals
+        "measure": "DS Applications Received",
     },
     {
         "name": "Extension Requests",
         "fname": "Extension and Revision Requests.csv",
         "date_col": "Created",
         "summary_cols": "Count Permits",
+        "measure": "Extension Requests",
     },
     {
         "name": "Residential DS Permit Requests",
         "fname": "Residential DS Permits.csv",
         "date_col": "Date Created",
         "summary_cols": "Count Permits",
+        "measure": "DS Applications Received",
     },
 ]
 
+# Weekly totals aggregated in AMANDA, see the *_weekly queries. These replace the daily
+# extracts with --preaggregated, their dates are already the saturday ending each week.
+PREAGGREGATED_FILES = {
+    "Applications Received": {
+        "fname": "applications_received_weekly.csv",
+        "date_col": "WEEKENDING",
+    },
+    "Permits Issued": {
+        "fname": "issued_permits_weekly.csv",
+        "date_col": "WEEKENDING",
+    },
+}
+
+# Number of trailing weeks always republished in --incremental mode, the open week
+# is still collecting permits
+OPEN_WEEKS = 1
+
+# Name of the fingerprints of each week's source rows in their state store, see
+# weeks_to_publish
+FINGERPRINTS_NAME = "weekly_summary_fingerprints.json"
+
+# Socrata floating timestamp of the saturday ending a week, the dataset's row identifier
+WEEK_FORMAT = "%Y-%m-%dT00:00:00.000"
+
+logger = logging.getLogger(__name__)
+
+
+def to_long(file):
+    """
+    Returns the counts of one file as long format rows of date, measure and count
+    Parameters
+    ----------
+    file (dict): an entry of FILES with the Pandas dataframe stored in 'data'
+
+    """
+    import pandas as pd
+
+    df = file["data"]
+    # Some data from AMANDA we want to summarize by FOLDERTYPE (DS, EX, RW)
+    if "FOLDERTYPE" in df.columns:
+        df = df[df["FOLDERTYPE"].isin(file["summary_cols"])]
+        return pd.DataFrame(
+            {
+                "date": df[file["date_col"]],
+                "measure": df["FOLDERTYPE"] + " " + file["name"],
+                "count": df[file["count_col"]],
+            }
+        )
+    return pd.DataFrame(
+        {
+            "date": df[file["date_col"]],
+            "measure": file["measure"],
+            "count": df[file["summary_cols"]],
+        }
+    )
+
+
+def weekly_rows(dfs):
+    """
+    Puts the counts of every file in one long format frame of date, measure, count
+    and week (the saturday ending it)
+    Parameters
+    ----------
+    dfs (list of dicts): Pandas dataframes stored in 'data' and metadata
+
+    """
+    import pandas as pd
+
+    rows = pd.concat([to_long(file) for file in dfs], ignore_index=True)
+    dates = pd.to_datetime(rows["date"], format="ISO8601").dt.normalize()
+    # Weeks start on sunday and are labeled with the saturday they end on
+    rows["week"] = dates + pd.to_timedelta((5 - dates.dt.dayofweek) % 7, unit="D")
+    return rows
+
 
 def summarize_weekly(dfs):
     """
-    Groups ROW counts by week and returns the count for each type
+    Groups ROW counts by week and returns the count for each type. Every file is
+    put in one long format frame and bucketed by week in a single groupby.
     Parameters
     ----------
     dfs (list of dicts): Pandas dataframes stored in 'data' and metadata
@@ -69,58 +161,224 @@ def summarize_weekly(dfs):
                         columns are the totals for each type of ROW permit
 
     """
-    weekly = []
-    for file in dfs:
-        df = file["data"]
-        # Some data from AMANDA we want to summarize by FOLDERTYPE (DS, EX, RW)
-        if "FOLDERTYPE" in df.columns:
-            df = pd.pivot_table(
-                df,
-                index=file["date_col"],
-                columns="FOLDERTYPE",
-                values=file["count_col"],
-                aggfunc="sum",
-            )
-            df = df.reset_index()
-        # Convert date column to datetime type
-        df[file["date_col"]] = pd.to_datetime(df[file["date_col"]])
-        # Grouping by week (starting on sunday)
-        week = df.resample("W-SAT", on=file["date_col"])[file["summary_cols"]].sum()
-        week = pd.DataFrame(week)
-        week["Measure"] = file["name"]
-        weekly.append(week)
-
-    # Combining dataframes
-    output = pd.concat(weekly)
-    output = output.reset_index()
-    output = pd.pivot_table(output, index="index", columns="Measure")
-    # Renaming columns to "FOLDERTYPE Measure"
-    output.columns = output.columns.map(" ".join)
-    output = output.fillna(0)
-
-    # Adding smartsheet data to AMANDA Totals
-    output["DS Applications Received"] = (
-        output["DS Applications Received"]
-        + output["Count Permits Commercial DS Permit Requests"]
-        + output["Count Permits Residential DS Permit Requests"]
+    return weekly_table(weekly_rows(dfs))
+
+
+def weekly_table(counts, weeks=None, measures=None):
+    """
+    Pivots counts to one row per week and a column for each measure
+    Parameters
+    ----------
+    counts (dataframe): long format rows of week (the saturday ending it), measure and count
+    weeks (list): dates of the weeks to return (see WEEK_FORMAT), every week between the
+        first and last one of counts by default
+    measures (list): columns to return, the measures in counts by default
+
+    """
+    import pandas as pd
+
+    output = counts.groupby(["week", "measure"])["count"].sum().unstack(fill_value=0)
+    if weeks is None:
+        # Every week between the first and last one gets a row, even without permits
+        weeks = pd.date_range(output.index.min(), output.index.max(), freq="W-SAT")
+    else:
+        weeks = pd.to_datetime(weeks, format=WEEK_FORMAT)
+    output = output.reindex(index=weeks, columns=measures, fill_value=0).sort_index(axis=1)
+
+    output.index = output.index.strftime(WEEK_FORMAT)
+    output = output.rename_axis(index="date", columns=None).reset_index()
+    return output
+
+
+def week_fingerprints(rows):
+    """
+    Returns a fingerprint of the source rows of each week: the sum of a hash of each
+    row's measure and count, so it doesn't depend on the order of the rows
+    Parameters
+    ----------
+    rows (dataframe): output of weekly_rows
+
+    Returns
+    ----------
+    dict of week date (see WEEK_FORMAT) to fingerprint, for the weeks with rows
+
+    """
+    import pandas as pd
+
+    hashes = pd.util.hash_pandas_object(rows[["measure", "count"]], index=False)
+    sums = hashes.groupby(rows["week"].dt.strftime(WEEK_FORMAT)).sum()
+    return {week: str(fingerprint) for week, fingerprint in sums.items()}
+
+
+def to_long_sql(store, file):
+    """
+    Returns the SQL and parameters selecting the counts of one ingested file as rows
+    of day, measure and count, the same rows as to_long.
+    Parameters
+    ----------
+    store (analytics_store.AnalyticsStore)
+    file (dict): an entry of FILES with the name of its table in 'table'
+
+    """
+    table = store.quote(file["table"])
+    # AMANDA dates are exported as text and smartsheet ones as dates, the day is the
+    # first 10 characters of either
+    day = f"CAST(left(CAST({store.quote(file['date_col'])} AS VARCHAR), 10) AS DATE)"
+    if "FOLDERTYPE" in store.columns(file["table"]):
+        types = ", ".join("?" for _ in file["summary_cols"])
+        sql = (
+            f"SELECT {day} AS day, FOLDERTYPE || ' ' || ? AS measure, "
+            f"{store.quote(file['count_col'])} AS count FROM {table} "
+            f"WHERE FOLDERTYPE IN ({types})"
+        )
+        return sql, [file["name"], *file["summary_cols"]]
+    sql = (
+        f"SELECT {day} AS day, ? AS measure, {store.quote(file['summary_cols'])} AS count "
+        f"FROM {table}"
     )
-    # Drop smartsheet columns
-    output = output.drop(
-        columns=[
-            "Count Permits Commercial DS Permit Requests",
-            "Count Permits Residential DS Permit Requests",
-        ]
+    return sql, [file["measure"]]
+
+
+def weekly_rows_sql(store, dfs):
+    """
+    Returns the SQL and parameters selecting the counts of every ingested file as
+    rows of week, measure and count, the same rows as weekly_rows
+    Parameters
+    ----------
+    store (analytics_store.AnalyticsStore)
+    dfs (list of dicts): entries of FILES with the name of their table in 'table'
+
+    """
+    selects, params = [], []
+    for file in dfs:
+        sql, file_params = to_long_sql(store, file)
+        selects.append(sql)
+        params.extend(file_params)
+    rows = " UNION ALL ".join(selects)
+    # dayofweek is 0 on sunday, so saturday is 6 days after it
+    sql = f"""
+        SELECT
+            CAST(day + CAST(6 - dayofweek(day) AS INTEGER) AS TIMESTAMP) AS week,
+            measure,
+            "count"
+        FROM ({rows})
+    """
+    return sql, params
+
+
+def summarize_weekly_sql(store, dfs, weeks=None, measures=None):
+    """
+    summarize_weekly run in DuckDB: the files are bucketed by week and summed in SQL,
+    only the weekly totals are pivoted in pandas.
+    Parameters
+    ----------
+    store (analytics_store.AnalyticsStore): the store the files were ingested into
+    dfs (list of dicts): entries of FILES with the name of their table in 'table'
+    weeks (list): only sum these weeks, see weekly_table
+    measures (list): see weekly_table
+
+    """
+    rows, params = weekly_rows_sql(store, dfs)
+    where = ""
+    if weeks is not None:
+        where = f"WHERE strftime(week, ?) IN ({', '.join('?' for _ in weeks)})"
+        params = [*params, WEEK_FORMAT, *weeks]
+    sql = f"""
+        SELECT week, measure, CAST(sum("count") AS BIGINT) AS "count"
+        FROM ({rows}) {where}
+        GROUP BY week, measure
+    """
+    counts = store.query_arrow(sql, params).to_pandas()
+    return weekly_table(counts, weeks, measures)
+
+
+def week_fingerprints_sql(store, dfs):
+    """
+    week_fingerprints run in DuckDB, also returns the measures of the files
+    Parameters
+    ----------
+    store (analytics_store.AnalyticsStore): the store the files were ingested into
+    dfs (list of dicts): entries of FILES with the name of their table in 'table'
+
+    """
+    rows, params = weekly_rows_sql(store, dfs)
+    fingerprints = store.query_df(
+        f"""
+        SELECT strftime(week, ?) AS week, CAST(sum(hash(measure, "count")) AS VARCHAR) AS fingerprint
+        FROM ({rows})
+        GROUP BY 1
+        """,
+        [WEEK_FORMAT, *params],
     )
-    output = output.reset_index()
-    output["index"] = output["index"].dt.strftime("%Y-%m-%d")
-    output["index"] = output["index"] + "T00:00:00.000"
-    output = output.rename(
-        columns={
-            "Count Permits Extension Requests": "Extension Requests",
-            "index": "date",
-        }
+    measures = store.query_df(f"SELECT DISTINCT measure FROM ({rows})", params)
+    return (
+        dict(zip(fingerprints["week"], fingerprints["fingerprint"])),
+        sorted(measures["measure"]),
     )
-    return output
+
+
+def weeks_to_publish(fingerprints, previous, published, open_weeks=OPEN_WEEKS):
+    """
+    Returns the weeks whose totals need to be computed and upserted: the weeks whose
+    source rows changed since the last incremental run, the weeks missing from the
+    dataset and the trailing open weeks. Also returns the published weeks that are no
+    longer in the summary (before its first or after its last week), to be deleted.
+    Parameters
+    ----------
+    fingerprints (dict): output of week_fingerprints
+    previous (dict): the fingerprints saved by the last incremental run, empty when
+        there are none and every week is computed
+    published (list): dates of the rows currently in the Socrata dataset
+
+    Returns
+    ----------
+    weeks (list): dates of the weeks to upsert, see WEEK_FORMAT
+    deleted (list): dates of the rows to delete from the dataset
+
+    """
+    import pandas as pd
+
+    weeks = []
+    if fingerprints:
+        weeks = list(
+            pd.date_range(min(fingerprints), max(fingerprints), freq="W-SAT").strftime(
+                WEEK_FORMAT
+            )
+        )
+    published = set(published)
+    changed = [
+        week
+        for week in weeks
+        if week not in published or fingerprints.get(week) != previous.get(week)
+    ]
+    changed = sorted(set(changed) | set(weeks[-open_weeks:]))
+    deleted = sorted(published - set(weeks))
+    return changed, deleted
+
+
+def get_state_store(kind, s3_client):
+    """Returns where the week fingerprints are kept: a file in CACHE_DIR or an object in S3"""
+    if kind == "s3":
+        return S3StateStore(s3_client, BUCKET, FINGERPRINTS_NAME)
+    return LocalStateStore(os.path.join(CACHE_DIR, FINGERPRINTS_NAME))
+
+
+def load_fingerprints(store, engine):
+    """
+    Returns the week fingerprints saved by the last incremental run, empty if there
+    are none or they were computed by the other engine (their hashes differ)
+    """
+    saved = store.read()
+    if saved is None:
+        return {}
+    saved = json.loads(saved)
+    if saved.get("engine") != engine:
+        return {}
+    return saved["weeks"]
+
+
+def save_fingerprints(store, engine, fingerprints):
+    store.write(json.dumps({"engine": engine, "weeks": fingerprints}).encode())
 
 
 def socrata_columns(df):
@@ -130,32 +388,199 @@ def socrata_columns(df):
     return df
 
 
-def main():
-    s3_client = boto3.client(
-        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
-    )
-    soda = Socrata(
-        SO_WEB,
-        SO_TOKEN,
-        username=SO_KEY,
-        password=SO_SECRET,
-        timeout=500,
-    )
+def main(args):
+    import boto3
+    from sodapy import Socrata
 
-    # Load in data from S3
-    dfs = []
+    script = "row_data_summary"
+    with Profiler.from_args(script, args) as profiler, Tracer(script):
+        s3_client = trace_s3(
+            boto3.client(
+                "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
+            )
+        )
+        soda = trace_socrata(
+            limit_socrata(
+                Socrata(
+                    SO_WEB,
+                    SO_TOKEN,
+                    username=SO_KEY,
+                    password=SO_SECRET,
+                    timeout=500,
+                )
+            )
+        )
+        publish_weekly_summary(
+            s3_client,
+            soda,
+            profiler,
+            incremental=args.incremental,
+            preaggregated=args.preaggregated,
+            engine=args.engine,
+            state_store=args.state_store,
+        )
+
+
+def publish_weekly_summary(
+    s3_client,
+    soda,
+    profiler,
+    incremental=False,
+    preaggregated=False,
+    frames=None,
+    engine="pandas",
+    state_store="local",
+):
+    """
+    Summarizes the permit counts by week and publishes them to Socrata.
+
+    Parameters
+    ----------
+    s3_client : boto3 S3 client object
+    soda : sodapy client object
+    profiler : profiling.Profiler wrapping the stages of the run
+    incremental (bool): only compute and upsert the weeks that changed and delete the
+        weeks no longer in the summary, see weeks_to_publish
+    preaggregated (bool): read the weekly AMANDA extracts instead of the daily ones
+    frames (dict): dataframes of files already in memory by S3 file name, see pipeline.py
+    engine (str): "pandas", or "duckdb" to summarize the files in the analytics store
+    state_store (str): where --incremental keeps the week fingerprints, "local" or "s3"
+
+    """
+    files = []
     for f in FILES:
-        row = f
-        row["data"] = s3_csv_to_df(s3_client, BUCKET, f["fname"])
-        dfs.append(row)
+        row = dict(f)
+        if preaggregated:
+            row.update(PREAGGREGATED_FILES.get(f["name"], {}))
+        files.append(row)
+
+    # With incremental, the fingerprints of the last run and the weeks in the dataset
+    previous, published = None, None
+    if incremental:
+        state = get_state_store(state_store, s3_client)
+        previous = load_fingerprints(state, engine)
+        with profiler.stage("download"):
+            published = [
+                row["date"]
+                for row in soda.get(DATASET, select="date", limit=SOCRATA_LIMIT)
+            ]
+
+    if engine == "duckdb":
+        weekly, fingerprints, deleted = summarize_in_store(
+            s3_client, profiler, files, frames, previous, published
+        )
+    else:
+        # Load in data from S3
+        with profiler.stage("download"):
+            for row in files:
+                row["data"] = load_csv(s3_client, BUCKET, row["fname"], frames)
+
+        with profiler.stage("transform"):
+            # Create a weekly summary of the data
+            rows = weekly_rows(files)
+            if incremental:
+                weekly, fingerprints, deleted = summarize_changed_weeks(
+                    rows, previous, published
+                )
+            else:
+                weekly = weekly_table(rows)
 
-    # Create a weekly summary of the data
-    weekly = summarize_weekly(dfs)
     # Cleanup column names
     weekly = socrata_columns(weekly)
+
     # Upload to socrata
-    df_to_socrata_dataset(soda, DATASET, weekly, method="replace")
+    with profiler.stage("publish"):
+        if incremental:
+            logger.info(f"Upserting {len(weekly)} weeks, deleting {len(deleted)}")
+            df_to_socrata_dataset(soda, DATASET, weekly, method="upsert")
+            if deleted:
+                soda.upsert(DATASET, [{"date": date, ":deleted": True} for date in deleted])
+            # Only saved once the dataset has the weeks they describe
+            save_fingerprints(state, engine, fingerprints)
+        else:
+            df_to_socrata_dataset(soda, DATASET, weekly, method="replace")
+
+
+def summarize_changed_weeks(rows, previous, published):
+    """
+    Sums only the weeks to publish, see weeks_to_publish
+    Parameters
+    ----------
+    rows (dataframe): output of weekly_rows
+
+    Returns
+    ----------
+    weekly (dataframe): the weeks to upsert, with a column for every measure
+    fingerprints (dict): of every week, to be saved once the weeks are published
+    deleted (list): dates of the rows to delete from the dataset
+
+    """
+    import pandas as pd
+
+    fingerprints = week_fingerprints(rows)
+    weeks, deleted = weeks_to_publish(fingerprints, previous, published)
+    changed = rows[rows["week"].isin(pd.to_datetime(weeks, format=WEEK_FORMAT))]
+    weekly = weekly_table(changed, weeks, sorted(rows["measure"].unique()))
+    return weekly, fingerprints, deleted
+
+
+def summarize_in_store(
+    s3_client, profiler, files, frames=None, previous=None, published=None
+):
+    """
+    Summarizes the files in the analytics store. With previous and published (see
+    weeks_to_publish) only the weeks to publish are summed, as in
+    summarize_changed_weeks, otherwise the fingerprints and deleted weeks returned
+    are None.
+    """
+    with AnalyticsStore() as store:
+        with profiler.stage("download"):
+            for row in files:
+                row["table"] = store.ingest(s3_client, BUCKET, row["fname"], frames)
+
+        with profiler.stage("transform"):
+            if previous is None:
+                return summarize_weekly_sql(store, files), None, None
+            fingerprints, measures = week_fingerprints_sql(store, files)
+            weeks, deleted = weeks_to_publish(fingerprints, previous, published)
+            weekly = summarize_weekly_sql(store, files, weeks, measures)
+            return weekly, fingerprints, deleted
+
+
+# CLI argument definition
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    required=False,
+    help="Only compute and upsert the open week and the weeks that changed, and delete weeks no longer in the summary, keyed by date",
+)
+
+parser.add_argument(
+    "--state-store",
+    choices=["local", "s3"],
+    default="local",
+    help="Keep the week fingerprints of --incremental in CACHE_DIR (local) or in the S3 bucket (s3)",
+)
+
+parser.add_argument(
+    "--preaggregated",
+    action="store_true",
+    required=False,
+    help="Read the weekly AMANDA extracts (applications_received_weekly, issued_permits_weekly)",
+)
+
+parser.add_argument(
+    "--engine",
+    choices=["pandas", "duckdb"],
+    default="pandas",
+    help="Summarize in pandas or in the local DuckDB store, see analytics_store.py",
+)
 
+add_profile_arguments(parser)
 
 if __name__ == "__main__":
-    main()
+    get_logger(__name__, level=logging.INFO)
+    args = parser.parse_args()
+    main(args)
@@ -3,15 +3,17 @@ Uploads a CSV file stored in an S3 Bucket to a desired dataset
 in Socrata AKA the open data portal AKA city datahub
 """
 import argparse
-import boto3
 import logging
-from sodapy import Socrata
-import numpy as np
 
 import os
 
+from profiling import Profiler, add_profile_arguments
+from rate_limit import limit_socrata
 from utils import df_to_socrata_dataset, get_logger, s3_csv_to_df
+from schemas import SCHEMAS
 from socrata_config import DATASETS
+from socrata_publish import RevisionPublisher
+from tracing import Tracer, trace_s3, trace_socrata
 
 # AWS Credentials
 AWS_ACCESS_ID = os.getenv("EXEC_DASH_ACCESS_ID")
@@ -26,37 +28,73 @@ SO_SECRET = os.getenv("SO_SECRET")
 
 DATASET = os.getenv("SO_DATASET")
 
+logger = logging.getLogger(__name__)
 
-def main(args):
-    dataset = DATASETS[args.dataset]
-
-    logger.info(f"Downloading csv file from S3: {dataset['file_name']}")
-    s3 = boto3.client(
-        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
-    )
-    df = s3_csv_to_df(s3, BUCKET, dataset["file_name"])
-    # replacing NaN's with None (Socrata doesn't like)
-    df = df.replace(np.nan, None)
 
-    if "sodapy_method" not in dataset:
-        method = None
-    else:
-        method = dataset["sodapy_method"]
-
-    logger.info(
-        f"Uploading to dataset: datahub.austintexas.gov/d/{dataset['resource_id']}, method: {method}"
-    )
+def main(args):
+    import boto3
+    from sodapy import Socrata
 
-    soda = Socrata(
-        SO_WEB,
-        SO_TOKEN,
-        username=SO_KEY,
-        password=SO_SECRET,
-        timeout=60,
-    )
+    dataset = DATASETS[args.dataset]
 
-    response = df_to_socrata_dataset(soda, dataset["resource_id"], df, method=method)
-    logger.info(response)
+    script = f"s3_to_socrata-{args.dataset}"
+    with Profiler.from_args(script, args) as profiler, Tracer(script):
+        s3 = trace_s3(
+            boto3.client(
+                "s3",
+                aws_access_key_id=AWS_ACCESS_ID,
+                aws_secret_access_key=AWS_PASS,
+            )
+        )
+
+        if "sodapy_method" not in dataset:
+            method = None
+        else:
+            method = dataset["sodapy_method"]
+
+        if args.backend == "revision":
+            # The CSV is streamed from S3 to Socrata without being read into a dataframe
+            logger.info(
+                f"Uploading {dataset['file_name']} as a revision of dataset: "
+                f"datahub.austintexas.gov/d/{dataset['resource_id']}, method: {method or 'upsert'}"
+            )
+            publisher = RevisionPublisher(SO_WEB, SO_TOKEN, SO_KEY, SO_SECRET)
+            with profiler.stage("publish"):
+                publisher.publish_s3_object(
+                    s3,
+                    BUCKET,
+                    dataset["file_name"],
+                    dataset["resource_id"],
+                    method=method or "upsert",
+                )
+            return
+
+        with profiler.stage("download"):
+            logger.info(f"Downloading csv file from S3: {dataset['file_name']}")
+            schema = SCHEMAS.get(args.dataset)
+            df = s3_csv_to_df(s3, BUCKET, dataset["file_name"], schema)
+
+        logger.info(
+            f"Uploading to dataset: datahub.austintexas.gov/d/{dataset['resource_id']}, method: {method}"
+        )
+
+        soda = trace_socrata(
+            limit_socrata(
+                Socrata(
+                    SO_WEB,
+                    SO_TOKEN,
+                    username=SO_KEY,
+                    password=SO_SECRET,
+                    timeout=60,
+                )
+            )
+        )
+
+        with profiler.stage("publish"):
+            response = df_to_socrata_dataset(
+                soda, dataset["resource_id"], df, method=method, schema=schema
+            )
+        logger.info(response)
 
 
 # CLI argument definition
@@ -69,12 +107,16 @@ parser.add_argument(
     help="Name of the dataset defined in socrata_config.py. Ex: license_agreements_timeline",
 )
 
-args = parser.parse_args()
-
-logger = get_logger(
-    __name__,
-    level=logging.INFO,
+parser.add_argument(
+    "--backend",
+    choices=["soda", "revision"],
+    default="soda",
+    help="Send the rows as JSON through SODA, or upload the CSV as a revision (for large replaces)",
 )
 
+add_profile_arguments(parser)
+
 if __name__ == "__main__":
+    get_logger(__name__, level=logging.INFO)
+    args = parser.parse_args()
     main(args)
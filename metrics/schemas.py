@@ -0,0 +1,176 @@
+"""
+Column types of the AMANDA extracts in S3 and of the Socrata datasets published
+from them. Schemas are keyed by the name of the query in amanda/queries.py (which
+is also the name of its dataset in socrata_config.DATASETS), or by the script for
+datasets a script builds itself.
+
+Each column is declared as one of:
+- CATEGORY: text with few distinct values
+- INT: integer that may be missing (pandas Int64)
+- datetime_column(format): parsed to datetime64 when read, written to Socrata with the strftime format
+
+Columns that aren't declared are read with the types pandas infers.
+"""
+
+# Socrata floating timestamp
+SOCRATA_DATETIME = "%Y-%m-%dT%H:%M:%S.000"
+
+CATEGORY = {"type": "category"}
+INT = {"type": "Int64"}
+
+
+def datetime_column(socrata_format=SOCRATA_DATETIME):
+    return {"type": "datetime", "format": socrata_format}
+
+
+DATETIME = datetime_column()
+
+# The priority dataset keeps timestamps to the minute
+PRIORITY_DATETIME = datetime_column("%Y-%m-%dT%H:%M:00.000")
+
+PRIORITY_DATES = [
+    "EXPIRY_DATE",
+    "START_DATE",
+    "END_DATE",
+    "ISSUE_DATE",
+    "MOST_RECENT_INSPECTION",
+    "EXTENSION_START_DATE",
+    "EXTENSION_END_DATE",
+    "EVENT_START_DATE",
+]
+
+SCHEMAS = {
+    "row_inspector_permit_list": {
+        "PERMIT_TYPE": CATEGORY,
+        "FOLDERTYPE": CATEGORY,
+        "FOLDERRSN": INT,
+        **{column: PRIORITY_DATETIME for column in PRIORITY_DATES},
+    },
+    "row_inspector_segment_list": {
+        "FOLDERRSN": INT,
+        "PROPERTYRSN": INT,
+    },
+    # Published by inspector_prioritization.py
+    "inspector_prioritization": {
+        "FOLDERTYPE": CATEGORY,
+        "FOLDERRSN": INT,
+        "count_segments": INT,
+        **{column: PRIORITY_DATETIME for column in PRIORITY_DATES},
+    },
+    "review_time": {
+        "FOLDERRSN": INT,
+        "FOLDERTYPE": CATEGORY,
+        "INDATE": DATETIME,
+        "ISSUEDATE": DATETIME,
+        "WEBAPPSTART": DATETIME,
+        "WEBAPPEND": DATETIME,
+    },
+    "license_agreements_timeline": {
+        "FOLDERRSN": INT,
+        "SUBDESC": CATEGORY,
+        "STATUSDESC": CATEGORY,
+        "INDATE": DATETIME,
+        "WEB_APP_ACCEPT_DATE": DATETIME,
+        "PAYMENT_COMPLETED_DATE": DATETIME,
+        "REVIEW_END_DATE": DATETIME,
+        "ISSUEDATE": DATETIME,
+    },
+    "lde_site_plan_revisions": {
+        "FOLDERTYPE": CATEGORY,
+        "FOLDERRSN": INT,
+        "SUBCODE": INT,
+        "SUBDESC": CATEGORY,
+        "STATUSDESC": CATEGORY,
+        "REVIEWER": CATEGORY,
+        "PROCESSRSN": INT,
+        "PROCESS_NAME": CATEGORY,
+        "PROCESS_STATUS": CATEGORY,
+        "START_DATE": DATETIME,
+        "END_DATE": DATETIME,
+        "TO_START": DATETIME,
+        "TO_END": DATETIME,
+    },
+    "tds_cases": {
+        "FOLDERTYPE": CATEGORY,
+        "FOLDERRSN": INT,
+        "REVIEWER": CATEGORY,
+        "PROCESSRSN": INT,
+        "PROCESSNAME": CATEGORY,
+        "PROCESS_STATUS": CATEGORY,
+        "CYCLENUMBER": INT,
+    },
+    "sif_payment_details": {
+        "PRIMARY_FOLDER_PROPERTY_PROPID": INT,
+        "COUNCIL_DISTRICT": CATEGORY,
+        "SIF_DISTRICT_AREA": CATEGORY,
+        "PAYMENT_MONTH": CATEGORY,
+        "PAYMENT_QUARTER": CATEGORY,
+        "PAYMENT_FY": CATEGORY,
+    },
+}
+
+
+def csv_dtypes(schema):
+    """Returns the dtypes pd.read_csv can parse the columns of a schema to directly, dates are parsed after"""
+    return {
+        column: spec["type"]
+        for column, spec in schema.items()
+        if spec["type"] != "datetime"
+    }
+
+
+def apply_schema(df, schema):
+    """
+    Casts the columns of a dataframe to the types declared in a schema, columns that
+    aren't in the dataframe are skipped.
+    """
+    import pandas as pd
+
+    for column, spec in schema.items():
+        if column not in df.columns:
+            continue
+        if spec["type"] == "datetime":
+            if not pd.api.types.is_datetime64_any_dtype(df[column]):
+                df[column] = pd.to_datetime(df[column], format="mixed")
+        elif df[column].dtype != spec["type"]:
+            df[column] = df[column].astype(spec["type"])
+    return df
+
+
+def socrata_dates(column, spec=None):
+    """Formats a datetime column (or one declared as datetime in spec) as Socrata timestamps, other columns are returned as they are"""
+    import pandas as pd
+
+    spec = spec or {}
+    is_datetime = pd.api.types.is_datetime64_any_dtype(column)
+    if spec.get("type") != "datetime" and not is_datetime:
+        return column
+    if not is_datetime:
+        column = pd.to_datetime(column, format="mixed")
+    return column.dt.strftime(spec.get("format", SOCRATA_DATETIME))
+
+
+def to_socrata_records(df, schema=None):
+    """
+    Returns the rows of a dataframe as the JSON records Socrata expects. Dates are
+    formatted with the Socrata format of their column and missing values become
+    None, one column at a time, so the dataframe is never converted to object dtype
+    as a whole.
+
+    Parameters
+    ----------
+    df : Pandas Dataframe
+    schema (dict): the column types, datetime64 columns that aren't declared use SOCRATA_DATETIME
+
+    Returns
+    -------
+    list of dicts
+
+    """
+    schema = schema or {}
+    columns = {}
+    for name in df.columns:
+        column = socrata_dates(df[name], schema.get(name))
+        values = column.astype(object)
+        columns[name] = values.where(column.notna(), None).tolist()
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
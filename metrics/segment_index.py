@@ -0,0 +1,271 @@
+"""
+Persisted index of the roadway segments already tagged and published to Socrata.
+
+For every segment it keeps a hash of the geometry, a hash of the published row,
+the road class and the zone tags, so a run only tags segments whose geometry
+changed and only upserts rows that are different from what was last published.
+
+The index is kept in the same store as the tagging run's checkpoint (a file in
+CACHE_DIR or an object in S3, see checkpoint.py), so a run resumed on another machine
+continues with what the failed run already uploaded.
+
+Once the index holds every segment, its road class and zones are also published
+as a SegmentLookup for inspector_prioritization.py, which looks up the segments of
+the permits in it instead of downloading the whole segment dataset.
+"""
+import numpy as np
+
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+
+from storage import CACHE_DIR, atomic_write
+
+# Name of the index in its store, next to the checkpoint
+SEGMENT_INDEX_NAME = "segment_index.npz"
+SEGMENT_LOOKUP_PATH = os.path.join(CACHE_DIR, "segment_lookup.npy")
+
+# Key of the segment lookup in the S3 bucket
+SEGMENT_LOOKUP_KEY = "segment_lookup.npy"
+
+# Metadata of the segment lookup's S3 object holding when it was published
+PUBLISHED_AT = "published-at"
+
+# A lookup that wasn't published for this long is stale: the daily tagging runs stopped
+# publishing it (their segment index is incomplete) and new segments are missing from it
+SEGMENT_LOOKUP_MAX_AGE = datetime.timedelta(hours=48)
+
+# Zone and road class columns are stored as int64 with this value for missing values
+NULL_ZONE = -1
+
+DTYPE = np.dtype(
+    [
+        ("segment_id", "i8"),
+        ("geometry_hash", "u8"),
+        ("row_hash", "u8"),
+        ("inspector_zone", "i8"),
+        ("dapcz_zone", "i8"),
+        ("road_class", "i8"),
+    ]
+)
+
+# Rows of a SegmentLookup table
+LOOKUP_COLUMNS = ("segment_id", "road_class", "inspector_zone", "dapcz_zone")
+
+logger = logging.getLogger(__name__)
+
+
+def _digest(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def geometry_hash(geometry):
+    """Returns a 64 bit hash of a shapely geometry's WKB, 0 for a missing geometry"""
+    import shapely
+
+    if geometry is None:
+        return 0
+    return _digest(shapely.to_wkb(geometry))
+
+
+def row_hash(record):
+    """Returns a 64 bit hash of a record as it is sent to Socrata"""
+    return _digest(json.dumps(record, sort_keys=True, default=str).encode())
+
+
+def zone_to_int(zone):
+    """Stores a zone tag (int, float or None) in an int64 column"""
+    if zone is None or zone != zone:
+        return NULL_ZONE
+    return int(zone)
+
+
+def zone_from_int(zone):
+    """Reads a zone tag back from its int64 column"""
+    if zone == NULL_ZONE:
+        return None
+    return int(zone)
+
+
+class SegmentIndex:
+    """
+    Structured array of DTYPE sorted by segment_id.
+
+    Parameters
+    ----------
+    data (numpy structured array): existing entries, sorted by segment_id
+    complete (bool): the index holds every segment in AGOL, set by a --replace run
+    store : checkpoint.LocalStateStore or S3StateStore the index is saved to
+
+    """
+
+    def __init__(self, data=None, complete=False, store=None):
+        self.data = data if data is not None else np.empty(0, dtype=DTYPE)
+        self.complete = complete
+        self.store = store
+
+    def __len__(self):
+        return len(self.data)
+
+    @classmethod
+    def load(cls, store):
+        """Reads the index from its store, returns an empty index if there is none yet"""
+        saved = store.read()
+        if saved is None:
+            return cls(store=store)
+        with np.load(io.BytesIO(saved), allow_pickle=False) as arrays:
+            data = arrays["data"]
+            complete = bool(arrays["complete"])
+        return cls(data, complete, store)
+
+    def save(self):
+        buffer = io.BytesIO()
+        np.savez(buffer, data=self.data, complete=np.array(self.complete))
+        self.store.write(buffer.getvalue())
+
+    def lookup(self):
+        """Returns the road class and zones of the segments as a SegmentLookup"""
+        return SegmentLookup(
+            np.stack([self.data[column] for column in LOOKUP_COLUMNS]).astype(np.int64)
+        )
+
+    def find(self, segment_ids):
+        """
+        Looks up segment IDs with a binary search.
+
+        Returns
+        -------
+        positions (array): index into self.data for each segment, only valid where found
+        found (boolean array): whether each segment is in the index
+
+        """
+        segment_ids = np.asarray(segment_ids, dtype=np.int64)
+        positions = np.searchsorted(self.data["segment_id"], segment_ids)
+        positions = np.minimum(positions, max(len(self.data) - 1, 0))
+        if not len(self.data):
+            return positions, np.zeros(len(segment_ids), dtype=bool)
+        found = self.data["segment_id"][positions] == segment_ids
+        return positions, found
+
+    def invalidate(self, segment_ids):
+        """Forgets the geometry hash of segments so that they are tagged again"""
+        positions, found = self.find(segment_ids)
+        self.data["geometry_hash"][positions[found]] = 0
+
+    def update(self, entries):
+        """Adds or replaces entries (a structured array of DTYPE), keeping the index sorted"""
+        if not len(entries):
+            return
+        combined = np.concatenate([self.data, np.asarray(entries, dtype=DTYPE)])
+        # Stable sort keeps the newest entry last within each segment_id
+        combined = combined[np.argsort(combined["segment_id"], kind="stable")]
+        ids = combined["segment_id"]
+        keep = np.ones(len(combined), dtype=bool)
+        keep[:-1] = ids[1:] != ids[:-1]
+        self.data = combined[keep]
+
+
+class SegmentLookup:
+    """
+    Road class, inspector zone and DAPCZ zone of every segment, as parallel int64
+    rows of a 2D array (see LOOKUP_COLUMNS) sorted by segment_id. Saved as a .npy
+    file which is memory-mapped when loaded, so segments are looked up with a
+    binary search without reading the whole table.
+
+    Parameters
+    ----------
+    table (2D int64 array): one row for each of LOOKUP_COLUMNS
+
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return self.table.shape[1]
+
+    @classmethod
+    def load(cls, path=SEGMENT_LOOKUP_PATH):
+        return cls(np.load(path, mmap_mode="r", allow_pickle=False))
+
+    def save(self, path=SEGMENT_LOOKUP_PATH):
+        with atomic_write(path) as f:
+            np.save(f, np.ascontiguousarray(self.table), allow_pickle=False)
+
+    def find(self, segment_ids):
+        """
+        Looks up segment IDs with a binary search.
+
+        Returns
+        -------
+        found (boolean array): whether each segment is in the lookup
+        columns (dict): road_class, inspector_zone and dapcz_zone of each segment
+            as float arrays, NaN where the value is missing or the segment wasn't found
+
+        """
+        segment_ids = np.asarray(segment_ids, dtype=np.int64)
+        if not len(self):
+            missing = np.full(len(segment_ids), np.nan)
+            return np.zeros(len(segment_ids), dtype=bool), {
+                name: missing.copy() for name in LOOKUP_COLUMNS[1:]
+            }
+        ids = self.table[0]
+        positions = np.minimum(np.searchsorted(ids, segment_ids), len(ids) - 1)
+        found = ids[positions] == segment_ids
+        columns = {}
+        for row, name in enumerate(LOOKUP_COLUMNS[1:], start=1):
+            values = self.table[row][positions].astype(float)
+            values[~found | (values == NULL_ZONE)] = np.nan
+            columns[name] = values
+        return found, columns
+
+
+def lookup_metadata():
+    """Returns the metadata of a segment lookup published now"""
+    return {PUBLISHED_AT: datetime.datetime.now(datetime.timezone.utc).isoformat()}
+
+
+def fetch_segment_lookup(
+    s3, bucket, path=SEGMENT_LOOKUP_PATH, max_age=SEGMENT_LOOKUP_MAX_AGE
+):
+    """
+    Returns the SegmentLookup published to S3 by roadway_segment_tagging.py,
+    memory-mapped from a copy in CACHE_DIR. The copy is only downloaded again when
+    the object's ETag changed. Returns None if no lookup was published, or if it was
+    published more than max_age ago (or before lookups recorded when they were).
+    """
+    try:
+        head = s3.head_object(Bucket=bucket, Key=SEGMENT_LOOKUP_KEY)
+    except s3.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+    published_at = head.get("Metadata", {}).get(PUBLISHED_AT)
+    age = None
+    if published_at is not None:
+        age = datetime.datetime.now(datetime.timezone.utc) - datetime.datetime.fromisoformat(
+            published_at
+        )
+    if age is None or age > max_age:
+        logger.warning(
+            f"The segment lookup in S3 was published at {published_at or 'an unknown time'}, "
+            f"more than {max_age} ago, it is stale and not used."
+        )
+        return None
+    etag = head["ETag"]
+    etag_path = f"{path}.etag"
+    cached = None
+    if os.path.exists(path) and os.path.exists(etag_path):
+        with open(etag_path) as f:
+            cached = f.read()
+    if cached != etag:
+        response = s3.get_object(Bucket=bucket, Key=SEGMENT_LOOKUP_KEY)
+        with atomic_write(path) as f:
+            shutil.copyfileobj(response["Body"], f)
+        with open(etag_path, "w") as f:
+            f.write(etag)
+    return SegmentLookup.load(path)
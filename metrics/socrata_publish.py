@@ -0,0 +1,219 @@
+"""
+Publishes whole files to Socrata through the revision API (DSMAPI) instead of
+sending the rows as JSON through SODA.
+
+A revision is opened on the dataset, the CSV is uploaded to it as a source,
+Socrata parses it, and the revision is applied and polled until the new version of
+the dataset is live. The CSV can be streamed straight from the S3 object, so large
+replaces don't need a dataframe. The CSV's header must match the dataset's column
+field names (Socrata lowercases them).
+
+https://dev.socrata.com/publishers/dsmapi.html
+"""
+import logging
+import os
+import time
+
+from rate_limit import get_limiter
+from schemas import socrata_dates
+from tracing import span, trace_requests
+
+# Seconds between checks of a source's or revision's progress
+POLL_INTERVAL = 5
+
+# Seconds to wait for Socrata to parse a source or apply a revision
+PUBLISH_TIMEOUT = 3600
+
+# sodapy methods to the revision action doing the same
+ACTIONS = {"replace": "replace", "upsert": "update"}
+
+logger = logging.getLogger(__name__)
+
+
+class RevisionError(Exception):
+    """Socrata failed to parse an upload or to apply a revision"""
+
+
+class SizedStream:
+    """
+    File-like wrapper around a stream of known length, so requests sends it with a
+    Content-Length header instead of chunked encoding
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+
+class RevisionPublisher:
+    """
+    Client of the revision API of a Socrata domain.
+
+    Parameters
+    ----------
+    domain (str): ex: datahub.austintexas.gov
+    app_token (str)
+    username (str): API key ID
+    password (str): API key secret
+    timeout (int): seconds to wait for each HTTP response
+
+    """
+
+    def __init__(self, domain, app_token, username, password, timeout=500):
+        import requests
+
+        self.url = f"https://{domain}/api/publishing/v1"
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers["X-App-Token"] = app_token
+        trace_requests(self.session)
+        self.limiter = get_limiter("socrata")
+
+    def _send(self, method, path, **kwargs):
+        response = self.session.request(
+            method, f"{self.url}{path}", timeout=self.timeout, **kwargs
+        )
+        response.raise_for_status()
+        return response.json()["resource"]
+
+    def _request(self, method, path, operation, **kwargs):
+        # POSTs create a revision or a source, retrying one that failed with a 5xx or
+        # a timeout could leave the one Socrata did create behind
+        with span("socrata", operation, path=path):
+            return self.limiter.call(
+                self._send, method, path, idempotent=method != "POST", **kwargs
+            )
+
+    def _upload(self, source_id, body, content_type):
+        # The body is streamed, so the upload can't be retried by the limiter
+        with span("socrata", "revision_upload", source=source_id):
+            self.limiter.acquire()
+            ok = False
+            try:
+                resource = self._send(
+                    "POST",
+                    f"/source/{source_id}",
+                    data=body,
+                    headers={"Content-Type": content_type},
+                )
+                ok = True
+                return resource
+            finally:
+                self.limiter.release(ok=ok)
+
+    def _wait(self, check, description):
+        # Polls check() until it returns something other than None
+        deadline = time.monotonic() + PUBLISH_TIMEOUT
+        while True:
+            result = check()
+            if result is not None:
+                return result
+            if time.monotonic() > deadline:
+                raise RevisionError(f"Timed out waiting for {description}")
+            time.sleep(POLL_INTERVAL)
+
+    def _output_schema(self, source_id):
+        # Returns the ID of the source's parsed output schema once Socrata is done with it
+        source = self._request("GET", f"/source/{source_id}", "revision_poll")
+        if source.get("failed_at"):
+            raise RevisionError(
+                f"Source {source_id} failed: {source.get('failure_details')}"
+            )
+        for input_schema in source.get("schemas") or []:
+            for output_schema in input_schema.get("output_schemas") or []:
+                if output_schema.get("completed_at"):
+                    if output_schema.get("error_count"):
+                        raise RevisionError(
+                            f"Source {source_id} has {output_schema['error_count']} rows "
+                            "that don't match the dataset's columns"
+                        )
+                    return output_schema["id"]
+        return None
+
+    def _applied(self, dataset_id, revision):
+        # Returns the revision once its update has finished
+        resource = self._request(
+            "GET", f"/revision/{dataset_id}/{revision}", "revision_poll"
+        )
+        statuses = [task.get("status") for task in resource.get("task_sets") or []]
+        if "failure" in statuses:
+            raise RevisionError(f"Revision {revision} of {dataset_id} failed")
+        if resource.get("closed_at"):
+            return resource
+        return None
+
+    def publish(
+        self, dataset_id, body, filename, method="replace", content_type="text/csv"
+    ):
+        """
+        Uploads a file as a new revision of a dataset and waits for it to be applied.
+
+        Parameters
+        ----------
+        dataset_id (str): resource ID of the dataset
+        body : bytes or a file-like object, streamed to Socrata
+        filename (str): name of the upload shown in the dataset's history
+        method (str): "replace" the rows of the dataset or "upsert" them
+
+        Returns
+        -------
+        dict: the applied revision
+
+        """
+        revision = self._request(
+            "POST",
+            f"/revision/{dataset_id}",
+            "revision_open",
+            json={"action": {"type": ACTIONS[method]}},
+        )["revision_seq"]
+        source = self._request(
+            "POST",
+            f"/revision/{dataset_id}/{revision}/source",
+            "revision_source",
+            json={
+                "source_type": {"type": "upload", "filename": filename},
+                "parse_options": {"parse_source": True},
+            },
+        )
+        logger.info(f"Uploading {filename} to revision {revision} of {dataset_id}")
+        self._upload(source["id"], body, content_type)
+
+        output_schema_id = self._wait(
+            lambda: self._output_schema(source["id"]), f"{filename} to be parsed"
+        )
+        self._request(
+            "PUT",
+            f"/revision/{dataset_id}/{revision}/apply",
+            "revision_apply",
+            json={"output_schema_id": output_schema_id},
+        )
+        applied = self._wait(
+            lambda: self._applied(dataset_id, revision),
+            f"revision {revision} of {dataset_id} to be applied",
+        )
+        logger.info(f"Applied revision {revision} of {dataset_id}")
+        return applied
+
+    def publish_s3_object(self, s3, bucket, key, dataset_id, method="replace"):
+        """Streams a CSV in S3 to a new revision of a dataset, without reading it into memory"""
+        response = s3.get_object(Bucket=bucket, Key=key)
+        body = SizedStream(response["Body"], response["ContentLength"])
+        return self.publish(dataset_id, body, os.path.basename(key), method)
+
+    def publish_df(self, df, dataset_id, filename, method="replace", schema=None):
+        """
+        Uploads a dataframe as a CSV revision of a dataset, dates are written in the
+        Socrata format of their column (see schemas.py)
+        """
+        schema = schema or {}
+        df = df.assign(
+            **{name: socrata_dates(df[name], schema.get(name)) for name in df.columns}
+        )
+        return self.publish(dataset_id, df.to_csv(index=False).encode(), filename, method)
@@ -0,0 +1,202 @@
+"""
+Generates synthetic ROW inspector data shaped like the row_inspector_permit_list
+and row_inspector_segment_list extracts from amanda_to_s3.py and the road segment
+dataset in Socrata. Used to benchmark the scoring pipeline at larger volumes.
+"""
+import numpy as np
+import pandas as pd
+
+import datetime
+
+# Roughly today's volume of active ROW permits (scale 1)
+BASE_PERMITS = 1500
+# Segments in the street network, this does not grow with the number of permits
+NETWORK_SEGMENTS = 60000
+
+FOLDERTYPE_MIX = {"DS": 0.5, "EX": 0.3, "RW": 0.2}
+PERMIT_TYPES = {
+    "DS": ["Commercial", "Residential", "Sidewalk Closure", "Lane Closure"],
+    "EX": ["Excavation", "Utility Excavation", "Boring"],
+    "RW": ["Temporary Use of ROW"],
+}
+RW_WORK_DESCRIPTIONS = ["Block Party", "Special Event", "Parade", "Filming"]
+
+# Socrata road_class codes and how common they are in the network
+ROAD_CLASS_MIX = {1: 0.01, 2: 0.02, 4: 0.07, 5: 0.1, 8: 0.15, 9: 0.55, 10: 0.1}
+INSPECTOR_ZONES = 12
+
+# Share of EX permits with both extension dates, and with only a start date
+EX_EXTENSION_SHARE = 0.2
+EX_PARTIAL_EXTENSION_SHARE = 0.03
+# Share of EX permits missing their START_DATE / END_DATE info values
+EX_MISSING_DATES_SHARE = 0.05
+NO_INSPECTION_SHARE = 0.35
+NO_SEGMENT_SHARE = 0.03
+# Share of permit segments which are not in the road segment dataset
+UNKNOWN_SEGMENT_SHARE = 0.02
+DAPCZ_SHARE = 0.04
+
+ORACLE_DATETIME = "%Y-%m-%d %H:%M:%S"
+INFOVALUE_DATE = "%m/%d/%Y"
+
+
+def _choice(rng, mix, size):
+    return rng.choice(list(mix.keys()), size=size, p=list(mix.values()))
+
+
+def _format(dates, fmt, mask=None):
+    """Formats an array of datetime64 as strings, with None where mask is False"""
+    values = pd.Series(pd.to_datetime(dates)).dt.strftime(fmt).to_numpy(dtype=object)
+    if mask is not None:
+        values[~mask] = None
+    return values
+
+
+def generate_segment_dataset(rng, n_segments=NETWORK_SEGMENTS):
+    """
+    Returns records shaped like soda.get() on the road segment dataset: every
+    value is a string and null fields are left out of the record.
+    """
+    segment_ids = rng.choice(np.arange(2_000_000, 3_500_000), n_segments, replace=False)
+    road_class = _choice(rng, ROAD_CLASS_MIX, n_segments)
+    zones = rng.integers(1, INSPECTOR_ZONES + 1, n_segments)
+    has_zone = rng.random(n_segments) > 0.02
+    in_dapcz = rng.random(n_segments) < DAPCZ_SHARE
+
+    records = []
+    for i in range(n_segments):
+        record = {
+            "segment_id": str(segment_ids[i]),
+            "full_street_name": f"{i % 3000} STREET",
+            "road_class": str(road_class[i]),
+        }
+        if has_zone[i]:
+            record["inspector_zone"] = str(zones[i])
+        if in_dapcz[i]:
+            record["dapcz_zone"] = "1"
+        records.append(record)
+    return records
+
+
+def generate_permits(rng, n_permits, segment_ids, today=None):
+    """
+    Returns a (permits, segments) pair of dataframes with the columns of the
+    row_inspector_permit_list and row_inspector_segment_list queries.
+
+    Parameters
+    ----------
+    rng : numpy Generator
+    n_permits (int): number of active permits
+    segment_ids (array): segment IDs in the road segment dataset
+    today (datetime): date the permits are active on, defaults to now
+
+    """
+    today = np.datetime64(today or datetime.datetime.now(), "s")
+    day = np.timedelta64(1, "D")
+    n = n_permits
+
+    foldertype = _choice(rng, FOLDERTYPE_MIX, n)
+    is_rw = foldertype == "RW"
+    is_ds = foldertype == "DS"
+    is_ex = foldertype == "EX"
+    folderrsn = 13_000_000 + rng.choice(np.arange(n * 4), n, replace=False)
+
+    permit_type = np.empty(n, dtype=object)
+    for t, options in PERMIT_TYPES.items():
+        mask = foldertype == t
+        permit_type[mask] = rng.choice(options, mask.sum())
+
+    issue = today - rng.integers(0, 120, n) * day - rng.integers(0, 86400, n).astype(
+        "timedelta64[s]"
+    )
+    duration = np.where(is_rw, rng.integers(1, 4, n), rng.integers(1, 120, n))
+    expiry = issue + duration * day
+    has_expiry = rng.random(n) > 0.01
+
+    # RW permits: event start and total days from folder info
+    event_start = issue + rng.integers(0, 30, n) * day
+
+    # EX permits: start/end dates and the occasional extension
+    start = issue + rng.integers(0, 5, n) * day
+    end = start + rng.integers(1, 90, n) * day
+    has_dates = is_ex & (rng.random(n) > EX_MISSING_DATES_SHARE)
+    extension_roll = rng.random(n)
+    has_extension = is_ex & (extension_roll < EX_EXTENSION_SHARE)
+    has_partial_extension = is_ex & (
+        (extension_roll >= EX_EXTENSION_SHARE)
+        & (extension_roll < EX_EXTENSION_SHARE + EX_PARTIAL_EXTENSION_SHARE)
+    )
+    extension_start = end + rng.integers(0, 3, n) * day
+    extension_end = extension_start + rng.integers(1, 60, n) * day
+
+    inspected = rng.random(n) > NO_INSPECTION_SHARE
+    inspection = today - rng.integers(0, 60 * 86400, n).astype("timedelta64[s]")
+
+    total_days = np.where(is_rw, duration, 0).astype(object)
+    total_days[~is_rw] = None
+    wz_duration = np.where(has_expiry, duration, np.nan)
+
+    permits = pd.DataFrame(
+        {
+            "PERMIT_TYPE": permit_type,
+            "FOLDERTYPE": foldertype,
+            "PERMIT": [f"2024-{rsn % 1_000_000:06d} {t}" for rsn, t in zip(folderrsn, foldertype)],
+            "FOLDERRSN": folderrsn,
+            "FOLDER_NAME": [f"{rsn % 9000} MAIN ST" for rsn in folderrsn],
+            "PROPERTY_NAME": [f"{rsn % 9000} MAIN ST" for rsn in folderrsn],
+            "EXPIRY_DATE": _format(expiry, ORACLE_DATETIME, has_expiry),
+            "ISSUE_DATE": _format(issue, ORACLE_DATETIME),
+            "CONTRACTOR": [f"Contractor {rsn % 400}" for rsn in folderrsn],
+            "PHONE": [f"512555{rsn % 10000:04d}" for rsn in folderrsn],
+            "RW_WORK_DESCRIPTION": np.where(
+                is_rw, rng.choice(RW_WORK_DESCRIPTIONS, n), None
+            ),
+            "WZ_DURATION": wz_duration,
+            "TOTAL_DAYS": total_days,
+            "EVENT_START_DATE": _format(event_start, INFOVALUE_DATE, is_rw),
+            "START_DATE": _format(start, INFOVALUE_DATE, has_dates),
+            "EXTENSION_START_DATE": _format(
+                extension_start, INFOVALUE_DATE, has_extension | has_partial_extension
+            ),
+            "EXTENSION_END_DATE": _format(extension_end, INFOVALUE_DATE, has_extension),
+            "END_DATE": _format(end, INFOVALUE_DATE, has_dates),
+            "COUNT_DEFICIENCIES": np.where(
+                is_ds | is_ex, rng.poisson(0.3, n), 0
+            ),
+            "MOST_RECENT_INSPECTION": _format(inspection, ORACLE_DATETIME, inspected),
+        }
+    )
+
+    # Most permits cover a single segment, a few long closures cover dozens
+    counts = np.minimum(rng.geometric(0.45, n), 60)
+    counts[rng.random(n) < NO_SEGMENT_SHARE] = 0
+    segment_rsn = np.repeat(folderrsn, counts)
+    property_rsn = rng.choice(segment_ids, len(segment_rsn))
+    unknown = rng.random(len(segment_rsn)) < UNKNOWN_SEGMENT_SHARE
+    property_rsn[unknown] = rng.integers(9_000_000, 9_500_000, unknown.sum())
+    first = np.r_[0, np.cumsum(counts)[:-1]][counts > 0]
+    is_primary = np.full(len(segment_rsn), "FALSE", dtype=object)
+    is_primary[first] = "TRUE"
+
+    segments = pd.DataFrame(
+        {
+            "FOLDERRSN": segment_rsn,
+            "PROPERTYRSN": property_rsn,
+            "IS_PRIMARY": is_primary,
+        }
+    )
+    return permits, segments
+
+
+def generate(scale=1, seed=0, today=None):
+    """
+    Returns synthetic (permits, segments, segment_records) at a multiple of
+    today's permit volume.
+    """
+    rng = np.random.default_rng(seed)
+    segment_records = generate_segment_dataset(rng)
+    segment_ids = np.array([int(r["segment_id"]) for r in segment_records])
+    permits, segments = generate_permits(
+        rng, int(BASE_PERMITS * scale), segment_ids, today=today
+    )
+    return permits, segments, segment_records
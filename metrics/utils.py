@@ -1,6 +1,7 @@
 import logging
 import sys
-import pandas as pd
+
+from schemas import apply_schema, csv_dtypes, to_socrata_records
 
 
 def get_logger(name, level):
@@ -14,13 +15,32 @@ def get_logger(name, level):
     return logger
 
 
-def s3_csv_to_df(s3, bucket, filename):
-    """Returns a pandas dataframe from a CSV stored in an S3 bucket"""
+def s3_csv_to_df(s3, bucket, filename, schema=None):
+    """
+    Returns a pandas dataframe from a CSV stored in an S3 bucket, with the column
+    types declared in schema (see schemas.py) when one is given
+    """
+    import pandas as pd
+
     response = s3.get_object(Bucket=bucket, Key=filename)
-    return pd.read_csv(response.get("Body"))
+    if schema is None:
+        return pd.read_csv(response.get("Body"))
+    df = pd.read_csv(response.get("Body"), dtype=csv_dtypes(schema))
+    return apply_schema(df, schema)
+
+
+def load_csv(s3, bucket, filename, frames=None, schema=None):
+    """
+    Returns the dataframe an earlier pipeline stage handed over for this file in
+    frames, or reads the CSV from the S3 bucket when it wasn't passed in memory.
+    """
+    if frames and filename in frames:
+        df = frames[filename].copy()
+        return apply_schema(df, schema) if schema else df
+    return s3_csv_to_df(s3, bucket, filename, schema)
 
 
-def df_to_socrata_dataset(soda, dataset_id, df, method="upsert"):
+def df_to_socrata_dataset(soda, dataset_id, df, method="upsert", schema=None):
     """
     Upserts the data in the socrata dataset with data in the dataframe. Must have a row identifier created.
 
@@ -30,9 +50,10 @@ def df_to_socrata_dataset(soda, dataset_id, df, method="upsert"):
     dataset_id: resource ID of the dataset
     soda: sodapy client object
     df : Pandas Dataframe
+    schema (dict): column types used to serialize the rows, see schemas.to_socrata_records
 
     """
-    payload = df.to_dict("records")
+    payload = to_socrata_records(df, schema)
     if method == "replace":
         response = soda.replace(dataset_id, payload)
     else:
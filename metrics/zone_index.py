@@ -0,0 +1,247 @@
+"""
+In-memory spatial index of the ROW inspector zone and DAPCZ polygons. The zones are
+downloaded once per run and roadway segments are tagged locally with a single
+STRtree spatial join instead of two AGOL queries per segment.
+
+The zone layers rarely change, so their polygons are also kept in the tagging run's
+state store (next to the segment index, see checkpoint.py) and only downloaded again
+when the layer's lastEditDate changes. When they do change, the stored polygons are
+compared with the new ones to find the area that needs retagging.
+"""
+import numpy as np
+import shapely
+from shapely.geometry import LineString, MultiLineString, Point, Polygon
+
+from functools import reduce
+import io
+import json
+
+
+def esri_to_shapely(geometry):
+    """
+    Converts an Esri JSON geometry (dict or arcgis Geometry) to a shapely geometry.
+    Polygon rings are combined with the even-odd rule so holes are kept.
+
+    Returns None for empty or missing geometries.
+    """
+    if not isinstance(geometry, dict) or not geometry:
+        return None
+    if geometry.get("rings"):
+        rings = [shapely.make_valid(Polygon(ring)) for ring in geometry["rings"]]
+        return reduce(lambda a, b: a.symmetric_difference(b), rings)
+    if geometry.get("paths"):
+        paths = geometry["paths"]
+        if len(paths) == 1:
+            return LineString(paths[0])
+        return MultiLineString(paths)
+    if "x" in geometry and geometry["x"] is not None:
+        return Point(geometry["x"], geometry["y"])
+    return None
+
+
+class ZoneLayer:
+    """
+    The polygons and ID attribute of one zone feature layer, ordered by OBJECTID
+    like the AGOL query responses were.
+
+    Parameters
+    ----------
+    name (str): name of the tag this layer produces, ex: INSPECTOR_ZONE
+    ids (list): zone ID attribute for each polygon
+    geometries (list): shapely polygons
+    cache_key (str): version of the AGOL layer the polygons came from, see layer_cache_key
+
+    """
+
+    def __init__(self, name, ids, geometries, cache_key=None):
+        self.name = name
+        self.ids = np.asarray(ids, dtype=object)
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.cache_key = cache_key
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_feature_layer(cls, name, layer, id_field, out_sr):
+        """Downloads every polygon of an AGOL feature layer in one query"""
+        response = layer.query(
+            where="1=1",
+            out_fields=id_field,
+            return_geometry=True,
+            out_sr=out_sr,
+            order_by_fields="OBJECTID",
+        )
+        ids = []
+        geometries = []
+        for feature in response.features:
+            ids.append(feature.attributes[id_field])
+            geometries.append(esri_to_shapely(feature.geometry))
+        return cls(name, ids, geometries)
+
+    def save(self, store):
+        """
+        Writes the layer to a state store as an .npz file: the polygons as
+        concatenated WKB with their offsets, and the zone IDs as JSON.
+        """
+        wkb = [shapely.to_wkb(g) if g is not None else b"" for g in self.geometries]
+        offsets = np.cumsum([0] + [len(w) for w in wkb])
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            cache_key=np.array(self.cache_key or ""),
+            ids=np.array(json.dumps(self.ids.tolist())),
+            offsets=offsets.astype(np.int64),
+            wkb=np.frombuffer(b"".join(wkb), dtype=np.uint8),
+        )
+        store.write(buffer.getvalue())
+
+    @classmethod
+    def load(cls, name, store):
+        """Reads a layer written by save(), returns None if the store has none"""
+        saved = store.read()
+        if saved is None:
+            return None
+        with np.load(io.BytesIO(saved), allow_pickle=False) as data:
+            cache_key = str(data["cache_key"])
+            ids = json.loads(str(data["ids"]))
+            offsets = data["offsets"]
+            wkb = data["wkb"].tobytes()
+        geometries = [
+            shapely.from_wkb(wkb[start:end]) if end > start else None
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+        return cls(name, ids, geometries, cache_key=cache_key or None)
+
+
+def layer_cache_key(layer, id_field, out_sr):
+    """
+    Returns a key identifying the current version of a feature layer, built from
+    its serviceItemId and editingInfo.lastEditDate with one metadata request.
+    Returns None when the layer doesn't track edits and can't be cached.
+    """
+    properties = layer.properties
+    editing_info = properties.get("editingInfo") or {}
+    last_edit = editing_info.get("lastEditDate")
+    if last_edit is None:
+        return None
+    return f"{properties.get('serviceItemId')}:{last_edit}:{id_field}:{out_sr}"
+
+
+def zone_state_name(name):
+    """Returns the name a zone layer is saved under in its state store"""
+    return f"{name}.npz"
+
+
+def load_zone_layer(name, layer, id_field, out_sr, store):
+    """
+    Returns the ZoneLayer for an AGOL feature layer from its state store when the
+    layer hasn't been edited since it was saved, downloading it otherwise.
+
+    New downloads are not saved here, call save() once the segments affected by
+    the change have been retagged.
+
+    Returns
+    -------
+    zone_layer - the current ZoneLayer
+    previous - the stale saved ZoneLayer if the AGOL layer was edited since, None otherwise
+
+    """
+    cache_key = layer_cache_key(layer, id_field, out_sr)
+    cached = ZoneLayer.load(name, store)
+    if cached is not None and cache_key is not None and cached.cache_key == cache_key:
+        return cached, None
+
+    zone_layer = ZoneLayer.from_feature_layer(name, layer, id_field, out_sr)
+    zone_layer.cache_key = cache_key
+    return zone_layer, cached
+
+
+def changed_area(previous, current):
+    """
+    Returns the area where the zones of two versions of a layer differ: the
+    symmetric difference of each zone's old and new polygon, plus the whole
+    polygon of added or removed zones. None if no zone changed.
+    """
+    old = {}
+    for zone_id, geometry in zip(previous.ids, previous.geometries):
+        old.setdefault(zone_id, geometry)
+    new = {}
+    for zone_id, geometry in zip(current.ids, current.geometries):
+        new.setdefault(zone_id, geometry)
+
+    changes = []
+    for zone_id in set(old) | set(new):
+        before, after = old.get(zone_id), new.get(zone_id)
+        if before is None or after is None:
+            changes.append(before if after is None else after)
+        elif shapely.to_wkb(before) != shapely.to_wkb(after):
+            changes.append(before.symmetric_difference(after))
+    changes = [g for g in changes if g is not None and not g.is_empty]
+    if not changes:
+        return None
+    return shapely.union_all(changes)
+
+
+class ZoneIndex:
+    """
+    One STRtree over the polygons of several zone layers so every tag for a set
+    of segments comes out of a single spatial join.
+
+    Parameters
+    ----------
+    layers (list of ZoneLayer)
+
+    """
+
+    def __init__(self, layers):
+        self.layers = layers
+        self.layer_of = np.concatenate(
+            [np.full(len(layer), i) for i, layer in enumerate(layers)]
+        ).astype(np.int64)
+        self.ids = np.concatenate([layer.ids for layer in layers])
+        self.tree = shapely.STRtree(
+            np.concatenate([layer.geometries for layer in layers])
+        )
+
+    def tag(self, geometries):
+        """
+        Tags each geometry with the first zone (by OBJECTID) it intersects in
+        every layer. If a segment is in multiple zones, only the first one is used.
+
+        Parameters
+        ----------
+        geometries (array of shapely geometries): the segments to tag
+
+        Returns
+        -------
+        dict of layer name to an array with the zone ID for each geometry, or None
+
+        """
+        geometries = np.asarray(geometries, dtype=object)
+        tags = {
+            layer.name: np.full(len(geometries), None, dtype=object)
+            for layer in self.layers
+        }
+        if not len(geometries):
+            return tags
+
+        # The tree does a bounding box prefilter before the exact intersects test
+        segment_idx, zone_idx = self.tree.query(geometries, predicate="intersects")
+        layer_idx = self.layer_of[zone_idx]
+        # Tree indices follow the OBJECTID order of each layer, so the first
+        # match for a segment within a layer is the lowest OBJECTID.
+        order = np.lexsort((zone_idx, layer_idx, segment_idx))
+        segment_idx, zone_idx, layer_idx = (
+            segment_idx[order],
+            zone_idx[order],
+            layer_idx[order],
+        )
+        first = np.ones(len(segment_idx), dtype=bool)
+        first[1:] = (segment_idx[1:] != segment_idx[:-1]) | (
+            layer_idx[1:] != layer_idx[:-1]
+        )
+        for i, layer in enumerate(self.layers):
+            match = first & (layer_idx == i)
+            tags[layer.name][segment_idx[match]] = self.ids[zone_idx[match]]
+        return tags
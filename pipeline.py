@@ -0,0 +1,349 @@
+"""
+Runs the nightly ROW reporting jobs in one process.
+
+Each stage declares the stages it depends on, and stages whose dependencies are
+done run at the same time. The CSVs a stage uploads to S3 are also handed to the
+stages that depend on it in memory, so they aren't downloaded again. The AMANDA
+connection pool and the S3, Socrata and Smartsheet clients are shared by every stage,
+and their calls are traced when TRACE_DIR is set, see shared/tracing.py.
+"""
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import importlib
+import importlib.util
+from io import StringIO
+import logging
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Modules used by the scripts of every directory (profiling, tracing, storage)
+SHARED = os.path.join(ROOT, "shared")
+if SHARED not in sys.path:
+    sys.path.append(SHARED)
+
+# Queries run against AMANDA at the same time, also the size of the connection pool
+AMANDA_CONCURRENCY = 4
+
+logger = logging.getLogger(__name__)
+
+
+def load_modules(directory, names):
+    """
+    Imports scripts from one of the subdirectories. Each script is loaded from its
+    file under a name qualified by its directory (ex: metrics.row_data_summary), and
+    so are the siblings it imports with flat imports (utils, config, ...), whose names
+    are reused across directories. The flat names are only bound while the
+    directory is imported, so the scripts import their siblings at module level. The
+    modules in shared/ are on sys.path and imported once by every directory.
+
+    Returns
+    -------
+    dict of script name to module
+
+    """
+    path = os.path.join(ROOT, directory)
+    loaded = set(sys.modules)
+    sys.path.insert(0, path)
+    try:
+        modules = {}
+        for name in names:
+            # A script a sibling already imported is reused, not loaded twice
+            module = sys.modules.get(name)
+            if module is None:
+                spec = importlib.util.spec_from_file_location(
+                    f"{directory}.{name}", os.path.join(path, f"{name}.py")
+                )
+                module = importlib.util.module_from_spec(spec)
+                # Also bound to its flat name, for the siblings loaded after it
+                sys.modules[spec.name] = sys.modules[name] = module
+                spec.loader.exec_module(module)
+            modules[name] = module
+        return modules
+    finally:
+        sys.path.remove(path)
+        # Siblings move to their directory-qualified names, the next directory's
+        # flat imports of the same names get its own modules
+        for name in set(sys.modules) - loaded:
+            module = sys.modules[name]
+            if "." in name or os.path.dirname(getattr(module, "__file__", None) or "") != path:
+                continue
+            sys.modules.setdefault(f"{directory}.{name}", sys.modules.pop(name))
+
+
+class Context:
+    """
+    Clients shared by the stages of a run and the files uploaded so far.
+
+    Parameters
+    ----------
+    modules (dict): the scripts by name, see load_modules
+    tracer (tracing.Tracer): traces the calls made with the shared clients
+
+    """
+
+    def __init__(self, modules, tracer, refresh=False):
+        self.modules = modules
+        self.refresh = refresh
+        self.tracing = modules["tracing"]
+        self.tracer = tracer
+        self.frames = {}
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def client(self, name, factory):
+        # Clients are created the first time a stage needs them
+        with self._lock:
+            if name not in self._clients:
+                self._clients[name] = factory()
+            return self._clients[name]
+
+    @property
+    def s3(self):
+        amanda = self.modules["amanda_to_s3"]
+        return self.client(
+            "s3",
+            lambda: self.tracing.trace_s3(amanda.get_s3_client(), self.tracer),
+        )
+
+    @property
+    def amanda_pool(self):
+        amanda = self.modules["amanda_to_s3"]
+        return self.client("amanda", lambda: amanda.get_pool(AMANDA_CONCURRENCY))
+
+    @property
+    def soda(self):
+        from sodapy import Socrata
+
+        metrics = self.modules["row_data_summary"]
+        return self.client(
+            "soda",
+            lambda: self.tracing.trace_socrata(
+                self.modules["rate_limit"].limit_socrata(
+                    Socrata(
+                        metrics.SO_WEB,
+                        metrics.SO_TOKEN,
+                        username=metrics.SO_KEY,
+                        password=metrics.SO_SECRET,
+                        timeout=500,
+                    )
+                ),
+                self.tracer,
+            ),
+        )
+
+    @property
+    def result_cache(self):
+        amanda = self.modules["amanda_to_s3"]
+        s3 = self.s3
+        return self.client(
+            "result_cache",
+            lambda: amanda.get_result_cache("local", s3, self.refresh),
+        )
+
+    @property
+    def smartsheet(self):
+        import smartsheet
+
+        return self.client(
+            "smartsheet",
+            lambda: self.tracing.trace_smartsheet(smartsheet.Smartsheet(), self.tracer),
+        )
+
+    def add_files(self, files):
+        """Keeps the CSVs a stage uploaded as dataframes for the stages after it"""
+        import pandas as pd
+
+        frames = {name: pd.read_csv(StringIO(csv)) for name, csv in files.items()}
+        with self._lock:
+            self.frames.update(frames)
+
+    def files(self):
+        with self._lock:
+            return dict(self.frames)
+
+    def close(self):
+        if "amanda" in self._clients:
+            self._clients["amanda"].close()
+
+
+def query_stage(query):
+    """
+    Returns a stage that runs an AMANDA query and uploads the result to S3, the
+    result is served from the query result cache within the query's cache_ttl
+    """
+
+    def run(context):
+        amanda = context.modules["amanda_to_s3"]
+
+        def connect():
+            conn = context.amanda_pool.acquire()
+            return context.tracing.trace_oracle(conn, context.tracer)
+
+        csv = amanda.query_csv(connect, query, context.result_cache)
+        return {f"{query}.csv": amanda.csv_to_s3(csv, context.s3, query)}
+
+    return run
+
+
+def smartsheet_stage(context):
+    sheets = context.modules["smartsheet_to_s3"]
+    profiler = sheets.Profiler("smartsheet_to_s3")
+    return sheets.sync_sheets(context.smartsheet, context.s3, profiler)
+
+
+def row_data_summary_stage(context):
+    summary = context.modules["row_data_summary"]
+    profiler = summary.Profiler("row_data_summary")
+    summary.publish_weekly_summary(
+        context.s3, context.soda, profiler, frames=context.files()
+    )
+    return {}
+
+
+def inspector_prioritization_stage(context):
+    prioritization = context.modules["inspector_prioritization"]
+    profiler = prioritization.Profiler("inspector_prioritization")
+    prioritization.prioritize_permits(
+        context.s3, context.soda, profiler, frames=context.files()
+    )
+    return {}
+
+
+STAGES = {
+    "applications_received": {"run": query_stage("applications_received")},
+    "issued_permits": {"run": query_stage("issued_permits")},
+    "row_inspector_permit_list": {"run": query_stage("row_inspector_permit_list")},
+    "row_inspector_segment_list": {"run": query_stage("row_inspector_segment_list")},
+    "smartsheet": {"run": smartsheet_stage},
+    "row_data_summary": {
+        "run": row_data_summary_stage,
+        "depends": ["applications_received", "issued_permits", "smartsheet"],
+    },
+    "inspector_prioritization": {
+        "run": inspector_prioritization_stage,
+        "depends": ["row_inspector_permit_list", "row_inspector_segment_list"],
+    },
+}
+
+
+def with_dependencies(names):
+    # Returns the stages to run for the requested ones, including everything they depend on
+    selected = set()
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo.extend(STAGES[name].get("depends", []))
+    return selected
+
+
+def run_stage(name, context):
+    start = time.perf_counter()
+    logger.info(f"Starting {name}")
+    files = STAGES[name]["run"](context)
+    context.add_files(files)
+    logger.info(f"Finished {name} in {time.perf_counter() - start:.1f}s")
+
+
+def run_pipeline(names, context, concurrency):
+    """
+    Runs the stages as soon as their dependencies are done. Stages that depend
+    on a failed stage are skipped.
+
+    Returns
+    -------
+    set of the stages that failed or were skipped
+
+    """
+    pending = set(names)
+    done = set()
+    failed = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while pending or running:
+            for name in sorted(pending):
+                depends = STAGES[name].get("depends", [])
+                if any(d in failed for d in depends):
+                    logger.error(f"Skipping {name}, a stage it depends on failed")
+                    pending.remove(name)
+                    failed.add(name)
+                elif all(d in done for d in depends):
+                    pending.remove(name)
+                    running[executor.submit(run_stage, name, context)] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception:
+                    logger.exception(f"{name} failed")
+                    failed.add(name)
+    return failed
+
+
+def log_to_stdout():
+    # Same format as utils.get_logger, on the root logger so every stage's logger uses it
+    handler = logging.StreamHandler(stream=sys.stdout)
+    handler.setFormatter(logging.Formatter(fmt="%(asctime)s %(levelname)s: %(message)s"))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.INFO)
+
+
+def main(args):
+    modules = {
+        **load_modules("amanda", ["amanda_to_s3"]),
+        **load_modules("smartsheet", ["smartsheet_to_s3"]),
+        **load_modules(
+            "metrics", ["row_data_summary", "inspector_prioritization", "rate_limit"]
+        ),
+        # shared/ is on sys.path, the scripts above already imported it by its flat name
+        "tracing": importlib.import_module("tracing"),
+    }
+    names = with_dependencies(args.stages or list(STAGES))
+    with modules["tracing"].Tracer("pipeline") as tracer:
+        context = Context(modules, tracer, args.refresh)
+        try:
+            failed = run_pipeline(names, context, args.concurrency)
+        finally:
+            context.close()
+    if failed:
+        logger.error(f"Failed stages: {', '.join(sorted(failed))}")
+        sys.exit(1)
+
+
+# CLI argument definition
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "--stage",
+    action="append",
+    dest="stages",
+    choices=list(STAGES),
+    help="Stage to run along with the stages it depends on, can be repeated. Runs every stage by default",
+)
+
+parser.add_argument(
+    "--concurrency",
+    type=int,
+    default=4,
+    help="Number of stages run at the same time",
+)
+
+parser.add_argument(
+    "--refresh",
+    action="store_true",
+    help="Run the AMANDA queries even if their cached results are still fresh",
+)
+
+if __name__ == "__main__":
+    log_to_stdout()
+    args = parser.parse_args()
+    main(args)
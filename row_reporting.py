@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Single entry point for the ROW reporting scripts:
+
+row-reporting <command> [arguments of the command]
+
+Only the module of the command that is run gets imported, and the scripts import
+their heavy dependencies (pandas, boto3, sodapy, oracledb, arcgis) in the functions
+that use them, so importing a command (or its --help) doesn't pay for them.
+"""
+import argparse
+import importlib
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+
+# Modules used by the scripts of every directory (profiling, tracing, storage)
+SHARED = os.path.join(ROOT, "shared")
+
+# Command name to the directory its script is in
+COMMANDS = {
+    "amanda_to_s3": "amanda",
+    "extraction_service": "amanda",
+    "calibrate_fetch": "amanda",
+    "smartsheet_to_s3": "smartsheet",
+    "active_permits_logging": "metrics",
+    "row_data_summary": "metrics",
+    "s3_to_socrata": "metrics",
+    "inspector_prioritization": "metrics",
+    "roadway_segment_tagging": "metrics",
+    "benchmark_inspector_prioritization": "metrics",
+    "pipeline": "",
+}
+
+logger = logging.getLogger(__name__)
+
+
+def log_to_stdout():
+    # Same format as utils.get_logger, on the root logger so the command's logger uses it
+    handler = logging.StreamHandler(stream=sys.stdout)
+    handler.setFormatter(logging.Formatter(fmt="%(asctime)s %(levelname)s: %(message)s"))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.INFO)
+
+
+def import_command(command):
+    """
+    Imports the script of a command, its directory is put first on sys.path for
+    the flat imports of its sibling modules, followed by the shared modules.
+
+    Returns
+    -------
+    module - the imported script
+    seconds (float): time it took to import the script and its dependencies
+    modules (int): number of modules that were imported
+
+    """
+    sys.path[:0] = [os.path.join(ROOT, COMMANDS[command]), SHARED]
+    loaded = len(sys.modules)
+    start = time.perf_counter()
+    module = importlib.import_module(command)
+    return module, time.perf_counter() - start, len(sys.modules) - loaded
+
+
+def main(args):
+    module, seconds, modules = import_command(args.command)
+    if args.import_time:
+        logger.info(f"Imported {args.command} and {modules} modules in {seconds:.3f}s")
+    module.main(module.parser.parse_args(args.arguments))
+
+
+# CLI argument definition
+parser = argparse.ArgumentParser(prog="row-reporting")
+
+parser.add_argument(
+    "--import-time",
+    action="store_true",
+    help="Log how long it took to import the command",
+)
+
+parser.add_argument("command", choices=list(COMMANDS))
+
+parser.add_argument(
+    "arguments",
+    nargs=argparse.REMAINDER,
+    help="Arguments passed on to the command, see row-reporting <command> --help",
+)
+
+if __name__ == "__main__":
+    log_to_stdout()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,223 @@
+"""
+Run profiling shared by the ROW reporting scripts.
+
+Wraps the named stages of a run (download, transform, score, publish) and
+records wall time and tracemalloc peak memory for each, optionally with
+cProfile stats. Everything ends up in one JSON report per run.
+"""
+
+import atexit
+import cProfile
+import datetime
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Number of functions kept from each stage's cProfile stats in the report
+TOP_FUNCTIONS = 25
+
+# tracemalloc is global to the process, so the peak is shared by the stages of every
+# Profiler (pipeline.py runs several on threads). Before the peak is reset for a new
+# stage, it is kept by every stage still open.
+_memory_lock = threading.Lock()
+_open_stages = []
+
+
+def _start_tracing():
+    # Called with _memory_lock held. Tracing runs until the process exits, a Profiler
+    # finishing doesn't stop it for the others
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        atexit.register(tracemalloc.stop)
+
+
+def _reset_peak():
+    # Called with _memory_lock held
+    _, peak = tracemalloc.get_traced_memory()
+    for frame in _open_stages:
+        frame["peak"] = max(frame["peak"], peak)
+    tracemalloc.reset_peak()
+
+
+def reset_memory_peak():
+    """
+    Resets the tracemalloc peak for code that measures its own peak while a Profiler
+    may be tracing, without losing the peak of the Profiler stages still open.
+    """
+    with _memory_lock:
+        _reset_peak()
+
+
+def add_profile_arguments(parser):
+    """Adds the --profile and --cprofile flags to an argparse parser"""
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Record stage timings and peak memory to a JSON report in PROFILE_DIR",
+    )
+    parser.add_argument(
+        "--cprofile",
+        action="store_true",
+        help="Also collect cProfile stats for each stage (implies --profile)",
+    )
+
+
+class Profiler:
+    """
+    Collects stage timings for one run of a script. When disabled, stage() is a
+    no-op so the scripts can always wrap their stages.
+
+    Parameters
+    ----------
+    script (str): name of the script, used in the report and its file name
+    enabled (bool): record stages and write a report
+    cprofile (bool): collect cProfile stats for each top level stage
+    output_dir (str): directory the report and .prof files are written to
+
+    """
+
+    def __init__(self, script, enabled=False, cprofile=False, output_dir=PROFILE_DIR):
+        self.script = script
+        self.enabled = enabled or cprofile
+        self.cprofile = cprofile
+        self.output_dir = output_dir
+        self.started_at = datetime.datetime.now()
+        self.stages = []
+        self.report_path = None
+        self._start = time.perf_counter()
+        self._stack = []
+
+    @classmethod
+    def from_args(cls, script, args):
+        return cls(
+            script,
+            enabled=getattr(args, "profile", False),
+            cprofile=getattr(args, "cprofile", False),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.write_report(error=exc)
+        return False
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """
+        Times the wrapped block as a named stage. Stages may be nested, a
+        parent's peak memory includes its children. The peak is the process's, so
+        stages running at the same time on other threads count towards it.
+
+        Parameters
+        ----------
+        name (str): stage name, ex: download, transform, score, publish
+        labels: extra values stored with the stage, ex: sheet="Residential DS Permits"
+
+        """
+        if not self.enabled:
+            yield
+            return
+
+        record = {"name": name, **labels}
+        with _memory_lock:
+            _start_tracing()
+            _reset_peak()
+            memory_start, _ = tracemalloc.get_traced_memory()
+            frame = {"peak": memory_start, "profile": None}
+            _open_stages.append(frame)
+        if self.cprofile and not self._stack:
+            frame["profile"] = cProfile.Profile()
+            frame["profile"].enable()
+        self._stack.append(frame)
+
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            record["error"] = repr(e)
+            raise
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 6)
+            with _memory_lock:
+                memory_end, peak = tracemalloc.get_traced_memory()
+                _open_stages.remove(frame)
+            self._stack.remove(frame)
+            # The peak since the last reset is also seen by the stages still open,
+            # including the parent, so nothing needs to be handed to them
+            record["peak_memory_bytes"] = max(peak, frame["peak"])
+            record["net_memory_bytes"] = memory_end - memory_start
+            if frame["profile"] is not None:
+                frame["profile"].disable()
+                record.update(self._profile_output(frame["profile"], name))
+            self.stages.append(record)
+
+    def _profile_output(self, profile, name):
+        """Dumps the raw .prof file and returns the top functions for the report"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        index = sum(1 for s in self.stages if "cprofile_path" in s)
+        path = os.path.join(self.output_dir, f"{self._file_stem()}-{index}-{name}.prof")
+        profile.dump_stats(path)
+
+        stats = pstats.Stats(profile, stream=io.StringIO())
+        stats.sort_stats(pstats.SortKey.CUMULATIVE)
+        top = []
+        for func in stats.fcn_list[:TOP_FUNCTIONS]:
+            calls, primitive_calls, tottime, cumtime, _ = stats.stats[func]
+            filename, line, function = func
+            top.append(
+                {
+                    "function": f"{filename}:{line}({function})",
+                    "ncalls": calls,
+                    "tottime": round(tottime, 6),
+                    "cumtime": round(cumtime, 6),
+                }
+            )
+        return {"cprofile_path": path, "top_functions": top}
+
+    def _file_stem(self):
+        return f"{self.script}-{self.started_at.strftime('%Y%m%dT%H%M%S')}"
+
+    def report(self):
+        """Returns the run report as a dict"""
+        totals = {}
+        for s in self.stages:
+            total = totals.setdefault(
+                s["name"], {"count": 0, "seconds": 0.0, "peak_memory_bytes": 0}
+            )
+            total["count"] += 1
+            total["seconds"] = round(total["seconds"] + s["seconds"], 6)
+            total["peak_memory_bytes"] = max(
+                total["peak_memory_bytes"], s["peak_memory_bytes"]
+            )
+        return {
+            "script": self.script,
+            "started_at": self.started_at.isoformat(),
+            "total_seconds": round(time.perf_counter() - self._start, 6),
+            "stages": self.stages,
+            "totals": totals,
+        }
+
+    def write_report(self, error=None):
+        """
+        Writes the JSON report to the output directory, returns its path or
+        None when profiling is disabled.
+        """
+        if not self.enabled:
+            return None
+        report = self.report()
+        if error is not None:
+            report["error"] = repr(error)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.report_path = os.path.join(self.output_dir, f"{self._file_stem()}.json")
+        with open(self.report_path, "w") as f:
+            json.dump(report, f, indent=2)
+        return self.report_path
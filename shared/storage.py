@@ -0,0 +1,28 @@
+"""
+Local files shared by the ROW reporting scripts: CACHE_DIR, where caches and state
+kept between runs live, and atomic_write for the files other processes read.
+"""
+
+from contextlib import contextmanager
+import os
+
+# Local directory for caches and state kept between runs
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+
+
+@contextmanager
+def atomic_write(path, mode="wb"):
+    """
+    Opens a temporary file next to path and moves it in place once the block is
+    done, so readers never see half a file. The directory is created if needed and
+    the temporary file is removed if the block fails.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, mode) as f:
+            yield f
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
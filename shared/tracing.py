@@ -0,0 +1,420 @@
+"""
+I/O tracing shared by the ROW reporting scripts.
+
+Every call to a remote service (Oracle, S3, Socrata, AGOL, Smartsheet) made through
+a traced client is recorded as a span with its duration, bytes sent and received,
+row count and retries. At the end of a run the spans are appended to a JSON lines
+file and summed per service and operation in a Prometheus textfile, both in
+TRACE_DIR. Tracing is off when TRACE_DIR isn't set and the trace_* functions then
+return the clients unchanged.
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from storage import atomic_write
+
+TRACE_DIR = os.getenv("TRACE_DIR")
+
+# Spans of every run are appended to this file in TRACE_DIR
+SPANS_FILE = "spans.jsonl"
+
+# Tracer of the current run, used by the trace_* functions when none is passed
+_active = None
+
+
+class Span:
+    """One call to a remote service"""
+
+    def __init__(self, service, operation, **attributes):
+        self.service = service
+        self.operation = operation
+        self.attributes = attributes
+        self.started_at = datetime.datetime.now()
+        self.seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.rows = 0
+        self.retries = 0
+        self.error = None
+
+    def add(self, bytes_in=0, bytes_out=0, rows=0, retries=0):
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.rows += rows
+        self.retries += retries
+
+    def to_dict(self):
+        return {
+            "service": self.service,
+            "operation": self.operation,
+            "started_at": self.started_at.isoformat(),
+            "seconds": round(self.seconds, 6),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "rows": self.rows,
+            "retries": self.retries,
+            "error": self.error,
+            **self.attributes,
+        }
+
+
+class Tracer:
+    """
+    Collects the spans of one run of a script.
+
+    Parameters
+    ----------
+    script (str): name of the script, stored with each span and used as the textfile name
+    output_dir (str): directory the spans and textfile are written to, tracing is off if None
+
+    """
+
+    def __init__(self, script, output_dir=TRACE_DIR):
+        self.script = script
+        self.output_dir = output_dir
+        self.enabled = output_dir is not None
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._previous = None
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        _active = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        global _active
+        _active = self._previous
+        self.export()
+        return False
+
+    @contextmanager
+    def span(self, service, operation, **attributes):
+        """Records the wrapped block as a call to a service, yields the Span to add counts to"""
+        span = Span(service, operation, **attributes)
+        stack = self._stack()
+        stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                self.spans.append(span)
+
+    def current(self):
+        """Returns the innermost open span of this thread, or None"""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def totals(self):
+        """Sums the spans by service and operation"""
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(
+                (span.service, span.operation),
+                {
+                    "calls": 0,
+                    "errors": 0,
+                    "seconds": 0.0,
+                    "bytes_in": 0,
+                    "bytes_out": 0,
+                    "rows": 0,
+                    "retries": 0,
+                },
+            )
+            total["calls"] += 1
+            total["errors"] += span.error is not None
+            total["seconds"] += span.seconds
+            total["bytes_in"] += span.bytes_in
+            total["bytes_out"] += span.bytes_out
+            total["rows"] += span.rows
+            total["retries"] += span.retries
+        return totals
+
+    def export(self):
+        """Appends the spans to the JSON lines file and writes the Prometheus textfile"""
+        if not self.enabled:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, SPANS_FILE), "a") as f:
+            for span in self.spans:
+                f.write(json.dumps({"script": self.script, **span.to_dict()}) + "\n")
+
+        lines = []
+        metrics = ["calls", "errors", "seconds", "bytes_in", "bytes_out", "rows", "retries"]
+        totals = self.totals()
+        for metric in metrics:
+            name = f"row_reporting_remote_{metric}"
+            lines.append(f"# HELP {name} Remote {metric} of the last run by service and operation")
+            lines.append(f"# TYPE {name} gauge")
+            for (service, operation), total in sorted(totals.items()):
+                labels = f'script="{self.script}",service="{service}",operation="{operation}"'
+                lines.append(f"{name}{{{labels}}} {total[metric]}")
+        lines.append("# TYPE row_reporting_last_run_timestamp_seconds gauge")
+        lines.append(
+            f'row_reporting_last_run_timestamp_seconds{{script="{self.script}"}} {time.time()}'
+        )
+        # The collector never reads half a file
+        with atomic_write(os.path.join(self.output_dir, f"{self.script}.prom"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+class TracedClient:
+    """
+    Proxy around a client that opens a span for each call to one of `methods`.
+
+    Parameters
+    ----------
+    client : the wrapped client, every other attribute is passed through to it
+    tracer (Tracer)
+    service (str): name of the remote service, ex: s3
+    methods (dict): method name to a function(span, args, kwargs, result) adding counts to the span
+    children (dict): attribute or method name to (methods, children) for the object it returns,
+        which is wrapped as well. Ex: the cursors of a connection.
+
+    """
+
+    def __init__(self, client, tracer, service, methods, children=None):
+        object.__setattr__(self, "_client", client)
+        object.__setattr__(self, "_tracer", tracer)
+        object.__setattr__(self, "_service", service)
+        object.__setattr__(self, "_methods", methods)
+        object.__setattr__(self, "_children", children or {})
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name in self._children:
+            methods, children = self._children[name]
+            if not callable(attr):
+                return TracedClient(attr, self._tracer, self._service, methods, children)
+
+            def wrapped(*args, **kwargs):
+                result = attr(*args, **kwargs)
+                return TracedClient(result, self._tracer, self._service, methods, children)
+
+            return wrapped
+        if name not in self._methods:
+            return attr
+        measure = self._methods[name]
+
+        def traced(*args, **kwargs):
+            with self._tracer.span(self._service, name) as span:
+                result = attr(*args, **kwargs)
+                measure(span, args, kwargs, result)
+            return result
+
+        return traced
+
+    def __setattr__(self, name, value):
+        setattr(self._client, name, value)
+
+    def __enter__(self):
+        self._client.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._client.__exit__(*exc)
+
+    def __iter__(self):
+        return iter(self._client)
+
+
+def _nothing(span, args, kwargs, result):
+    pass
+
+
+def _body_size(body):
+    if isinstance(body, str):
+        return len(body.encode())
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    return 0
+
+
+def _s3_retries(span, result):
+    span.add(retries=result.get("ResponseMetadata", {}).get("RetryAttempts", 0))
+
+
+def _s3_get(span, args, kwargs, result):
+    # The body is streamed after the call, the span covers the time to first byte
+    span.attributes["key"] = kwargs.get("Key")
+    span.add(bytes_in=result.get("ContentLength", 0))
+    _s3_retries(span, result)
+
+
+def _s3_put(span, args, kwargs, result):
+    span.attributes["key"] = kwargs.get("Key")
+    span.add(bytes_out=_body_size(kwargs.get("Body")))
+    _s3_retries(span, result)
+
+
+def _s3_other(span, args, kwargs, result):
+    span.attributes["key"] = kwargs.get("Key")
+    _s3_retries(span, result)
+
+
+S3_METHODS = {
+    "get_object": _s3_get,
+    "put_object": _s3_put,
+    "head_object": _s3_other,
+    "delete_object": _s3_other,
+}
+
+
+def _socrata_read(span, args, kwargs, result):
+    span.attributes["dataset"] = args[0] if args else kwargs.get("dataset_identifier")
+    span.add(rows=len(result) if isinstance(result, list) else 0)
+
+
+def _socrata_write(span, args, kwargs, result):
+    span.attributes["dataset"] = args[0] if args else kwargs.get("dataset_identifier")
+    payload = args[1] if len(args) > 1 else kwargs.get("payload")
+    span.add(rows=len(payload) if isinstance(payload, list) else 0)
+
+
+SOCRATA_METHODS = {
+    "get": _socrata_read,
+    "upsert": _socrata_write,
+    "replace": _socrata_write,
+    "delete": _socrata_read,
+}
+
+
+def _fetched_rows(span, args, kwargs, result):
+    span.add(rows=len(result))
+
+
+CURSOR_METHODS = {
+    "execute": _nothing,
+    "fetchall": _fetched_rows,
+    "fetchmany": _fetched_rows,
+}
+
+
+def _features(span, args, kwargs, result):
+    # Queries with return_count_only return a number instead of a FeatureSet
+    features = getattr(result, "features", None)
+    span.add(rows=len(features) if features is not None else 0)
+
+
+FEATURE_LAYER_METHODS = {"query": _features}
+
+
+def _sheet_rows(span, args, kwargs, result):
+    span.attributes["sheet_id"] = args[0] if args else kwargs.get("sheet_id")
+    span.add(rows=len(getattr(result, "rows", None) or []))
+
+
+SMARTSHEET_SHEETS_METHODS = {
+    "get_sheet": _sheet_rows,
+    "get_sheet_version": _nothing,
+    "get_columns": _nothing,
+}
+
+
+def record(**counts):
+    """Adds counts (ex: retries=1) to the span open in the calling thread, if any"""
+    span = _active.current() if _active is not None else None
+    if span is not None:
+        span.add(**counts)
+
+
+def _tracer(tracer):
+    tracer = tracer or _active
+    if tracer is None or not tracer.enabled:
+        return None
+    return tracer
+
+
+@contextmanager
+def span(service, operation, tracer=None, **attributes):
+    """
+    Records the wrapped block as a call to a service, for calls that aren't made
+    through a traced client. Yields the Span, or None when tracing is off.
+    """
+    tracer = _tracer(tracer)
+    if tracer is None:
+        yield None
+        return
+    with tracer.span(service, operation, **attributes) as current:
+        yield current
+
+
+def trace_requests(session, tracer=None):
+    """
+    Adds the size of every HTTP request and response made with a requests session
+    to the span open in the calling thread, for clients whose methods don't report
+    the bytes they transfer.
+    """
+    tracer = _tracer(tracer)
+    if tracer is None or session is None:
+        return
+
+    def count_bytes(response, *args, **kwargs):
+        span = tracer.current()
+        if span is not None:
+            body = response.request.body if response.request is not None else None
+            span.add(bytes_in=len(response.content), bytes_out=_body_size(body))
+
+    session.hooks["response"].append(count_bytes)
+
+
+def trace_s3(client, tracer=None):
+    """Traces a boto3 S3 client"""
+    tracer = _tracer(tracer)
+    if tracer is None:
+        return client
+    return TracedClient(client, tracer, "s3", S3_METHODS)
+
+
+def trace_socrata(soda, tracer=None):
+    """Traces a sodapy client, bytes are counted on its requests session"""
+    tracer = _tracer(tracer)
+    if tracer is None:
+        return soda
+    trace_requests(getattr(soda, "session", None), tracer)
+    return TracedClient(soda, tracer, "socrata", SOCRATA_METHODS)
+
+
+def trace_oracle(conn, tracer=None):
+    """Traces the cursors of an Oracle connection"""
+    tracer = _tracer(tracer)
+    if tracer is None:
+        return conn
+    return TracedClient(conn, tracer, "oracle", {}, {"cursor": (CURSOR_METHODS, None)})
+
+
+def trace_feature_layer(layer, tracer=None):
+    """Traces the queries of an arcgis FeatureLayer"""
+    tracer = _tracer(tracer)
+    if tracer is None:
+        return layer
+    return TracedClient(layer, tracer, "agol", FEATURE_LAYER_METHODS)
+
+
+def trace_smartsheet(smart, tracer=None):
+    """Traces the sheet downloads of a smartsheet client, bytes are counted on its session"""
+    tracer = _tracer(tracer)
+    if tracer is None:
+        return smart
+    trace_requests(getattr(smart, "_session", None), tracer)
+    return TracedClient(
+        smart, tracer, "smartsheet", {}, {"Sheets": (SMARTSHEET_SHEETS_METHODS, None)}
+    )
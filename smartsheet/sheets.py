@@ -1,17 +1,24 @@
+# Dates are parsed from the cell values returned by the Smartsheet API, system
+# created dates are ISO 8601 timestamps in UTC and are converted to TIMEZONE.
+TIMEZONE = "US/Central"
+
 FILES = [
     {
         "id": 4477152411314052,  # Smartsheet sheet ID
         "name": "Commercial DS Permit Requests",  # File name used in S3
         "date_column": "Date Created",  # Date column name in the smartsheet
+        "date_format": "%Y-%m-%dT%H:%M:%S%z",  # Format of the date column's cell values
     },
     {
         "id": 1926715770464132,
         "name": "Extension and Revision Requests",
         "date_column": "Created",
+        "date_format": "%Y-%m-%dT%H:%M:%S%z",
     },
     {
         "id": 6628516847478660,
         "name": "Residential DS Permits",
         "date_column": "Date Created",
+        "date_format": "%Y-%m-%dT%H:%M:%S%z",
     },
 ]
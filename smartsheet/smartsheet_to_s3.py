@@ -2,40 +2,227 @@
 Downloads a Smartsheet and uploads a summary of the permit count by date to S3
 """
 
-import boto3
-import pandas as pd
-import smartsheet
-
-import tempfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime
 from io import StringIO
+import logging
 import os
 
-from sheets import FILES
+import utils
+from profiling import Profiler, add_profile_arguments
+from sheets import FILES, TIMEZONE
+from tracing import Tracer, trace_s3, trace_smartsheet
 
 # AWS Credentials
 AWS_ACCESS_ID = os.getenv("EXEC_DASH_ACCESS_ID")
 AWS_PASS = os.getenv("EXEC_DASH_PASS")
 BUCKET = os.getenv("BUCKET_NAME")
 
+# Rows requested per page from the Smartsheet API
+PAGE_SIZE = 5000
 
-def download_file(smart, id, temp_dir, name):
-    smart.Sheets.get_sheet_as_csv(
-        id,
-        download_path=temp_dir.name,
-        alternate_file_name=f"{name}.csv",
-    )
+logger = logging.getLogger(__name__)
+
+
+def sheet_to_df(sheet):
+    """
+    Builds a dataframe from a sheet returned by the Smartsheet API, one column
+    per sheet column titled like in the smartsheet.
+    """
+    import pandas as pd
+
+    titles = {column.id: column.title for column in sheet.columns}
+    records = [
+        {titles[cell.column_id]: cell.value for cell in row.cells} for row in sheet.rows
+    ]
+    return pd.DataFrame(records, columns=list(titles.values()))
+
+
+def column_ids(smart, f):
+    # Looks up the IDs of the columns we use from their titles in sheets.py
+    columns = smart.Sheets.get_columns(f["id"], include_all=True).data
+    ids = {column.title: column.id for column in columns}
+    return [ids[f["date_column"]]]
+
+
+def download_sheet(smart, f, columns, **kwargs):
+    """
+    Downloads only the given columns of a sheet, a page of rows at a time.
+
+    Parameters
+    ----------
+    smart : smartsheet client
+    f (dict): an entry of sheets.FILES
+    columns (list): the column IDs to request, see column_ids
+    kwargs : other get_sheet filters, ex: rows_modified_since
+
+    Returns
+    -------
+    df (dataframe): the rows that were returned
+    total_row_count (int): the number of rows in the whole sheet
+
+    """
+    import pandas as pd
 
+    frames = []
+    page = 1
+    while True:
+        sheet = smart.Sheets.get_sheet(
+            f["id"], column_ids=columns, page_size=PAGE_SIZE, page=page, **kwargs
+        )
+        frames.append(sheet_to_df(sheet))
+        # The API returns the last page again for pages past the end, so a sheet with
+        # a multiple of PAGE_SIZE rows is stopped by its row count, not a short page
+        if len(sheet.rows) < PAGE_SIZE or page * PAGE_SIZE >= sheet.total_row_count:
+            break
+        page += 1
+    return pd.concat(frames, ignore_index=True), sheet.total_row_count
 
-def df_groupby_date(df, date_column):
+
+def parse_dates(df, date_column, date_format):
+    # Parses a sheet's date column, timestamps with a timezone are converted to TIMEZONE
+    import pandas as pd
+
+    dates = pd.to_datetime(df[date_column], format=date_format)
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_convert(TIMEZONE)
+    return dates
+
+
+def df_groupby_date(dates, date_column):
     # Returns the count of the number of permits for each date in our dataframe
-    df[date_column] = pd.to_datetime(df[date_column])
-    df = df.groupby([df[date_column].dt.date])[date_column].count()
+    import pandas as pd
+
+    df = dates.groupby(dates.dt.date.rename(date_column)).count()
     df = pd.DataFrame(df)
     df = df.rename(columns={date_column: "Count Permits"})
+    df.index = df.index.astype(str)
     return df
 
 
-def df_to_s3(df, resource, filename):
+def stored_state(client, filename):
+    """
+    Returns the metadata saved with a sheet's counts in S3 by the last run, see
+    sync_metadata. Returns an empty dict if the counts haven't been uploaded yet.
+    """
+    try:
+        response = client.head_object(Bucket=BUCKET, Key=f"{filename}.csv")
+    except client.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return {}
+        raise
+    return response["Metadata"]
+
+
+def stored_counts(client, filename, date_column):
+    # Reads the per-date counts uploaded by the last run
+    import pandas as pd
+
+    response = client.get_object(Bucket=BUCKET, Key=f"{filename}.csv")
+    return pd.read_csv(response["Body"], index_col=date_column, dtype={date_column: str})
+
+
+def last_created(dates):
+    # Returns the latest timestamp of a date column, None if it isn't a timestamp
+    if dates.dt.tz is None or not dates.notna().any():
+        return None
+    return dates.max()
+
+
+def sync_metadata(version, fetched_at, row_count, last_created):
+    """
+    Metadata stored with the counts in S3 so the next run can tell whether the
+    sheet changed and which rows it has already counted.
+
+    Parameters
+    ----------
+    version (int): the sheet version the counts were computed from
+    fetched_at (str): UTC time the rows were requested at
+    row_count (int): number of rows in the sheet
+    last_created (timestamp): date of the newest row counted, None if unknown
+
+    """
+    metadata = {
+        "sheet-version": str(version),
+        "fetched-at": fetched_at,
+        "row-count": str(row_count),
+    }
+    if last_created is not None:
+        metadata["last-created"] = last_created.tz_convert("UTC").isoformat()
+    return metadata
+
+
+def fetch_new_rows(smart, f, columns, state):
+    """
+    Fetches only the rows modified since the last run and keeps the ones created
+    after the last counted row. Returns None when the new rows can't be merged
+    into the stored counts: the date column isn't a timestamp, or rows were
+    deleted so the row count doesn't add up.
+    """
+    import pandas as pd
+
+    if "last-created" not in state or "row-count" not in state:
+        return None
+    df, row_count = download_sheet(
+        smart, f, columns, rows_modified_since=state["fetched-at"]
+    )
+    dates = parse_dates(df, f["date_column"], f["date_format"])
+    if dates.dt.tz is None:
+        return None
+    dates = dates[dates > pd.Timestamp(state["last-created"])]
+    if int(state["row-count"]) + len(dates) != row_count:
+        return None
+    return dates, row_count
+
+
+def fetch_sheet(smart, client, f, full=False):
+    """
+    Downloads the rows of one sheet that haven't been counted yet.
+
+    Returns
+    -------
+    None if the sheet's version hasn't changed since the last run, otherwise a
+    dict with the parsed 'dates' of the rows to count, the stored 'counts' they
+    are added to (None when the whole sheet was fetched) and the 'metadata' to
+    save with the new counts.
+
+    """
+    import pandas as pd
+
+    state = {} if full else stored_state(client, f["name"])
+    version = smart.Sheets.get_sheet_version(f["id"]).version
+    if state.get("sheet-version") == str(version):
+        return None
+
+    columns = column_ids(smart, f)
+    fetched_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    new_rows = fetch_new_rows(smart, f, columns, state) if state else None
+    if new_rows is not None:
+        dates, row_count = new_rows
+        counts = stored_counts(client, f["name"], f["date_column"])
+        # The last counted row is kept when no rows were added
+        newest = last_created(dates)
+        if newest is None:
+            newest = pd.Timestamp(state["last-created"])
+        metadata = sync_metadata(version, fetched_at, row_count, newest)
+        return {"dates": dates, "counts": counts, "metadata": metadata}
+
+    df, row_count = download_sheet(smart, f, columns)
+    dates = parse_dates(df, f["date_column"], f["date_format"])
+    metadata = sync_metadata(version, fetched_at, row_count, last_created(dates))
+    return {"dates": dates, "counts": None, "metadata": metadata}
+
+
+def merge_counts(counts, new_counts):
+    # Adds the counts of new rows to the stored per-date counts
+    import pandas as pd
+
+    merged = counts["Count Permits"].add(new_counts["Count Permits"], fill_value=0)
+    return pd.DataFrame(merged.astype(int).sort_index())
+
+
+def df_to_s3(df, client, filename, metadata):
     """
     Send pandas dataframe to an S3 bucket as a CSV
     h/t https://stackoverflow.com/questions/38154040/save-dataframe-to-csv-directly-to-s3-python
@@ -43,34 +230,89 @@ def df_to_s3(df, resource, filename):
     Parameters
     ----------
     df : Pandas Dataframe
-    resource : boto3 s3 resource
+    client : boto3 s3 client
     filename : String of the file that will be created in the S3 bucket ex:
+    metadata : dict of strings stored as the object's metadata
+
+    Returns
+    -------
+    str: the CSV that was uploaded
 
     """
     csv_buffer = StringIO()
     df.to_csv(csv_buffer, index=True)
-    resource.Object(BUCKET, f"{filename}.csv").put(Body=csv_buffer.getvalue())
+    client.put_object(
+        Bucket=BUCKET,
+        Key=f"{filename}.csv",
+        Body=csv_buffer.getvalue(),
+        Metadata=metadata,
+    )
+    return csv_buffer.getvalue()
 
 
-def main():
-    # Create a temporary directory where we will store the data from smartsheet
-    temp_dir = tempfile.TemporaryDirectory()
+def main(args):
+    import boto3
+    import smartsheet
+
+    script = "smartsheet_to_s3"
+    with Profiler.from_args(script, args) as profiler, Tracer(script):
+        smart = trace_smartsheet(smartsheet.Smartsheet())
+        s3_client = trace_s3(
+            boto3.client(
+                "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
+            )
+        )
+        sync_sheets(smart, s3_client, profiler, full=args.full)
+
+
+def sync_sheets(smart, s3_client, profiler, full=False):
+    """
+    Uploads the per-date counts of every changed sheet to S3.
+
+    Returns
+    -------
+    dict of S3 file name to the uploaded CSV, for the sheets that changed
+
+    """
+    # Every sheet is checked at the same time, so this takes as long as the slowest one
+    with profiler.stage("download"):
+        with ThreadPoolExecutor(max_workers=len(FILES)) as executor:
+            results = list(
+                executor.map(
+                    lambda f: fetch_sheet(smart, s3_client, f, full=full), FILES
+                )
+            )
+
+    # Summarize each changed sheet and send to s3
+    uploaded = {}
+    for f, result in zip(FILES, results):
+        if result is None:
+            logger.info(f"{f['name']} hasn't changed, skipping")
+            continue
+        with profiler.stage("transform", sheet=f["name"]):
+            df = df_groupby_date(result["dates"], f["date_column"])
+            if result["counts"] is not None:
+                logger.info(f"{f['name']}: {len(result['dates'])} new rows")
+                df = merge_counts(result["counts"], df)
+        with profiler.stage("publish", sheet=f["name"]):
+            uploaded[f"{f['name']}.csv"] = df_to_s3(
+                df, s3_client, f["name"], result["metadata"]
+            )
+    return uploaded
 
-    smart = smartsheet.Smartsheet()
-    s3_resource = boto3.resource(
-        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
-    )
 
-    # Download the sheet and then send to s3
-    for f in FILES:
-        download_file(smart, f["id"], temp_dir, f["name"])
-        df = pd.read_csv(f"{temp_dir.name}/{f['name']}.csv")
-        df = df_groupby_date(df, f["date_column"])
-        df_to_s3(df, s3_resource, f["name"])
+# CLI argument definition
+parser = argparse.ArgumentParser()
 
-    # Delete temporary directory
-    temp_dir.cleanup()
+parser.add_argument(
+    "--full",
+    action="store_true",
+    help="Download and count every sheet even if it hasn't changed since the last run",
+)
 
+add_profile_arguments(parser)
 
 if __name__ == "__main__":
-    main()
+    utils.get_logger(__name__, level=logging.INFO)
+    args = parser.parse_args()
+    main(args)